@@ -0,0 +1,17 @@
+import argparse
+from kitti_columnar import convert_kitti_pickle_to_columnar
+
+#One-time conversion of the kitti_singlefile_data_*.pickle files into memory-mappable columnar directories
+#(pass the directory as kitti_dataset_file to KITTIVODatasetPreTransformed)
+def main():
+    parser = argparse.ArgumentParser(description='Convert KITTI pickled pose data to the columnar format')
+    parser.add_argument('pickle_files', nargs='+')
+    args = parser.parse_args()
+
+    for pickle_file in args.pickle_files:
+        print('Converting {}...'.format(pickle_file))
+        out_dir = convert_kitti_pickle_to_columnar(pickle_file)
+        print('Saved to {}.'.format(out_dir))
+
+if __name__ == '__main__':
+    main()
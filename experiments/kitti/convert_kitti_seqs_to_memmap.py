@@ -0,0 +1,23 @@
+import argparse
+from loaders import convert_kitti_seq_to_memmap
+
+#One-time conversion of the seq_XX.pt image files into memory-mappable .npy stores
+#(use with KITTIVODatasetPreTransformed(..., use_memmap=True))
+def main():
+    parser = argparse.ArgumentParser(description='Convert KITTI sequence files to memory-mapped image stores')
+    parser.add_argument('--megalith', action='store_true', default=False)
+    parser.add_argument('--seqs', nargs='+', default=['00','02','05','06', '07', '08', '09', '10'])
+    args = parser.parse_args()
+
+    seqs_base_path = '/media/m2-drive/datasets/KITTI/single_files'
+    if args.megalith:
+        seqs_base_path = '/media/datasets/KITTI/single_files'
+    seq_prefix = 'seq_'
+
+    for seq in args.seqs:
+        print('Converting sequence {}...'.format(seq))
+        out_path = convert_kitti_seq_to_memmap(seqs_base_path, seq, seq_prefix)
+        print('Saved to {}.'.format(out_path))
+
+if __name__ == '__main__':
+    main()
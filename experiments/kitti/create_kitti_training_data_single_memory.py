@@ -3,6 +3,7 @@ import pickle, csv, glob, os
 import random
 import numpy as np
 from liegroups.numpy import SE3
+from kitti_columnar import save_kitti_columnar
 
 KITTI_SEQS_DICT = {'00': {'date': '2011_10_03',
                           'drive': '0027',
@@ -35,6 +36,26 @@ KITTI_SEQS_DICT = {'00': {'date': '2011_10_03',
                           'drive': '0034',
                           'frames': range(0, 1201)}}
 
+def stack_poses(poses):
+    """Stack a list of SE3 poses into an N x 4 x 4 array"""
+    return np.stack([T.as_matrix() for T in poses], axis=0)
+
+def inv_transforms(T):
+    """Invert a batch of N x 4 x 4 rigid transforms"""
+    C_T = np.swapaxes(T[:, :3, :3], 1, 2)
+    T_inv = np.zeros_like(T)
+    T_inv[:, :3, :3] = C_T
+    T_inv[:, :3, 3] = -np.einsum('nij,nj->ni', C_T, T[:, :3, 3])
+    T_inv[:, 3, 3] = 1.
+    return T_inv
+
+def rotation_angles(C):
+    """Rotation angles (in radians) of a batch of N x 3 x 3 rotation matrices"""
+    #atan2 form keeps precision at both small and large angles (arccos of the trace does not)
+    axis = np.stack([C[:, 2, 1] - C[:, 1, 2], C[:, 0, 2] - C[:, 2, 0], C[:, 1, 0] - C[:, 0, 1]], axis=1)
+    cos_angle = 0.5*(np.trace(C, axis1=1, axis2=2) - 1.)
+    return np.arctan2(0.5*np.linalg.norm(axis, axis=1), cos_angle)
+
 def compute_vo_pose_errors(tm, pose_deltas, seq, eval_type='train', add_reverse=False, min_turning_angle=0.):
     """Compute delta pose errors on VO estimates """
     T_21_gts = []
@@ -42,33 +63,29 @@ def compute_vo_pose_errors(tm, pose_deltas, seq, eval_type='train', add_reverse=
     pair_pose_ids = []
     seqs = []
 
+    Twv_gt = stack_poses(tm.Twv_gt)
+    Twv_est = stack_poses(tm.Twv_est)
+    Tvw_gt = inv_transforms(Twv_gt)
+    Tvw_est = inv_transforms(Twv_est)
 
     for p_delta in pose_deltas:
 
-        pose_ids = range(len(tm.Twv_gt) - p_delta)
-    
-        for i, p_idx in enumerate(pose_ids):
-            T_21_gt = tm.Twv_gt[p_idx + p_delta].inv().dot(tm.Twv_gt[p_idx])
-            T_21_est = tm.Twv_est[p_idx + p_delta].inv().dot(tm.Twv_est[p_idx])
-
-            turning_angle = np.linalg.norm(T_21_gt.rot.log())*(180./np.pi)
-            if (turning_angle > min_turning_angle):
-                T_21_gts.append(T_21_gt.as_matrix())
-                T_21_ests.append(T_21_est.as_matrix())
-                pair_pose_ids.append([p_idx, p_idx + p_delta])
-                seqs.append(seq)
-
+        pose_ids = np.arange(len(Twv_gt) - p_delta)
+        directions = [(pose_ids, pose_ids + p_delta)]
         if add_reverse:
-            for i, p_idx in enumerate(pose_ids):
-                T_21_gt = tm.Twv_gt[p_idx].inv().dot(tm.Twv_gt[p_idx + p_delta])
-                T_21_est = tm.Twv_est[p_idx].inv().dot(tm.Twv_est[p_idx + p_delta])
+            directions.append((pose_ids + p_delta, pose_ids))
+
+        #Pair (i, j) uses T_21 = T_vw[j] T_wv[i], i.e. Twv[j].inv().dot(Twv[i])
+        for ids_1, ids_2 in directions:
+            T_21_gt = np.matmul(Tvw_gt[ids_2], Twv_gt[ids_1])
+            T_21_est = np.matmul(Tvw_est[ids_2], Twv_est[ids_1])
 
-                turning_angle = np.linalg.norm(T_21_gt.rot.log())*(180./np.pi)
-                if turning_angle > min_turning_angle: #or coin_flip[i]:
-                    T_21_gts.append(T_21_gt.as_matrix())
-                    T_21_ests.append(T_21_est.as_matrix())
-                    pair_pose_ids.append([p_idx + p_delta, p_idx])
-                    seqs.append(seq)
+            turning_angles = rotation_angles(T_21_gt[:, :3, :3])*(180./np.pi)
+            mask = turning_angles > min_turning_angle
+            T_21_gts.extend(T_21_gt[mask])
+            T_21_ests.extend(T_21_est[mask])
+            pair_pose_ids.extend(np.stack([ids_1[mask], ids_2[mask]], axis=1).tolist())
+            seqs.extend([seq]*int(mask.sum()))
 
     return (T_21_gts, T_21_ests, pair_pose_ids, seqs)
 
@@ -183,6 +200,10 @@ def main():
         with open(data_filename, 'wb') as f:
             pickle.dump(kitti_data, f, pickle.HIGHEST_PROTOCOL)
 
+        #Columnar copy (memory-mappable) alongside the pickle
+        columnar_dir = save_kitti_columnar(kitti_data, os.path.splitext(data_filename)[0])
+        print('Saved columnar copy to {}.'.format(columnar_dir))
+
         print('Saved.')
 
 
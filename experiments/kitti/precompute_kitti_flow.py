@@ -0,0 +1,31 @@
+import argparse
+from loaders import KITTIVODatasetPreTransformed, precompute_kitti_flow
+
+#Offline job: fills the optical flow cache for every image pair of a KITTI dataset file
+#(use with KITTIVODatasetPreTransformed(..., use_flow=True, flow_cache_dir=...))
+def main():
+    parser = argparse.ArgumentParser(description='Precompute KITTI optical flow into a memory-mapped cache')
+    parser.add_argument('--seq', choices=['00', '02', '05'], default='00')
+    parser.add_argument('--megalith', action='store_true', default=False)
+    parser.add_argument('--memmap', action='store_true', default=False)
+    parser.add_argument('--apply_blur', action='store_true', default=False)
+    parser.add_argument('--flow_cache_dir', type=str, default='kitti/flow_cache')
+    parser.add_argument('--num_procs', type=int, default=None)
+    args = parser.parse_args()
+
+    seqs_base_path = '/media/m2-drive/datasets/KITTI/single_files'
+    if args.megalith:
+        seqs_base_path = '/media/datasets/KITTI/single_files'
+    seq_prefix = 'seq_'
+
+    kitti_data_pickle_file = 'kitti/kitti_singlefile_data_sequence_{}_delta_1_reverse_True_minta_0.0.pickle'.format(args.seq)
+
+    for run_type in ['train', 'test']:
+        dataset = KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=True, apply_blur=args.apply_blur, seqs_base_path=seqs_base_path, 
+                                               run_type=run_type, seq_prefix=seq_prefix, use_memmap=args.memmap, flow_cache_dir=args.flow_cache_dir)
+        print('Computing flow for {} pairs...'.format(run_type))
+        num_pairs = precompute_kitti_flow(dataset, num_procs=args.num_procs)
+        print('Cached {} pairs in {}.'.format(num_pairs, args.flow_cache_dir))
+
+if __name__ == '__main__':
+    main()
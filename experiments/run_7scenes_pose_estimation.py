@@ -1,14 +1,15 @@
 import torch
+import os
 import time, argparse
 from datetime import datetime
 import numpy as np
-from loaders import SevenScenesData
+from loaders import SevenScenesData, ShardCropNormalize, pack_seven_scenes, seven_scenes_shard_paths
 from networks import *
 from losses import *
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as transforms
 import tqdm
-from helpers_train_test import train_test_model
+from helpers_train_test import train_test_model, PrefetchLoader
 
 
 def main():
@@ -22,7 +23,9 @@ def main():
     parser.add_argument('--batch_size_train', type=int, default=32)
 
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
     parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--shards', action='store_true', default=False, help='Use packed uint8 image/pose shards (packed on first use).')
     parser.add_argument('--megalith', action='store_true', default=False)
 
     parser.add_argument('--double', action='store_true', default=False)
@@ -69,12 +72,25 @@ def main():
 
     data_folder = dataset_dir+'7scenes'
 
-    train_loader = DataLoader(SevenScenesData(args.scene, data_folder, train=True, transform=transform_train, output_first_image=False, tensor_type=tensor_type),
+    shard_dir = None
+    if args.shards:
+        shard_dir = os.path.join(data_folder, args.scene)
+        for train in [True, False]:
+            if not all(os.path.exists(path) for path in seven_scenes_shard_paths(shard_dir, args.scene, train)):
+                print('Packing {} shard for {}...'.format('train' if train else 'test', args.scene))
+                pack_seven_scenes(args.scene, data_folder, train, shard_dir)
+        transform_train = ShardCropNormalize(224, train=True)
+        transform_test = ShardCropNormalize(224, train=False)
+
+    train_loader = DataLoader(SevenScenesData(args.scene, data_folder, train=True, transform=transform_train, output_first_image=False, tensor_type=tensor_type, shard_dir=shard_dir),
                         batch_size=args.batch_size_train, pin_memory=True,
                         shuffle=True, num_workers=args.num_workers, drop_last=False)
-    valid_loader = DataLoader(SevenScenesData(args.scene, data_folder, train=False, transform=transform_test, output_first_image=False, tensor_type=tensor_type),
+    valid_loader = DataLoader(SevenScenesData(args.scene, data_folder, train=False, transform=transform_test, output_first_image=False, tensor_type=tensor_type, shard_dir=shard_dir),
                         batch_size=args.batch_size_test, pin_memory=True,
                         shuffle=False, num_workers=args.num_workers, drop_last=False)
+    if args.prefetch:
+        train_loader = PrefetchLoader(train_loader, device, tensor_type)
+        valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
     
     dim_in = 3
 
@@ -2,13 +2,13 @@ import torch
 import time, argparse
 from datetime import datetime
 import numpy as np
-from loaders import FLADataset
+from loaders import FLADataset, FLAPairSampler
 from networks import *
 from losses import *
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as transforms
 import tqdm
-from helpers_train_test import train_test_model
+from helpers_train_test import train_test_model, PrefetchLoader
 
 
 
@@ -20,7 +20,10 @@ def main():
     parser.add_argument('--batch_size_train', type=int, default=32)
 
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
     parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--frame_cache_size', type=int, default=0, help='Decoded frames cached per worker (0 disables).')
+    parser.add_argument('--pair_window', type=int, default=512, help='Shuffle window of the frame-sharing pair sampler (used with --frame_cache_size).')
     parser.add_argument('--megalith', action='store_true', default=False)
 
     parser.add_argument('--double', action='store_true', default=False)
@@ -71,13 +74,26 @@ def main():
     test_dataset = 'experiments/FLA/{}_test.csv'.format(args.scene)
     train_dataset = 'experiments/FLA/{}_train.csv'.format(args.scene)
 
-    train_loader = DataLoader(FLADataset(train_dataset, image_dir=image_dir, pose_dir=pose_dir, transform=transform),
-                            batch_size=args.batch_size_train, pin_memory=False,
-                            shuffle=True, num_workers=args.num_workers, drop_last=False)
+    train_data = FLADataset(train_dataset, image_dir=image_dir, pose_dir=pose_dir, transform=transform, frame_cache_size=args.frame_cache_size)
+    train_sampler = FLAPairSampler(train_data, window=args.pair_window) if args.frame_cache_size > 0 else None
+    train_loader = DataLoader(train_data,
+                            batch_size=args.batch_size_train, pin_memory=args.cuda and args.prefetch, sampler=train_sampler,
+                            shuffle=train_sampler is None, num_workers=args.num_workers, drop_last=False)
 
-    valid_loader = DataLoader(FLADataset(test_dataset, image_dir=image_dir, pose_dir=pose_dir, transform=transform, eval_mode=True),
-                            batch_size=args.batch_size_test, pin_memory=False,
+    valid_data = FLADataset(test_dataset, image_dir=image_dir, pose_dir=pose_dir, transform=transform, eval_mode=True, frame_cache_size=args.frame_cache_size)
+    valid_loader = DataLoader(valid_data,
+                            batch_size=args.batch_size_test, pin_memory=args.cuda and args.prefetch,
                             shuffle=False, num_workers=args.num_workers, drop_last=False)
+    if args.prefetch:
+        train_loader = PrefetchLoader(train_loader, device, tensor_type)
+        valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
+
+    def log_cache_stats(e):
+        #Per-epoch frame cache hit rates (counts are summed over the loader workers)
+        for name, data in [('Train', train_data), ('Test', valid_data)]:
+            stats = data.cache_stats(reset=True)
+            print('{} frame cache: {} hits / {} misses (hit rate: {:.3f}).'.format(name, stats['hits'], stats['misses'], stats['hit_rate']))
+    epoch_callback = log_cache_stats if args.frame_cache_size > 0 else None
 
     
     if args.model == 'A_sym':
@@ -86,7 +102,7 @@ def main():
         train_loader.dataset.rotmat_targets = False
         valid_loader.dataset.rotmat_targets = False
         loss_fn = quat_chordal_squared_loss
-        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False, scheduler=False)
+        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False, scheduler=False, epoch_callback=epoch_callback)
 
     elif args.model == '6D':
         print('==========TRAINING DIRECT 6D ROTMAT MODEL============')
@@ -94,7 +110,7 @@ def main():
         train_loader.dataset.rotmat_targets = True
         valid_loader.dataset.rotmat_targets = True
         loss_fn = rotmat_frob_squared_norm_loss
-        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False, scheduler=False)
+        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False, scheduler=False, epoch_callback=epoch_callback)
 
     elif args.model == 'quat':
         print('=========TRAINING DIRECT QUAT MODEL==================')
@@ -102,7 +118,7 @@ def main():
         train_loader.dataset.rotmat_targets = False
         valid_loader.dataset.rotmat_targets = False
         loss_fn = quat_chordal_squared_loss
-        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False)
+        (train_stats, test_stats) = train_test_model(args, loss_fn, model, train_loader, valid_loader, tensorboard_output=False, epoch_callback=epoch_callback)
 
     if args.save_model:
         saved_data_file_name = 'fla_model_{}_{}_{}'.format(args.scene, args.model, datetime.now().strftime("%m-%d-%Y-%H-%M-%S"))
@@ -2,12 +2,12 @@ import torch
 import time, argparse
 from datetime import datetime
 import numpy as np
-from loaders import KITTIVODatasetPreTransformed
+from loaders import KITTIVODatasetPreTransformed, KITTIVODatasetStreaming
 from networks import *
 from losses import *
 from torch.utils.data import Dataset, DataLoader
 import tqdm
-from helpers_train_test import train_test_model
+from helpers_train_test import train_test_model, PrefetchLoader
 
 
 
@@ -19,16 +19,21 @@ def main():
     parser.add_argument('--batch_size_train', type=int, default=32)
 
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
     parser.add_argument('--num_workers', type=int, default=8)
     parser.add_argument('--megalith', action='store_true', default=False)
 
     parser.add_argument('--double', action='store_true', default=False)
     parser.add_argument('--optical_flow', action='store_true', default=False)
+    parser.add_argument('--memmap', action='store_true', default=False, help='Read images from the memory-mapped store (see kitti/convert_kitti_seqs_to_memmap.py).')
+    parser.add_argument('--flow_cache_dir', type=str, default=None, help='Optical flow cache (see kitti/precompute_kitti_flow.py).')
+    parser.add_argument('--streaming', action='store_true', default=False, help='Stream training sequences chunk by chunk from the memory-mapped store.')
     parser.add_argument('--batchnorm', action='store_true', default=False)
     
     parser.add_argument('--unit_frob', action='store_true', default=False)
     parser.add_argument('--save_model', action='store_true', default=False)
     parser.add_argument('--enforce_psd', action='store_true', default=False)
+    parser.add_argument('--sdp_jobs', type=int, default=None, help='Threads diffcp uses to solve the SDP batch (default: diffcp default, all cores).')
 
     parser.add_argument('--seq', choices=['00', '02', '05'], default='00')
     parser.add_argument('--model', choices=['A_sym', 'A_sym_rot', 'A_sym_rot_16', '6D', 'quat'], default='A_sym')
@@ -58,13 +63,21 @@ def main():
     #kitti_data_pickle_file = 'kitti/kitti_singlefile_data_sequence_{}_delta_2_reverse_True_min_turn_1.0.pickle'.format(args.seq)
     kitti_data_pickle_file = 'kitti/kitti_singlefile_data_sequence_{}_delta_1_reverse_True_minta_0.0.pickle'.format(args.seq)
     
-    train_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='train', seq_prefix=seq_prefix),
-                            batch_size=args.batch_size_train, pin_memory=False,
-                            shuffle=True, num_workers=args.num_workers, drop_last=True)
-
-    valid_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='test', seq_prefix=seq_prefix),
-                            batch_size=args.batch_size_test, pin_memory=False,
+    if args.streaming:
+        train_loader = DataLoader(KITTIVODatasetStreaming(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='train', seq_prefix=seq_prefix, flow_cache_dir=args.flow_cache_dir),
+                                batch_size=args.batch_size_train, pin_memory=args.cuda and args.prefetch,
+                                num_workers=args.num_workers, drop_last=True)
+    else:
+        train_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='train', seq_prefix=seq_prefix, use_memmap=args.memmap, flow_cache_dir=args.flow_cache_dir),
+                                batch_size=args.batch_size_train, pin_memory=args.cuda and args.prefetch,
+                                shuffle=True, num_workers=args.num_workers, drop_last=True)
+
+    valid_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='test', seq_prefix=seq_prefix, use_memmap=args.memmap, flow_cache_dir=args.flow_cache_dir),
+                            batch_size=args.batch_size_test, pin_memory=args.cuda and args.prefetch,
                             shuffle=True, num_workers=args.num_workers, drop_last=True)
+    if args.prefetch:
+        train_loader = PrefetchLoader(train_loader, device, tensor_type)
+        valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
     #Train and test with new representation
     dim_in = 2 if args.optical_flow else 6
 
@@ -80,7 +93,7 @@ def main():
 
     elif args.model == 'A_sym_rot_16':
         print('==============Using A (Sym 16) RotMat MODEL====================')
-        model = RotMatSDPFlowNet(dim_rep=16, dim_in=dim_in, batchnorm=args.batchnorm).to(device=device, dtype=tensor_type)
+        model = RotMatSDPFlowNet(dim_rep=16, dim_in=dim_in, batchnorm=args.batchnorm, sdp_jobs=args.sdp_jobs).to(device=device, dtype=tensor_type)
         train_loader.dataset.rotmat_targets = True
         valid_loader.dataset.rotmat_targets = True
         loss_fn = rotmat_frob_squared_norm_loss
@@ -88,7 +101,7 @@ def main():
 
     elif args.model == 'A_sym_rot':
         print('==============Using A (Sym) RotMat MODEL====================')
-        model = RotMatSDPFlowNet(dim_rep=55, enforce_psd=True, unit_frob_norm=args.unit_frob, dim_in=dim_in, batchnorm=args.batchnorm).to(device=device, dtype=tensor_type)
+        model = RotMatSDPFlowNet(dim_rep=55, enforce_psd=True, unit_frob_norm=args.unit_frob, dim_in=dim_in, batchnorm=args.batchnorm, sdp_jobs=args.sdp_jobs).to(device=device, dtype=tensor_type)
         train_loader.dataset.rotmat_targets = True
         valid_loader.dataset.rotmat_targets = True
         loss_fn = rotmat_frob_squared_norm_loss
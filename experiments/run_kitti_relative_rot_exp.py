@@ -10,7 +10,7 @@ from torch.utils.data import Dataset, DataLoader
 from quaternions import *
 import tqdm
 from utils import loguniform
-from helpers_train_test import train_test_model
+from helpers_train_test import train_test_model, PrefetchLoader
 
 def main():
 
@@ -22,6 +22,7 @@ def main():
     parser.add_argument('--batch_size_train', type=int, default=32)
 
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
     parser.add_argument('--num_workers', type=int, default=8)
     parser.add_argument('--megalith', action='store_true', default=False)
     parser.add_argument('--batchnorm', action='store_true', default=False)
@@ -57,12 +58,15 @@ def main():
         print('===================SEQ {}======================='.format(seq))
         kitti_data_pickle_file = 'kitti/kitti_singlefile_data_sequence_{}_delta_2_reverse_True_min_turn_1.0.pickle'.format(seq)
         train_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='train', seq_prefix=seq_prefix),
-                                batch_size=args.batch_size_train, pin_memory=False,
+                                batch_size=args.batch_size_train, pin_memory=args.cuda and args.prefetch,
                                 shuffle=True, num_workers=args.num_workers, drop_last=True)
 
         valid_loader = DataLoader(KITTIVODatasetPreTransformed(kitti_data_pickle_file, use_flow=args.optical_flow, seqs_base_path=seqs_base_path, transform_img=transform, run_type='test', seq_prefix=seq_prefix),
-                                batch_size=args.batch_size_test, pin_memory=False,
+                                batch_size=args.batch_size_test, pin_memory=args.cuda and args.prefetch,
                                 shuffle=False, num_workers=args.num_workers, drop_last=False)    
+        if args.prefetch:
+            train_loader = PrefetchLoader(train_loader, device, tensor_type)
+            valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
         train_stats_list = []
         test_stats_list = []
 
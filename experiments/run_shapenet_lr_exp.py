@@ -1,77 +1,71 @@
 import torch
-import time, argparse
+import time, argparse, copy
 from datetime import datetime
 import numpy as np
 from tensorboardX import SummaryWriter
-from loaders import PointNetDataset, pointnet_collate
+from loaders import PointNetDataset, pointnet_collate, pointnet_ids_collate, load_pointnet_cache_file_list, pointnet_cache_dir
 from networks import *
 from losses import *
 from torch.utils.data import Dataset, DataLoader
 from quaternions import *
 import tqdm
-from utils import loguniform
-from helpers_train_test import train_test_model
-
-def main():
-
-
-    parser = argparse.ArgumentParser(description='ShapeNet experiment')
-    parser.add_argument('--epochs', type=int, default=150)
-
-    parser.add_argument('--batch_size_test', type=int, default=1)
-    parser.add_argument('--batch_size_train', type=int, default=1)
-    parser.add_argument('--rotations_per_batch_train', type=int, default=10)
-    parser.add_argument('--rotations_per_batch_test', type=int, default=100)
-    parser.add_argument('--iterations_per_epoch', type=int, default=200)
-
-    parser.add_argument('--cuda', action='store_true', default=False)
-    parser.add_argument('--num_workers', type=int, default=0)
-    parser.add_argument('--batchnorm', action='store_true', default=False)
-    parser.add_argument('--unit_frob', action='store_true', default=False)
-
-    parser.add_argument('--double', action='store_true', default=False)
-    
-    #Randomly select within this range
-    parser.add_argument('--lr_min', type=float, default=1e-4)
-    parser.add_argument('--lr_max', type=float, default=1e-3)
-    parser.add_argument('--trials', type=int, default=10)
-
-
-    args = parser.parse_args()
-    print(args)
-
-    #Float or Double?
-    tensor_type = torch.float
+from utils import loguniform, run_trials
+from helpers_train_test import train_test_model, train_test_models, PrefetchLoader
 
+def pointnet_data_path(args):
+    if args.cuda:
+        return '../RotationContinuity/shapenet/data/pc_plane'
+    else:
+        return '/Users/valentinp/Dropbox/Postdoc/projects/misc/RotationContinuity/shapenet/data/pc_plane'
+
+#Loaders are built once per process and shared by all of its trials
+_LOADERS = None
+
+def get_loaders(args, device, tensor_type):
+    global _LOADERS
+    if _LOADERS is None:
+        pointnet_data = pointnet_data_path(args)
+        train_loader = DataLoader(PointNetDataset(pointnet_data + '/points', load_into_memory=True, use_cache=args.point_cache, device=device, rotations_per_batch=args.rotations_per_batch_train, total_iters=args.iterations_per_epoch, dtype=tensor_type, ids_only=args.synthesize_batches, seed=args.seed),
+                            batch_size=args.batch_size_train, pin_memory=True, collate_fn=pointnet_ids_collate if args.synthesize_batches else pointnet_collate,
+                            shuffle=False, num_workers=args.num_workers, drop_last=False)
+
+        valid_loader = DataLoader(PointNetDataset(pointnet_data + '/points_test', load_into_memory=True, use_cache=args.point_cache, device=device, rotations_per_batch=args.rotations_per_batch_test, dtype=tensor_type, test_mode=True, ids_only=args.synthesize_batches, seed=args.seed),
+                            batch_size=args.batch_size_test, pin_memory=True, collate_fn=pointnet_ids_collate if args.synthesize_batches else pointnet_collate,
+                            shuffle=False, num_workers=args.num_workers, drop_last=False)
+        if args.prefetch:
+            train_loader = PrefetchLoader(train_loader, device, tensor_type)
+            valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
+        _LOADERS = (train_loader, valid_loader)
+    return _LOADERS
+
+#One learning rate trial (module-level so that it can run in a worker process)
+def run_trial(t_i, params):
+    (args, lr) = params
+    #Train and test direct model
+    print('===================TRIAL {}/{}======================='.format(t_i+1, args.trials))
+
+    args = copy.copy(args)
+    args.lr = lr
+    print('Learning rate: {:.3E}'.format(lr))
 
     device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
     tensor_type = torch.double if args.double else torch.float
-
-    if args.cuda:
-        pointnet_data = '../RotationContinuity/shapenet/data/pc_plane'
+    (train_loader, valid_loader) = get_loaders(args, device, tensor_type)
+    if args.seed is not None:
+        #The loaders are reused across the trials of a process: restart their streams so the trial only depends on t_i
+        train_loader.dataset.reseed(args.seed + t_i)
+        valid_loader.dataset.reseed(args.seed + t_i)
+
+    if args.lockstep:
+        print('==========TRAINING QUAT, 6D AND A (Sym) MODELS IN LOCKSTEP============')
+        models = [PointNet(dim_out=4, normalize_output=True, batchnorm=args.batchnorm).to(device=device, dtype=tensor_type),
+                  RotMat6DDirect(batchnorm=args.batchnorm).to(device=device, dtype=tensor_type),
+                  QuatNet(enforce_psd=False, unit_frob_norm=args.unit_frob,batchnorm=args.batchnorm).to(device=device, dtype=tensor_type)]
+        loss_fns = [quat_chordal_squared_loss, rotmat_frob_squared_norm_loss, quat_chordal_squared_loss]
+        (train_stats, test_stats) = train_test_models(args, loss_fns, models, train_loader, valid_loader, rotmat_targets=[False, True, False])
+        (train_stats_quat, train_stats_6D, train_stats_A_sym) = train_stats
+        (test_stats_quat, test_stats_6D, test_stats_A_sym) = test_stats
     else:
-        pointnet_data = '/Users/valentinp/Dropbox/Postdoc/projects/misc/RotationContinuity/shapenet/data/pc_plane'
-    
-    train_loader = DataLoader(PointNetDataset(pointnet_data + '/points', load_into_memory=True, device=device, rotations_per_batch=args.rotations_per_batch_train, total_iters=args.iterations_per_epoch, dtype=tensor_type),
-                        batch_size=args.batch_size_train, pin_memory=True, collate_fn=pointnet_collate,
-                        shuffle=False, num_workers=args.num_workers, drop_last=False)
-
-    valid_loader = DataLoader(PointNetDataset(pointnet_data + '/points_test', load_into_memory=True, device=device, rotations_per_batch=args.rotations_per_batch_test, dtype=tensor_type, test_mode=True),
-                        batch_size=args.batch_size_test, pin_memory=True, collate_fn=pointnet_collate,
-                        shuffle=False, num_workers=args.num_workers, drop_last=False)
-    
-    train_stats_list = []
-    test_stats_list = []
-
-    lrs = torch.empty(args.trials)
-    for t_i in range(args.trials):
-        #Train and test direct model
-        print('===================TRIAL {}/{}======================='.format(t_i+1, args.trials))
-
-        lr = loguniform(np.log(args.lr_min), np.log(args.lr_max))
-        args.lr = lr
-        print('Learning rate: {:.3E}'.format(lr))
-
         print('=========TRAINING DIRECT QUAT MODEL==================')
         model_quat = PointNet(dim_out=4, normalize_output=True, batchnorm=args.batchnorm).to(device=device, dtype=tensor_type)
         train_loader.dataset.rotmat_targets = False
@@ -88,7 +82,7 @@ def main():
         (train_stats_6D, test_stats_6D) = train_test_model(args, loss_fn, model_6D, train_loader, valid_loader, tensorboard_output=False)
 
 
-               #Train and test with new representation
+        #Train and test with new representation
         print('==============TRAINING A (Sym) MODEL====================')
         model_sym = QuatNet(enforce_psd=False, unit_frob_norm=args.unit_frob,batchnorm=args.batchnorm).to(device=device, dtype=tensor_type)
         train_loader.dataset.rotmat_targets = False
@@ -97,17 +91,68 @@ def main():
         loss_fn = quat_chordal_squared_loss
         (train_stats_A_sym, test_stats_A_sym) = train_test_model(args, loss_fn, model_sym, train_loader, valid_loader, tensorboard_output=False)
 
-        # #Train and test with new representation
-        # print('==============TRAINING A (PSD) MODEL====================')
-        # model_psd = QuatNet(enforce_psd=True, unit_frob_norm=True).to(device=device, dtype=tensor_type)
-        # loss_fn = quat_squared_loss
-        # (train_stats_A_psd, test_stats_A_psd) = train_test_model(args, loss_fn, model_psd, train_loader, valid_loader, tensorboard_output=False)
-
-        lrs[t_i] = lr
-        #train_stats_list.append([train_stats_6D, train_stats_quat, train_stats_A_sym, train_stats_A_psd])
-        #test_stats_list.append([test_stats_6D, test_stats_quat, test_stats_A_sym, test_stats_A_psd])
-        train_stats_list.append([train_stats_6D, train_stats_quat, train_stats_A_sym])
-        test_stats_list.append([test_stats_6D, test_stats_quat, test_stats_A_sym])
+    # #Train and test with new representation
+    # print('==============TRAINING A (PSD) MODEL====================')
+    # model_psd = QuatNet(enforce_psd=True, unit_frob_norm=True).to(device=device, dtype=tensor_type)
+    # loss_fn = quat_squared_loss
+    # (train_stats_A_psd, test_stats_A_psd) = train_test_model(args, loss_fn, model_psd, train_loader, valid_loader, tensorboard_output=False)
+
+    return ([train_stats_6D, train_stats_quat, train_stats_A_sym], [test_stats_6D, test_stats_quat, test_stats_A_sym])
+
+def main():
+
+
+    parser = argparse.ArgumentParser(description='ShapeNet experiment')
+    parser.add_argument('--epochs', type=int, default=150)
+
+    parser.add_argument('--batch_size_test', type=int, default=1)
+    parser.add_argument('--batch_size_train', type=int, default=1)
+    parser.add_argument('--rotations_per_batch_train', type=int, default=10)
+    parser.add_argument('--rotations_per_batch_test', type=int, default=100)
+    parser.add_argument('--iterations_per_epoch', type=int, default=200)
+
+    parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--point_cache', action='store_true', default=False, help='Read pointclouds from the consolidated binary cache.')
+    parser.add_argument('--synthesize_batches', action='store_true', default=False, help='Load only cloud ids and rotate the batch on the training device.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the synthesized rotations.')
+    parser.add_argument('--batchnorm', action='store_true', default=False)
+    parser.add_argument('--unit_frob', action='store_true', default=False)
+
+    parser.add_argument('--double', action='store_true', default=False)
+    
+    #Randomly select within this range
+    parser.add_argument('--lr_min', type=float, default=1e-4)
+    parser.add_argument('--lr_max', type=float, default=1e-3)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of trials run in parallel.')
+    parser.add_argument('--threads_per_proc', type=int, default=None, help='Torch threads per trial process (default: cores / num_procs).')
+    parser.add_argument('--checkpoint_file', type=str, default=None, help='Saves finished trials; an existing file is resumed.')
+    parser.add_argument('--trial_seed', type=int, default=0, help='Trial t_i seeds torch and numpy with trial_seed + t_i.')
+    parser.add_argument('--lockstep', action='store_true', default=False, help='Train all models on the same minibatches in lockstep.')
+
+
+    args = parser.parse_args()
+    print(args)
+
+    if args.num_procs > 1:
+        #Trial workers are daemonic processes: they cannot start DataLoader workers or build the pointcloud cache themselves
+        args.num_workers = 0
+        if args.point_cache:
+            for pc_folder in [pointnet_data_path(args) + '/points', pointnet_data_path(args) + '/points_test']:
+                load_pointnet_cache_file_list(pc_folder, pointnet_cache_dir(pc_folder))
+
+    #Learning rates are sampled up front (a resumed sweep reuses the ones in its checkpoint)
+    np.random.seed(args.trial_seed)
+    lrs = [loguniform(np.log(args.lr_min), np.log(args.lr_max)) for _ in range(args.trials)]
+    (trial_params, trial_results) = run_trials(run_trial, [(args, lr) for lr in lrs], num_procs=args.num_procs, threads_per_proc=args.threads_per_proc, checkpoint_file=args.checkpoint_file, base_seed=args.trial_seed)
+
+    lrs = torch.tensor([lr for (_, lr) in trial_params])
+    #train_stats_list.append([train_stats_6D, train_stats_quat, train_stats_A_sym, train_stats_A_psd])
+    #test_stats_list.append([test_stats_6D, test_stats_quat, test_stats_A_sym, test_stats_A_psd])
+    train_stats_list = [train_stats for (train_stats, _) in trial_results]
+    test_stats_list = [test_stats for (_, test_stats) in trial_results]
         
     saved_data_file_name = 'diff_lr_shapenet_experiment_3models_{}'.format(datetime.now().strftime("%m-%d-%Y-%H-%M-%S"))
     full_saved_path = 'saved_data/shapenet/{}.pt'.format(saved_data_file_name)
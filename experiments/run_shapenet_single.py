@@ -3,14 +3,14 @@ import time, argparse
 from datetime import datetime
 import numpy as np
 from tensorboardX import SummaryWriter
-from loaders import PointNetDataset, pointnet_collate
+from loaders import PointNetDataset, pointnet_collate, pointnet_ids_collate
 from networks import *
 from losses import *
 from torch.utils.data import Dataset, DataLoader
 from quaternions import *
 import tqdm
 from utils import loguniform
-from helpers_train_test import train_test_model
+from helpers_train_test import train_test_model, PrefetchLoader
 
 def main():
 
@@ -25,7 +25,11 @@ def main():
     parser.add_argument('--iterations_per_epoch', type=int, default=200)
 
     parser.add_argument('--cuda', action='store_true', default=False)
+    parser.add_argument('--prefetch', action='store_true', default=False, help='Copy the next batch to the device (or collate it in a background thread) while the current step runs.')
     parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--point_cache', action='store_true', default=False, help='Read pointclouds from the consolidated binary cache.')
+    parser.add_argument('--synthesize_batches', action='store_true', default=False, help='Load only cloud ids and rotate the batch on the training device.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the synthesized rotations.')
     parser.add_argument('--batchnorm', action='store_true', default=False)
 
     parser.add_argument('--double', action='store_true', default=False)
@@ -56,13 +60,16 @@ def main():
     else:
         pointnet_data = '/Users/valentinp/Dropbox/Postdoc/projects/misc/RotationContinuity/shapenet/data/pc_plane'
     
-    train_loader = DataLoader(PointNetDataset(pointnet_data + '/points', load_into_memory=True, device=device, rotations_per_batch=args.rotations_per_batch_train, total_iters=args.iterations_per_epoch, dtype=tensor_type),
-                        batch_size=args.batch_size_train, pin_memory=True, collate_fn=pointnet_collate,
+    train_loader = DataLoader(PointNetDataset(pointnet_data + '/points', load_into_memory=True, use_cache=args.point_cache, device=device, rotations_per_batch=args.rotations_per_batch_train, total_iters=args.iterations_per_epoch, dtype=tensor_type, ids_only=args.synthesize_batches, seed=args.seed),
+                        batch_size=args.batch_size_train, pin_memory=True, collate_fn=pointnet_ids_collate if args.synthesize_batches else pointnet_collate,
                         shuffle=False, num_workers=args.num_workers, drop_last=False)
 
-    valid_loader = DataLoader(PointNetDataset(pointnet_data + '/points_test', load_into_memory=True, device=device, rotations_per_batch=args.rotations_per_batch_test, dtype=tensor_type, test_mode=True),
-                        batch_size=args.batch_size_test, pin_memory=True, collate_fn=pointnet_collate,
+    valid_loader = DataLoader(PointNetDataset(pointnet_data + '/points_test', load_into_memory=True, use_cache=args.point_cache, device=device, rotations_per_batch=args.rotations_per_batch_test, dtype=tensor_type, test_mode=True, ids_only=args.synthesize_batches, seed=args.seed),
+                        batch_size=args.batch_size_test, pin_memory=True, collate_fn=pointnet_ids_collate if args.synthesize_batches else pointnet_collate,
                         shuffle=False, num_workers=args.num_workers, drop_last=False)
+    if args.prefetch:
+        train_loader = PrefetchLoader(train_loader, device, tensor_type)
+        valid_loader = PrefetchLoader(valid_loader, device, tensor_type)
 
     if args.model == 'A_sym':
         print('==============TRAINING A (Sym) MODEL====================')
@@ -4,8 +4,73 @@ from networks import *
 from quaternions import *
 from helpers_sim import *
 from datetime import datetime
-import argparse
-from utils import loguniform
+import argparse, copy
+from utils import loguniform, run_trials
+
+#One learning rate trial (module-level so that it can run in a worker process)
+def run_trial(t_i, params):
+    (args, lr) = params
+    #Train and test direct model
+    print('===================TRIAL {}/{}======================='.format(t_i+1, args.trials))
+
+    args = copy.copy(args)
+    args.lr = lr
+    print('Learning rate: {:.3E}'.format(lr))
+
+    device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
+    tensor_type = torch.double if args.double else torch.float
+
+    # print('==============TRAINING A (55 psd rotmat) MODEL====================')
+    # model_A_rotmat = RotMatSDPNet(enforce_psd=False, unit_frob_norm=True).to(device=device, dtype=tensor_type)
+    # loss_fn = rotmat_frob_squared_norm_loss
+    # train_data, test_data = None, None
+    # (train_stats_A_rotmat, test_stats_A_rotmat) = train_test_model(args, train_data, test_data, model_A_rotmat, loss_fn,  rotmat_targets=True, tensorboard_output=False)
+    # del(model_A_rotmat)
+    train_stats_A_rotmat, test_stats_A_rotmat = None, None
+
+    if args.lockstep:
+        print('==========TRAINING 6D, QUAT AND A (16 sym quat) MODELS IN LOCKSTEP============')
+        models = [RotMat6DDirect().to(device=device, dtype=tensor_type),
+                  PointNet(dim_out=4, normalize_output=True).to(device=device, dtype=tensor_type),
+                  QuatNet(enforce_psd=False, unit_frob_norm=args.unit_frob).to(device=device, dtype=tensor_type)]
+        loss_fns = [rotmat_frob_squared_norm_loss, quat_chordal_squared_loss, quat_chordal_squared_loss]
+        train_data, test_data = None, None
+        (train_stats, test_stats) = train_test_models(args, train_data, test_data, models, loss_fns, rotmat_targets=[True, False, False])
+        (train_stats_6d, train_stats_quat, train_stats_A_sym) = train_stats
+        (test_stats_6d, test_stats_quat, test_stats_A_sym) = test_stats
+        del(models)
+    else:
+        print('==========TRAINING DIRECT 6D ROTMAT MODEL============')
+        model_6D = RotMat6DDirect().to(device=device, dtype=tensor_type)
+        loss_fn = rotmat_frob_squared_norm_loss
+        train_data, test_data = None, None
+        (train_stats_6d, test_stats_6d) = train_test_model(args, train_data, test_data, model_6D, loss_fn, rotmat_targets=True, tensorboard_output=False)
+        del(model_6D)
+
+        print('=========TRAINING DIRECT QUAT MODEL==================')
+        model_quat = PointNet(dim_out=4, normalize_output=True).to(device=device, dtype=tensor_type)
+        loss_fn = quat_chordal_squared_loss
+        train_data, test_data = None, None
+        (train_stats_quat, test_stats_quat) = train_test_model(args, train_data, test_data, model_quat, loss_fn, rotmat_targets=False, tensorboard_output=False)
+        del(model_quat)
+
+        #Train and test with new representation
+        print('==============TRAINING A (16 sym quat) MODEL====================')
+        model_A_sym = QuatNet(enforce_psd=False, unit_frob_norm=args.unit_frob).to(device=device, dtype=tensor_type)
+        loss_fn = quat_chordal_squared_loss
+        train_data, test_data = None, None
+        (train_stats_A_sym, test_stats_A_sym) = train_test_model(args, train_data, test_data, model_A_sym, loss_fn,  rotmat_targets=False, tensorboard_output=False)
+        del(model_A_sym)
+
+    # #Train and test with new representation
+    # print('==============TRAINING A (16 psd quat) MODEL====================')
+    # model_A_psd = QuatNet(enforce_psd=True, unit_frob_norm=args.unit_frob).to(device=device, dtype=tensor_type)
+    # loss_fn = quat_squared_loss
+    # train_data, test_data = None, None
+    # (train_stats_A_psd, test_stats_A_psd) = train_test_model(args, train_data, test_data, model_A_psd, loss_fn,  rotmat_targets=False, tensorboard_output=False)
+    # del(model_A_psd)
+
+    return ([train_stats_6d, train_stats_quat, train_stats_A_sym], [test_stats_6d, test_stats_quat, test_stats_A_sym])
 
 def main():
     parser = argparse.ArgumentParser(description='Synthetic Wahba arguments.')
@@ -22,6 +87,9 @@ def main():
     #parser.add_argument('--lr', type=float, default=1e-3)
 
     parser.add_argument('--dataset', choices=['dynamic', 'dynamic_beachball'], default='dynamic')
+    parser.add_argument('--stream_data', action='store_true', default=False, help='Generate dynamic datasets minibatch by minibatch on the device.')
+    parser.add_argument('--data_seed', type=int, default=0, help='Seed of the streamed synthetic data.')
+    parser.add_argument('--lockstep', action='store_true', default=False, help='Train all models on the same minibatches in lockstep.')
     parser.add_argument('--max_rotation_angle', type=float, default=180., help='In degrees. Maximum axis-angle rotation of simulated rotation.')
 
     parser.add_argument('--cuda', action='store_true', default=False)
@@ -32,76 +100,23 @@ def main():
     parser.add_argument('--lr_min', type=float, default=1e-4)
     parser.add_argument('--lr_max', type=float, default=1e-3)
     parser.add_argument('--trials', type=int, default=25)
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of trials run in parallel.')
+    parser.add_argument('--threads_per_proc', type=int, default=None, help='Torch threads per trial process (default: cores / num_procs).')
+    parser.add_argument('--checkpoint_file', type=str, default=None, help='Saves finished trials; an existing file is resumed.')
+    parser.add_argument('--trial_seed', type=int, default=0, help='Trial t_i seeds torch and numpy with trial_seed + t_i.')
     
 
     args = parser.parse_args()
     print(args)
 
-    device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
-    tensor_type = torch.double if args.double else torch.float
-
-
-    #Generate data
-    if args.dataset == 'static':
-        train_data, test_data = create_experimental_data_fast(args.N_train, args.N_test, args.matches_per_sample, sigma=args.sim_sigma, device=device, dtype=tensor_type)
-    else:
-        #Data will be generated on the fly
-        train_data, test_data = None, None
-
-    train_stats_list = []
-    test_stats_list = []
-    lrs = torch.empty(args.trials)
-
-    for t_i in range(args.trials):
-        #Train and test direct model
-        print('===================TRIAL {}/{}======================='.format(t_i+1, args.trials))
-
-        lr = loguniform(np.log(args.lr_min), np.log(args.lr_max))
-        args.lr = lr
-        print('Learning rate: {:.3E}'.format(lr))
-
-
-        # print('==============TRAINING A (55 psd rotmat) MODEL====================')
-        # model_A_rotmat = RotMatSDPNet(enforce_psd=False, unit_frob_norm=True).to(device=device, dtype=tensor_type)
-        # loss_fn = rotmat_frob_squared_norm_loss
-        # train_data, test_data = None, None
-        # (train_stats_A_rotmat, test_stats_A_rotmat) = train_test_model(args, train_data, test_data, model_A_rotmat, loss_fn,  rotmat_targets=True, tensorboard_output=False)
-        # del(model_A_rotmat)
-        train_stats_A_rotmat, test_stats_A_rotmat = None, None
-
-        print('==========TRAINING DIRECT 6D ROTMAT MODEL============')
-        model_6D = RotMat6DDirect().to(device=device, dtype=tensor_type)
-        loss_fn = rotmat_frob_squared_norm_loss
-        train_data, test_data = None, None
-        (train_stats_6d, test_stats_6d) = train_test_model(args, train_data, test_data, model_6D, loss_fn, rotmat_targets=True, tensorboard_output=False)
-        del(model_6D)
-
-        print('=========TRAINING DIRECT QUAT MODEL==================')
-        model_quat = PointNet(dim_out=4, normalize_output=True).to(device=device, dtype=tensor_type)
-        loss_fn = quat_chordal_squared_loss
-        train_data, test_data = None, None
-        (train_stats_quat, test_stats_quat) = train_test_model(args, train_data, test_data, model_quat, loss_fn, rotmat_targets=False, tensorboard_output=False)
-        del(model_quat)
-
-        #Train and test with new representation
-        print('==============TRAINING A (16 sym quat) MODEL====================')
-        model_A_sym = QuatNet(enforce_psd=False, unit_frob_norm=args.unit_frob).to(device=device, dtype=tensor_type)
-        loss_fn = quat_chordal_squared_loss
-        train_data, test_data = None, None
-        (train_stats_A_sym, test_stats_A_sym) = train_test_model(args, train_data, test_data, model_A_sym, loss_fn,  rotmat_targets=False, tensorboard_output=False)
-        del(model_A_sym)
+    #Learning rates are sampled up front (a resumed sweep reuses the ones in its checkpoint)
+    np.random.seed(args.trial_seed)
+    lrs = [loguniform(np.log(args.lr_min), np.log(args.lr_max)) for _ in range(args.trials)]
+    (trial_params, trial_results) = run_trials(run_trial, [(args, lr) for lr in lrs], num_procs=args.num_procs, threads_per_proc=args.threads_per_proc, checkpoint_file=args.checkpoint_file, base_seed=args.trial_seed)
 
-        # #Train and test with new representation
-        # print('==============TRAINING A (16 psd quat) MODEL====================')
-        # model_A_psd = QuatNet(enforce_psd=True, unit_frob_norm=args.unit_frob).to(device=device, dtype=tensor_type)
-        # loss_fn = quat_squared_loss
-        # train_data, test_data = None, None
-        # (train_stats_A_psd, test_stats_A_psd) = train_test_model(args, train_data, test_data, model_A_psd, loss_fn,  rotmat_targets=False, tensorboard_output=False)
-        # del(model_A_psd)
-
-        lrs[t_i] = lr
-        train_stats_list.append([train_stats_6d, train_stats_quat, train_stats_A_sym])
-        test_stats_list.append([test_stats_6d, test_stats_quat, test_stats_A_sym])
+    lrs = torch.tensor([lr for (_, lr) in trial_params])
+    train_stats_list = [train_stats for (train_stats, _) in trial_results]
+    test_stats_list = [test_stats for (_, test_stats) in trial_results]
         
     saved_data_file_name = 'diff_lr_synthetic_wahba_experiment_3models_chordal_{}_{}'.format(args.dataset, datetime.now().strftime("%m-%d-%Y-%H-%M-%S"))
     full_saved_path = 'saved_data/synthetic/{}.pt'.format(saved_data_file_name)
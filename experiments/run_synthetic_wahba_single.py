@@ -22,6 +22,8 @@ def main():
     parser.add_argument('--lr', type=float, default=5e-4)
 
     parser.add_argument('--dataset', choices=['static', 'dynamic', 'dynamic_beachball'], default='dynamic')
+    parser.add_argument('--stream_data', action='store_true', default=False, help='Generate dynamic datasets minibatch by minibatch on the device.')
+    parser.add_argument('--data_seed', type=int, default=0, help='Seed of the streamed synthetic data.')
     parser.add_argument('--max_rotation_angle', type=float, default=180., help='In degrees. Maximum axis-angle rotation of simulated rotation.')
     parser.add_argument('--beachball_sigma_factors', type=lambda s: [float(item) for item in s.split(',')], default=[0.1, 0.5, 2, 10])
 
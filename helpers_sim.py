@@ -11,7 +11,8 @@ from tensorboardX import SummaryWriter
 import time
 import tqdm
 
-def train_minibatch(model, loss_fn, optimizer, x, targets, A_prior=None):
+#detach_loss=True returns the loss as a device tensor instead of syncing with loss.item()
+def train_minibatch(model, loss_fn, optimizer, x, targets, A_prior=None, detach_loss=False):
     #Ensure model gradients are active
     model.train()
 
@@ -28,16 +29,16 @@ def train_minibatch(model, loss_fn, optimizer, x, targets, A_prior=None):
     # Update parameters
     optimizer.step()
 
-    return (out, loss.item())
+    return (out, loss.detach() if detach_loss else loss.item())
 
-def test_model(model, loss_fn, x, targets, **kwargs):
+def test_model(model, loss_fn, x, targets, detach_loss=False, **kwargs):
     #model.eval() speeds things up because it turns off gradient computation
     model.eval()
     # Forward
     with torch.no_grad():
         out = model.forward(x, **kwargs)
         loss = loss_fn(out, targets)
-    return (out, loss.item())
+    return (out, loss.detach() if detach_loss else loss.item())
 
 def pretrain(A_net, train_data, test_data):
     loss_fn = torch.nn.MSELoss()
@@ -74,6 +75,29 @@ def pretrain(A_net, train_data, test_data):
 
     return
 
+def synthetic_minibatches(data, N, batch_size):
+    for k in range(N // batch_size):
+        start, end = k * batch_size, (k + 1) * batch_size
+        yield SyntheticData(data.x[start:end], data.q[start:end], None)
+
+def synthetic_streams(args, device, dtype):
+    #Dynamic datasets can be streamed minibatch by minibatch (args.stream_data) instead of regenerated in full every epoch
+    if args.dataset == 'static' or not getattr(args, 'stream_data', False):
+        return None
+    beachball = (args.dataset == 'dynamic_beachball')
+    data_seed = getattr(args, 'data_seed', 0)
+    train_stream = SyntheticWahbaStream(args.N_train, args.batch_size_train, args.matches_per_sample, sigma=args.sim_sigma, beachball=beachball, max_rotation_angle=args.max_rotation_angle, beachball_factors=args.beachball_sigma_factors, seed=data_seed, stream_id=0, device=device, dtype=dtype)
+    test_stream = SyntheticWahbaStream(args.N_test, args.batch_size_test, args.matches_per_sample, sigma=args.sim_sigma, beachball=beachball, max_rotation_angle=args.max_rotation_angle, beachball_factors=args.beachball_sigma_factors, seed=data_seed, stream_id=1, device=device, dtype=dtype)
+    return train_stream, test_stream
+
+def synthetic_epoch_minibatches(args, epoch, streams, train_data, test_data, device, dtype):
+    if streams is not None:
+        return streams[0].epoch(epoch), streams[1].epoch(epoch)
+    if args.dataset != 'static':
+        beachball = (args.dataset == 'dynamic_beachball')
+        train_data, test_data = create_experimental_data_fast(args.N_train, args.N_test, args.matches_per_sample, max_rotation_angle=args.max_rotation_angle, sigma=args.sim_sigma, beachball=beachball, beachball_factors=args.beachball_sigma_factors, device=device, dtype=dtype)
+    return synthetic_minibatches(train_data, args.N_train, args.batch_size_train), synthetic_minibatches(test_data, args.N_test, args.batch_size_test)
+
 def train_test_model(args, train_data, test_data, model, loss_fn, rotmat_targets=False, tensorboard_output=True, verbose=False):
     
     if tensorboard_output:
@@ -88,57 +112,57 @@ def train_test_model(args, train_data, test_data, model, loss_fn, rotmat_targets
     device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
     tensor_type = torch.double if args.double else torch.float
 
+    streams = synthetic_streams(args, device, tensor_type)
+
     pbar = tqdm.tqdm(total=args.epochs)
     for e in range(args.epochs):
         start_time = time.time()
 
-        if args.dataset is not 'static':
-            beachball = (args.dataset == 'dynamic_beachball')
-            beachball_factors = args.beachball_sigma_factors
-            train_data, test_data = create_experimental_data_fast(args.N_train, args.N_test, args.matches_per_sample, max_rotation_angle=args.max_rotation_angle, sigma=args.sim_sigma, beachball=beachball, beachball_factors=beachball_factors, device=device, dtype=tensor_type)
+        (train_batches, test_batches) = synthetic_epoch_minibatches(args, e, streams, train_data, test_data, device, tensor_type)
 
         #Train model
         if verbose:
             print('Training...')
         
-        num_train_batches = args.N_train // args.batch_size_train
-        train_loss = torch.tensor(0.)
-        train_mean_err = torch.tensor(0.)
-        for k in range(num_train_batches):
-            start, end = k * args.batch_size_train, (k + 1) * args.batch_size_train
+        #Metrics are summed on the device and only copied to the host once per epoch
+        train_metrics = MetricsAccumulator(['loss', 'mean_err'], device=device)
+        for batch in train_batches:
 
             if rotmat_targets:
-                targets = quat_to_rotmat(train_data.q[start:end])
-                (C_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, train_data.x[start:end], targets)
-                train_mean_err += (1/num_train_batches)*rotmat_angle_diff(C_est, targets)
+                targets = quat_to_rotmat(batch.q)
+                (C_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, batch.x, targets, detach_loss=True)
+                train_err_k = rotmat_angle_diff(C_est.detach(), targets)
             else:
-                targets = train_data.q[start:end]
-                (q_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, train_data.x[start:end], targets)
-                train_mean_err += (1/num_train_batches)*quat_angle_diff(q_est, targets)        
+                targets = batch.q
+                (q_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, batch.x, targets, detach_loss=True)
+                train_err_k = quat_angle_diff(q_est.detach(), targets)
         
-            train_loss += (1/num_train_batches)*train_loss_k
+            train_metrics.add(loss=train_loss_k, mean_err=train_err_k)
+
+        train_means = train_metrics.means()
+        train_loss, train_mean_err = train_means['loss'], train_means['mean_err']
 
         #Test model
         if verbose:
             print('Testing...')
-        num_test_batches = args.N_test // args.batch_size_test
-        test_loss = torch.tensor(0.)
-        test_mean_err = torch.tensor(0.)
+        test_metrics = MetricsAccumulator(['loss', 'mean_err'], device=device)
 
 
-        for k in range(num_test_batches):
-            start, end = k * args.batch_size_test, (k + 1) * args.batch_size_test
+        for batch in test_batches:
 
             if rotmat_targets:
-                targets = quat_to_rotmat(test_data.q[start:end])
-                (C_est, test_loss_k) =  test_model(model, loss_fn, test_data.x[start:end], targets)
-                test_mean_err += (1/num_test_batches)*rotmat_angle_diff(C_est, targets)
+                targets = quat_to_rotmat(batch.q)
+                (C_est, test_loss_k) =  test_model(model, loss_fn, batch.x, targets, detach_loss=True)
+                test_err_k = rotmat_angle_diff(C_est, targets)
             else:
-                targets = test_data.q[start:end]
-                (q_est, test_loss_k) =  test_model(model, loss_fn, test_data.x[start:end], targets)
-                test_mean_err += (1/num_test_batches)*quat_angle_diff(q_est, targets)   
+                targets = batch.q
+                (q_est, test_loss_k) =  test_model(model, loss_fn, batch.x, targets, detach_loss=True)
+                test_err_k = quat_angle_diff(q_est, targets)
 
-            test_loss += (1/num_test_batches)*test_loss_k
+            test_metrics.add(loss=test_loss_k, mean_err=test_err_k)
+
+        test_means = test_metrics.means()
+        test_loss, test_mean_err = test_means['loss'], test_means['mean_err']
 
         #scheduler.step()
 
@@ -171,6 +195,82 @@ def train_test_model(args, train_data, test_data, model, loss_fn, rotmat_targets
     return train_stats, test_stats
 
 
+def lockstep_minibatches(models, loss_fns, rotmat_targets, batches, metrics, optimizers=None):
+    """Steps every model on each minibatch in turn (trains if optimizers are given, tests otherwise).
+    Targets are built once per minibatch and shared by all models with the same target type."""
+    for batch in batches:
+        targets = {False: batch.q}
+        if any(rotmat_targets):
+            targets[True] = quat_to_rotmat(batch.q)
+        for m_i, (model, loss_fn, rotmat_target) in enumerate(zip(models, loss_fns, rotmat_targets)):
+            if optimizers is not None:
+                (out, loss_k) = train_minibatch(model, loss_fn, optimizers[m_i], batch.x, targets[rotmat_target], detach_loss=True)
+                out = out.detach()
+            else:
+                (out, loss_k) = test_model(model, loss_fn, batch.x, targets[rotmat_target], detach_loss=True)
+
+            if rotmat_target:
+                err_k = rotmat_angle_diff(out, targets[rotmat_target])
+            else:
+                err_k = quat_angle_diff(out, targets[rotmat_target])
+            metrics[m_i].add(loss=loss_k, mean_err=err_k)
+
+def train_test_models(args, train_data, test_data, models, loss_fns, rotmat_targets, verbose=False):
+    """
+    Lockstep version of train_test_model: every model (with its own loss_fn, optimizer and target type) 
+    is stepped on the same minibatch, so the data is only generated once per epoch for all of them.
+    Returns lists of per-model train and test stats (each args.epochs x 2, as in train_test_model).
+    """
+    optimizers = [torch.optim.Adam(model.parameters(), lr=args.lr) for model in models]
+
+    #Save stats
+    train_stats = [torch.empty(args.epochs, 2) for _ in models]
+    test_stats = [torch.empty(args.epochs, 2) for _ in models]
+
+    device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
+    tensor_type = torch.double if args.double else torch.float
+
+    streams = synthetic_streams(args, device, tensor_type)
+
+    pbar = tqdm.tqdm(total=args.epochs)
+    for e in range(args.epochs):
+        start_time = time.time()
+
+        (train_batches, test_batches) = synthetic_epoch_minibatches(args, e, streams, train_data, test_data, device, tensor_type)
+
+        if verbose:
+            print('Training...')
+        train_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+        lockstep_minibatches(models, loss_fns, rotmat_targets, train_batches, train_metrics, optimizers=optimizers)
+
+        if verbose:
+            print('Testing...')
+        test_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+        lockstep_minibatches(models, loss_fns, rotmat_targets, test_batches, test_metrics)
+
+        elapsed_time = time.time() - start_time
+
+        #History tracking
+        output_strings = []
+        for m_i in range(len(models)):
+            train_means = train_metrics[m_i].means()
+            test_means = test_metrics[m_i].means()
+            train_stats[m_i][e] = torch.tensor([train_means['loss'], train_means['mean_err']])
+            test_stats[m_i][e] = torch.tensor([test_means['loss'], test_means['mean_err']])
+            output_strings.append('Model {}: Train: Loss {:.3E} / Error {:.3f} (deg) | Test: Loss {:.3E} / Error {:.3f} (deg).'.format(m_i, train_means['loss'], train_means['mean_err'], test_means['loss'], test_means['mean_err']))
+
+        if verbose:
+            print('Epoch: {}/{}. Epoch time: {:.3f} sec.'.format(e+1, args.epochs, elapsed_time))
+            print('\n'.join(output_strings))
+
+        pbar.set_description('Epoch: {}/{}. '.format(e+1, args.epochs) + ' '.join(output_strings))
+        pbar.update(1)
+
+    pbar.close()
+
+    return train_stats, test_stats
+
+
 def train_test_models_with_plots(args, train_data, test_data, models, loss_fns, rotmat_targets, verbose=False):
     """
     Helper for rss_demo.ipynb
@@ -245,44 +345,18 @@ def train_test_models_with_plots(args, train_data, test_data, models, loss_fns,
                                                                     beachball_factors=beachball_factors, device=device,
                                                                     dtype=tensor_type)
 
-            num_train_batches = args.N_train // args.batch_size_train
-            train_loss = torch.zeros(len(models))
-            train_mean_err = torch.zeros(len(models))
-            for idx, (model, optimizer, loss_fn, rotmat_target) in enumerate(zip(models, optimizers, loss_fns, rotmat_targets)):
-                for k in range(num_train_batches):
-                    start, end = k * args.batch_size_train, (k + 1) * args.batch_size_train
-        
-                    if rotmat_target:
-                        targets = quat_to_rotmat(train_data.q[start:end])
-                        (C_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, train_data.x[start:end], targets)
-                        train_mean_err[idx] += (1 / num_train_batches) * rotmat_angle_diff(C_est, targets)
-                    else:
-                        targets = train_data.q[start:end]
-                        (q_est, train_loss_k) = train_minibatch(model, loss_fn, optimizer, train_data.x[start:end], targets)
-                        train_mean_err[idx] += (1 / num_train_batches) * quat_angle_diff(q_est, targets)
-        
-                    train_loss[idx] += (1 / num_train_batches) * train_loss_k
+            train_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+            lockstep_minibatches(models, loss_fns, rotmat_targets, synthetic_minibatches(train_data, args.N_train, args.batch_size_train), train_metrics, optimizers=optimizers)
+            train_loss = torch.tensor([m.means()['loss'] for m in train_metrics])
+            train_mean_err = torch.tensor([m.means()['mean_err'] for m in train_metrics])
 
             # Test model
             if verbose:
                 print('Testing...')
-            num_test_batches = args.N_test // args.batch_size_test
-            test_loss = torch.zeros(len(models))
-            test_mean_err = torch.zeros(len(models))
-            for idx, (model, loss_fn, rotmat_target) in enumerate(zip(models, loss_fns, rotmat_targets)):
-                for k in range(num_test_batches):
-                    start, end = k * args.batch_size_test, (k + 1) * args.batch_size_test
-        
-                    if rotmat_target:
-                        targets = quat_to_rotmat(test_data.q[start:end])
-                        (C_est, test_loss_k) = test_model(model, loss_fn, test_data.x[start:end], targets)
-                        test_mean_err[idx] += (1 / num_test_batches) * rotmat_angle_diff(C_est, targets)
-                    else:
-                        targets = test_data.q[start:end]
-                        (q_est, test_loss_k) = test_model(model, loss_fn, test_data.x[start:end], targets)
-                        test_mean_err[idx] += (1 / num_test_batches) * quat_angle_diff(q_est, targets)
-        
-                    test_loss[idx] += (1 / num_test_batches) * test_loss_k
+            test_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+            lockstep_minibatches(models, loss_fns, rotmat_targets, synthetic_minibatches(test_data, args.N_test, args.batch_size_test), test_metrics)
+            test_loss = torch.tensor([m.means()['loss'] for m in test_metrics])
+            test_mean_err = torch.tensor([m.means()['mean_err'] for m in test_metrics])
 
             # History tracking
             train_stats[:, e, 0] = train_loss
@@ -317,6 +391,53 @@ def build_A(x_1, x_2, sigma_2):
         A += A_i
     return A 
 
+#Omega_l(pure_quat(e_i)).dot(Omega_r(pure_quat(e_j))) for all basis pairs, shape (3,3,4,4)
+OMEGA_LR_BASIS = np.stack([np.stack([Omega_l(pure_quat(np.eye(3)[i])).dot(Omega_r(pure_quat(np.eye(3)[j])))
+                    for j in range(3)]) for i in range(3)])
+
+def weighted_point_sums(x_1, x_2, sigma_2):
+    #Broadcast sigma_2 (scalar, (N,) or (B,N)) to per-point weights of shape (B,N)
+    if x_1.dim() < 3:
+        x_1 = x_1.unsqueeze(dim=0)
+        x_2 = x_2.unsqueeze(dim=0)
+    sigma_2 = torch.as_tensor(sigma_2, dtype=x_1.dtype, device=x_1.device)
+    w = (1./sigma_2).expand(x_1.shape[:2])
+    return x_1, x_2, w
+
+def build_A_batch(x_1, x_2, sigma_2):
+    """
+    Batched torch version of build_A.
+    Input: x_1, x_2: Bx N x 3 (or N x 3) matched unit vectors, sigma_2: scalar, N or B x N noise variances
+    Output: A: B x 4 x 4
+    """
+    x_1, x_2, w = weighted_point_sums(x_1, x_2, sigma_2)
+    basis = torch.from_numpy(OMEGA_LR_BASIS).to(dtype=x_1.dtype, device=x_1.device)
+    #The Omega product is bilinear in (x_2, x_1), so only the weighted outer products need to be summed
+    M = torch.einsum('bn,bni,bnj->bij', w, x_2, x_1)
+    s = (w*(x_1.pow(2).sum(dim=2) + x_2.pow(2).sum(dim=2))).sum(dim=1)
+    I = torch.eye(4, dtype=x_1.dtype, device=x_1.device)
+    A = s.view(-1, 1, 1)*I + 2.*torch.einsum('bij,ijkl->bkl', M, basis)
+    return A
+
+def build_A_rotmat_batch(x_1, x_2, sigma_2):
+    """
+    Batched 10x10 rotation matrix cost: sum_i [kron(x_1, I), -x_2]^T [kron(x_1, I), -x_2] / sigma_2.
+    Input: x_1, x_2: Bx N x 3 (or N x 3) matched unit vectors, sigma_2: scalar, N or B x N noise variances
+    Output: A: B x 10 x 10
+    """
+    x_1, x_2, w = weighted_point_sums(x_1, x_2, sigma_2)
+    B = x_1.shape[0]
+    S_11 = torch.einsum('bn,bni,bnj->bij', w, x_1, x_1)
+    #Cross term kron(x_1, x_2), indexed 3*j + i
+    S_12 = torch.einsum('bn,bnj,bni->bji', w, x_1, x_2).reshape(B, 9)
+    I = torch.eye(3, dtype=x_1.dtype, device=x_1.device)
+    A = torch.zeros(B, 10, 10, dtype=x_1.dtype, device=x_1.device)
+    A[:, :9, :9] = torch.einsum('bij,kl->bikjl', S_11, I).reshape(B, 9, 9)
+    A[:, :9, 9] = -S_12
+    A[:, 9, :9] = -S_12
+    A[:, 9, 9] = (w*x_2.pow(2).sum(dim=2)).sum(dim=1)
+    return A
+
 #Note sigma can be scalar or an N-dimensional vector of std. devs.
 def gen_sim_data(N, sigma, torch_vars=False, shuffle_points=False):
     ##Simulation
@@ -388,122 +509,139 @@ class SyntheticData():
         self.A_prior = A_prior
 
 
-def gen_sim_data_fast(N_rotations, N_matches_per_rotation, sigma, max_rotation_angle=None, dtype=torch.double):
+def gen_sim_data_fast(N_rotations, N_matches_per_rotation, sigma, max_rotation_angle=None, dtype=torch.double, device=None, generator=None):
     ##Simulation
     #Create a random rotation
-    axis = torch.randn(N_rotations, 3, dtype=dtype)
+    axis = torch.randn(N_rotations, 3, dtype=dtype, device=device, generator=generator)
     axis = axis / axis.norm(dim=1, keepdim=True)
     if max_rotation_angle:
         max_angle = max_rotation_angle*np.pi/180.
     else:
         max_angle = np.pi
     
-    angle = max_angle*torch.rand(N_rotations, 1)
+    angle = max_angle*torch.rand(N_rotations, 1, dtype=dtype, device=device, generator=generator)
 
     C = SO3_torch.exp(angle*axis).as_matrix()
     if N_rotations == 1:
         C = C.unsqueeze(dim=0)
     #Create two sets of vectors (normalized to unit l2 norm)
-    x_1 = torch.randn(N_rotations, 3, N_matches_per_rotation, dtype=dtype)
+    x_1 = torch.randn(N_rotations, 3, N_matches_per_rotation, dtype=dtype, device=device, generator=generator)
     x_1 = x_1/x_1.norm(dim=1,keepdim=True)   
     #Rotate and add noise
-    noise = sigma*torch.randn_like(x_1)
+    noise = sigma*torch.randn(x_1.shape, dtype=dtype, device=device, generator=generator)
     x_2 = C.bmm(x_1) + noise
     
     return C, x_1, x_2
 
-def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double):
+def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double, device=None, generator=None):
     ##Simulation
     #Create a random rotation
-    C = SO3_torch.exp(torch.randn(N_rotations, 3, dtype=dtype)).as_matrix()
+    C = SO3_torch.exp(torch.randn(N_rotations, 3, dtype=dtype, device=device, generator=generator)).as_matrix()
+    if N_rotations == 1:
+        C = C.unsqueeze(dim=0)
     #Create two sets of vectors (normalized to unit l2 norm)
-    x_1 = torch.randn(3, N_rotations*N_matches_per_rotation, dtype=dtype)
-    x_1 = x_1/x_1.norm(dim=0,keepdim=True)
+    x_1 = torch.randn(N_rotations, 3, N_matches_per_rotation, dtype=dtype, device=device, generator=generator)
+    x_1 = x_1/x_1.norm(dim=1,keepdim=True)
 
-    region_masks = [(x_1[0] < 0.) & (x_1[1] < 0.), 
-                (x_1[0] >= 0.) & (x_1[1] < 0.), 
-                (x_1[0] < 0.) & (x_1[1] >= 0.), 
-                (x_1[0] >= 0.) & (x_1[1] >= 0.)]
+    #Noise is scaled by the factor of the quadrant (in x-y) of each point: 
+    #(x < 0, y < 0), (x >= 0, y < 0), (x < 0, y >= 0), (x >= 0, y >= 0)
+    regions = (x_1[:, 0] >= 0.).long() + 2*(x_1[:, 1] >= 0.).long()
+    region_factors = torch.as_tensor(factors, dtype=dtype, device=x_1.device)[regions].unsqueeze(dim=1)
+    noise = region_factors*sigma*torch.randn(x_1.shape, dtype=dtype, device=device, generator=generator)
 
-    noise = torch.zeros_like(x_1)
-    for r_i, region in enumerate(region_masks):
-        noise[:, region] = factors[r_i]*sigma*torch.randn_like(noise[:, region])
-
-    x_1 = x_1.view(3, N_rotations, N_matches_per_rotation).transpose(0,1) 
-    noise = noise.view(3, N_rotations, N_matches_per_rotation).transpose(0,1) 
-
-    
     #Rotate and add noise
     x_2 = C.bmm(x_1) + noise
     return C, x_1, x_2
 
+def synthetic_data_from_sim(C, x_1, x_2):
+    #C: N x 3 x 3, x_1, x_2: N x 3 x M -> x: N x 2 x M x 3, q: N x 4
+    x = torch.stack([x_1, x_2], dim=1).transpose(2,3)
+    q = rotmat_to_quat(C, ordering='xyzw')
+    if q.dim() < 2:
+        q = q.unsqueeze(dim=0)
+    return SyntheticData(x, q, None)
+
 def create_experimental_data_fast(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, beachball=False, max_rotation_angle=None, beachball_factors=None, device=torch.device('cpu'), dtype=torch.double):
     
+    #Generated directly on the device
     if beachball:
-        C_train, x_1_train, x_2_train = gen_sim_data_beachball(N_train, N_matches_per_sample, sigma, beachball_factors)
-        C_test, x_1_test, x_2_test = gen_sim_data_beachball(N_test, N_matches_per_sample, sigma, beachball_factors)
+        train_data = synthetic_data_from_sim(*gen_sim_data_beachball(N_train, N_matches_per_sample, sigma, beachball_factors, dtype=dtype, device=device))
+        test_data = synthetic_data_from_sim(*gen_sim_data_beachball(N_test, N_matches_per_sample, sigma, beachball_factors, dtype=dtype, device=device))
     else:
-        C_train, x_1_train, x_2_train = gen_sim_data_fast(N_train, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle)
-        C_test, x_1_test, x_2_test = gen_sim_data_fast(N_test, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle)
-
-    x_train = torch.empty(N_train, 2, N_matches_per_sample, 3, dtype=dtype, device=device)
-    x_train[:,0,:,:] = x_1_train.transpose(1,2)
-    x_train[:,1,:,:] = x_2_train.transpose(1,2)
-    
-    q_train = rotmat_to_quat(C_train, ordering='xyzw').to(dtype=dtype, device=device)
-    if q_train.dim() < 2:
-        q_train = q_train.unsqueeze(dim=0)
-
-
-    x_test = torch.empty(N_test, 2, N_matches_per_sample, 3, dtype=dtype, device=device)
-    x_test[:,0,:,:] = x_1_test.transpose(1,2)
-    x_test[:,1,:,:] = x_2_test.transpose(1,2)
-    
-    q_test = rotmat_to_quat(C_test, ordering='xyzw').to(dtype=dtype, device=device)
-    if q_test.dim() < 2:
-        q_test = q_test.unsqueeze(dim=0)
-    
-    train_data = SyntheticData(x_train, q_train, None)
-    test_data = SyntheticData(x_test, q_test, None)
+        train_data = synthetic_data_from_sim(*gen_sim_data_fast(N_train, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle, dtype=dtype, device=device))
+        test_data = synthetic_data_from_sim(*gen_sim_data_fast(N_test, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle, dtype=dtype, device=device))
     
     return train_data, test_data    
 
 
-def create_experimental_data(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, device=torch.device('cpu'), dtype=torch.double):
-
-    x_train = torch.empty(N_train, 2, N_matches_per_sample, 3, dtype=dtype)
-    q_train = torch.empty(N_train, 4, dtype=dtype)
-    A_prior_train = torch.empty(N_train, 4, 4, dtype=dtype)
+class SyntheticWahbaStream():
+    """
+    Streams synthetic Wahba minibatches (same distributions as create_experimental_data_fast), generated directly on the device. 
+    Every minibatch is drawn from its own generator, seeded from (seed, stream_id, epoch, batch index), so an epoch
+    can be replayed exactly and only one minibatch is ever held in memory.
+    """
+    def __init__(self, N, batch_size, N_matches_per_sample=100, sigma=0.01, beachball=False, max_rotation_angle=None, beachball_factors=None, seed=0, stream_id=0, device=torch.device('cpu'), dtype=torch.double):
+        self.N = N
+        self.batch_size = batch_size
+        self.N_matches_per_sample = N_matches_per_sample
+        self.sigma = sigma
+        self.beachball = beachball
+        self.max_rotation_angle = max_rotation_angle
+        self.beachball_factors = beachball_factors
+        self.seed = seed
+        self.stream_id = stream_id
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.generator = torch.Generator(device=self.device)
+
+    def __len__(self):
+        return self.N // self.batch_size
+
+    def batch_seed(self, epoch, k):
+        return int(np.random.SeedSequence([self.seed, self.stream_id, epoch, k]).generate_state(1, dtype=np.uint64)[0])
+
+    def batch(self, epoch, k):
+        self.generator.manual_seed(self.batch_seed(epoch, k))
+        if self.beachball:
+            sim = gen_sim_data_beachball(self.batch_size, self.N_matches_per_sample, self.sigma, self.beachball_factors, dtype=self.dtype, device=self.device, generator=self.generator)
+        else:
+            sim = gen_sim_data_fast(self.batch_size, self.N_matches_per_sample, self.sigma, max_rotation_angle=self.max_rotation_angle, dtype=self.dtype, device=self.device, generator=self.generator)
+        return synthetic_data_from_sim(*sim)
+
+    def epoch(self, epoch):
+        for k in range(len(self)):
+            yield self.batch(epoch, k)
+
+
+def gen_sim_data_batch(N_rotations, N_matches_per_rotation, sigma, dtype=torch.double):
+    #Batched equivalent of gen_sim_data (same rotation and point distributions)
+    C = SO3_torch.exp(torch.from_numpy(np.random.randn(N_rotations, 3))).as_matrix().view(N_rotations, 3, 3)
+    x_1 = torch.from_numpy(normalized(np.random.randn(N_rotations, N_matches_per_rotation, 3), axis=2))
+    noise = torch.from_numpy(np.random.randn(N_rotations, N_matches_per_rotation, 3)*np.reshape(sigma, (-1, 1)))
+    x_2 = x_1.bmm(C.transpose(1,2)) + noise
+    return C.to(dtype=dtype), x_1.to(dtype=dtype), x_2.to(dtype=dtype)
 
-    x_test = torch.empty(N_test, 2, N_matches_per_sample, 3, dtype=dtype)
-    q_test = torch.empty(N_test, 4, dtype=dtype)
-    A_prior_test = torch.empty(N_test, 4, 4, dtype=dtype)
+def create_experimental_data(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, device=torch.device('cpu'), dtype=torch.double):
 
     sigma_sim_vec = sigma*np.ones(N_matches_per_sample)
     #sigma_sim_vec[:int(N_matches_per_sample/2)] *= 10 #Artificially scale half the noise
     sigma_prior_vec = sigma*np.ones(N_matches_per_sample)
-    
 
-    for n in range(N_train):
-
-        C, x_1, x_2 = gen_sim_data(N_matches_per_sample, sigma_sim_vec, torch_vars=True, shuffle_points=False)
-        q = rotmat_to_quat(C, ordering='xyzw')
-        x_train[n, 0, :, :] = x_1
-        x_train[n, 1, :, :] = x_2
-        q_train[n] = q
-        A_prior_train[n] = torch.from_numpy(build_A(x_1.numpy(), x_2.numpy(), sigma_2=sigma_prior_vec**2))
-
-    for n in range(N_test):
-        C, x_1, x_2 = gen_sim_data(N_matches_per_sample, sigma_sim_vec, torch_vars=True, shuffle_points=False)
-        q = rotmat_to_quat(C, ordering='xyzw')
-        x_test[n, 0, :, :] = x_1
-        x_test[n, 1, :, :] = x_2
-        q_test[n] = q
-        A_prior_test[n] = torch.from_numpy(build_A(x_1.numpy(), x_2.numpy(), sigma_2=sigma_prior_vec**2))
-
-        # A_vec = convert_A_to_Avec(A_prior_test[n]).unsqueeze(dim=0)
-        # print(q - QuadQuatFastSolver.apply(A_vec).squeeze())
-    
+    C_train, x_1, x_2 = gen_sim_data_batch(N_train, N_matches_per_sample, sigma_sim_vec)
+    x_train = torch.stack([x_1, x_2], dim=1).to(dtype=dtype)
+
+    C_test, x_1, x_2 = gen_sim_data_batch(N_test, N_matches_per_sample, sigma_sim_vec)
+    x_test = torch.stack([x_1, x_2], dim=1).to(dtype=dtype)
+
+    #Build all A priors (and targets) at once
+    sigma_2 = torch.from_numpy(sigma_prior_vec**2)
+    q_train = rotmat_to_quat(C_train, ordering='xyzw').to(dtype=dtype).view(N_train, 4)
+    A_prior_train = build_A_batch(x_train[:, 0].double(), x_train[:, 1].double(), sigma_2).to(dtype=dtype)
+    q_test = rotmat_to_quat(C_test, ordering='xyzw').to(dtype=dtype).view(N_test, 4)
+    A_prior_test = build_A_batch(x_test[:, 0].double(), x_test[:, 1].double(), sigma_2).to(dtype=dtype)
+
+    # A_vec = convert_A_to_Avec(A_prior_test)
+    # print(q_test - QuadQuatFastSolver.apply(A_vec))
 
     x_train = x_train.to(device=device)
     q_train = q_train.to(device=device)
@@ -1,13 +1,16 @@
 import torch
 import time, argparse
+import threading, queue
 from datetime import datetime
 import numpy as np
 from tensorboardX import SummaryWriter
 from quaternions import *
+from utils import MetricsAccumulator
 import tqdm
 
 #Generic training function
-def train(model, loss_fn, optimizer, x, q_gt):
+#detach_loss=True returns the loss as a device tensor instead of syncing with loss.item()
+def train(model, loss_fn, optimizer, x, q_gt, detach_loss=False):
 
     # Reset gradient
     optimizer.zero_grad()
@@ -22,19 +25,131 @@ def train(model, loss_fn, optimizer, x, q_gt):
     # Update parameters
     optimizer.step()
 
-    return (q_est, loss.item())
+    return (q_est, loss.detach() if detach_loss else loss.item())
 
 
-def test(model, loss_fn, x, q_gt):
+def test(model, loss_fn, x, q_gt, detach_loss=False):
     # Forward
     with torch.no_grad():
         q_est = model.forward(x)
         loss = loss_fn(q_est, q_gt)
             
-    return (q_est, loss.item())
+    return (q_est, loss.detach() if detach_loss else loss.item())
 
 
-def train_test_model(args, loss_fn, model, train_loader, test_loader, tensorboard_output=True, progress_bar=True, scheduler=False):
+#Datasets in ids-only mode (e.g., PointNetDataset) synthesize the batch on the device
+def unpack_batch(loader, batch, device):
+    if getattr(loader.dataset, 'ids_only', False):
+        return loader.dataset.synthesize_batch(batch, device)
+    return batch
+
+
+class PrefetchLoader():
+    """Drop-in wrapper around a DataLoader that moves each batch to the device (and dtype) ahead of the training step.
+
+    On CUDA, the next batch is copied from pinned memory with non-blocking transfers on a side stream 
+    while the current step runs. On the CPU, a background thread collates and converts up to num_prefetch batches ahead.
+    Ids-only batches (see unpack_batch) are passed through untouched.
+    """
+    def __init__(self, loader, device, dtype=torch.float, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.num_prefetch = num_prefetch
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch, non_blocking=False):
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self.to_device(b, non_blocking) for b in batch)
+        if not torch.is_tensor(batch):
+            return batch
+        if non_blocking and batch.device.type == 'cpu' and not batch.is_pinned():
+            batch = batch.pin_memory()
+        dtype = self.dtype if batch.is_floating_point() else batch.dtype
+        return batch.to(device=self.device, dtype=dtype, non_blocking=non_blocking)
+
+    def record_stream(self, batch, stream):
+        if isinstance(batch, (list, tuple)):
+            for b in batch:
+                self.record_stream(b, stream)
+        elif torch.is_tensor(batch) and batch.is_cuda:
+            batch.record_stream(stream)
+
+    def __iter__(self):
+        if getattr(self.dataset, 'ids_only', False):
+            return iter(self.loader)
+        if self.device.type == 'cuda':
+            return self.iter_cuda()
+        return self.iter_threaded()
+
+    def iter_cuda(self):
+        copy_stream = torch.cuda.Stream(device=self.device)
+        pending = None
+        for batch in self.loader:
+            #Issue the copy of this batch before handing out the previous one
+            with torch.cuda.stream(copy_stream):
+                batch = self.to_device(batch, non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record(copy_stream)
+            if pending is not None:
+                yield self.wait_for(*pending)
+            pending = (batch, copied)
+        if pending is not None:
+            yield self.wait_for(*pending)
+
+    def wait_for(self, batch, copied):
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(copied)
+        #The batch was allocated on the copy stream but is used on the compute stream
+        self.record_stream(batch, compute_stream)
+        return batch
+
+    def iter_threaded(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(self.to_device(batch)):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            #Also reached when the consumer stops early
+            stop.set()
+            worker.join()
+
+
+def train_test_model(args, loss_fn, model, train_loader, test_loader, tensorboard_output=True, progress_bar=True, scheduler=False, sync_every=None, epoch_callback=None):
 
     if tensorboard_output:
         writer = SummaryWriter()
@@ -57,49 +172,57 @@ def train_test_model(args, loss_fn, model, train_loader, test_loader, tensorboar
 
         #Train model
         model.train()
-        train_loss = torch.tensor(0.)
-        train_mean_err = torch.tensor(0.)
+        #Metrics are summed on the device and only copied to the host at the end of the epoch (or every sync_every steps)
+        train_metrics = MetricsAccumulator(['loss', 'mean_err'], device=device)
         num_train_batches = len(train_loader)
 
         if progress_bar:
             pbar = tqdm.tqdm(total=num_train_batches)
 
-        for _, (x, target) in enumerate(train_loader):
+        for k, batch in enumerate(train_loader):
+            x, target = unpack_batch(train_loader, batch, device)
             #Move all data to appropriate device
             target = target.to(device=device, dtype=tensor_type)
             x = x.to(device=device, dtype=tensor_type)
-            (rot_est, train_loss_k) = train(model, loss_fn, optimizer, x, target)
+            (rot_est, train_loss_k) = train(model, loss_fn, optimizer, x, target, detach_loss=True)
 
             if rotmat_targets:
-                train_mean_err += (1./num_train_batches)*rotmat_angle_diff(rot_est, target)
+                train_err_k = rotmat_angle_diff(rot_est.detach(), target)
             else:
-                train_mean_err += (1./num_train_batches)*quat_angle_diff(rot_est, target)
+                train_err_k = quat_angle_diff(rot_est.detach(), target)
 
-            train_loss += (1./num_train_batches)*train_loss_k
+            train_metrics.add(loss=train_loss_k, mean_err=train_err_k)
             if progress_bar:
+                if sync_every and (k + 1) % sync_every == 0:
+                    pbar.set_postfix(train_metrics.means())
                 pbar.update(1)
         
         if progress_bar:
             pbar.close()
 
+        train_means = train_metrics.means()
+        train_loss, train_mean_err = train_means['loss'], train_means['mean_err']
+
         #Test model
         model.eval()
-        num_test_batches = len(test_loader)
-        test_loss = torch.tensor(0.)
-        test_mean_err = torch.tensor(0.)
+        test_metrics = MetricsAccumulator(['loss', 'mean_err'], device=device)
 
-        for _, (x, target) in enumerate(test_loader):
+        for _, batch in enumerate(test_loader):
+            x, target = unpack_batch(test_loader, batch, device)
             #Move all data to appropriate device
             target = target.to(device=device, dtype=tensor_type)
             x = x.to(device=device, dtype=tensor_type)
-            (rot_est, test_loss_k) = test(model, loss_fn, x, target)
+            (rot_est, test_loss_k) = test(model, loss_fn, x, target, detach_loss=True)
 
             if rotmat_targets:
-                test_mean_err += (1./num_test_batches)*rotmat_angle_diff(rot_est, target)
+                test_err_k = rotmat_angle_diff(rot_est, target)
             else:
-                test_mean_err += (1./num_test_batches)*quat_angle_diff(rot_est, target)
+                test_err_k = quat_angle_diff(rot_est, target)
+
+            test_metrics.add(loss=test_loss_k, mean_err=test_err_k)
 
-            test_loss += (1./num_test_batches)*test_loss_k
+        test_means = test_metrics.means()
+        test_loss, test_mean_err = test_means['loss'], test_means['mean_err']
 
         test_stats[e, 0] = test_loss
         test_stats[e, 1] = test_mean_err
@@ -120,9 +243,85 @@ def train_test_model(args, loss_fn, model, train_loader, test_loader, tensorboar
         
         output_string = 'Epoch: {}/{}. Train: Loss {:.3E} / Error {:.3f} (deg) | Test: Loss {:.3E} / Error {:.3f} (deg). Epoch time: {:.3f} sec.'.format(e+1, args.epochs, train_loss, train_mean_err, test_loss, test_mean_err, elapsed_time)
         print(output_string)
+        if epoch_callback is not None:
+            epoch_callback(e)
         if scheduler:
             scheduler.step()
 
     if tensorboard_output:
         writer.close()
-    return train_stats, test_stats
\ No newline at end of file
+    return train_stats, test_stats
+
+def train_test_models(args, loss_fns, models, train_loader, test_loader, rotmat_targets, progress_bar=True, scheduler=False):
+    """Lockstep version of train_test_model: every model (with its own loss_fn, optimizer and target type) 
+    is stepped on the same minibatch, so each batch is loaded once for all of them.
+    The loaders yield quaternion targets; rotation matrix targets are built from them for the models that need them.
+    Returns lists of per-model train and test stats (each args.epochs x 2, as in train_test_model).
+    """
+    optimizers = [torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr) for model in models]
+    schedulers = [torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[10,20], gamma=0.2) for optimizer in optimizers] if scheduler else []
+
+    #Save stats
+    train_stats = [torch.zeros(args.epochs, 2) for _ in models]
+    test_stats = [torch.zeros(args.epochs, 2) for _ in models]
+
+    device = next(models[0].parameters()).device
+    tensor_type = torch.double if args.double else torch.float
+
+    train_loader.dataset.rotmat_targets = False
+    test_loader.dataset.rotmat_targets = False
+
+    def run_epoch(loader, metrics, train_mode):
+        for model in models:
+            model.train(train_mode)
+        if progress_bar and train_mode:
+            pbar = tqdm.tqdm(total=len(loader))
+        for _, batch in enumerate(loader):
+            x, q_target = unpack_batch(loader, batch, device)
+            #Move all data to appropriate device
+            x = x.to(device=device, dtype=tensor_type)
+            targets = {False: q_target.to(device=device, dtype=tensor_type)}
+            if any(rotmat_targets):
+                targets[True] = quat_to_rotmat(targets[False])
+
+            for m_i, (model, loss_fn, rotmat_target) in enumerate(zip(models, loss_fns, rotmat_targets)):
+                target = targets[rotmat_target]
+                if train_mode:
+                    (rot_est, loss_k) = train(model, loss_fn, optimizers[m_i], x, target, detach_loss=True)
+                    rot_est = rot_est.detach()
+                else:
+                    (rot_est, loss_k) = test(model, loss_fn, x, target, detach_loss=True)
+
+                if rotmat_target:
+                    err_k = rotmat_angle_diff(rot_est, target)
+                else:
+                    err_k = quat_angle_diff(rot_est, target)
+                metrics[m_i].add(loss=loss_k, mean_err=err_k)
+            if progress_bar and train_mode:
+                pbar.update(1)
+        if progress_bar and train_mode:
+            pbar.close()
+
+    for e in range(args.epochs):
+        start_time = time.time()
+
+        train_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+        run_epoch(train_loader, train_metrics, train_mode=True)
+
+        test_metrics = [MetricsAccumulator(['loss', 'mean_err'], device=device) for _ in models]
+        run_epoch(test_loader, test_metrics, train_mode=False)
+
+        elapsed_time = time.time() - start_time
+
+        for m_i in range(len(models)):
+            train_means = train_metrics[m_i].means()
+            test_means = test_metrics[m_i].means()
+            train_stats[m_i][e] = torch.tensor([train_means['loss'], train_means['mean_err']])
+            test_stats[m_i][e] = torch.tensor([test_means['loss'], test_means['mean_err']])
+            output_string = 'Epoch: {}/{}. Model {}. Train: Loss {:.3E} / Error {:.3f} (deg) | Test: Loss {:.3E} / Error {:.3f} (deg). Epoch time: {:.3f} sec.'.format(e+1, args.epochs, m_i, train_means['loss'], train_means['mean_err'], test_means['loss'], test_means['mean_err'], elapsed_time)
+            print(output_string)
+
+        for s in schedulers:
+            s.step()
+
+    return train_stats, test_stats
@@ -8,10 +8,10 @@ from sdp_layers import RotMatSDPSolver
 
 
 class RotMatSDPNet(torch.nn.Module):
-    def __init__(self, dim_rep=55, enforce_psd=True, unit_frob_norm=True, batchnorm=True):
+    def __init__(self, dim_rep=55, enforce_psd=True, unit_frob_norm=True, batchnorm=True, sdp_jobs=None):
         super(RotMatSDPNet, self).__init__()        
         self.net = PointNet(dim_out=dim_rep, normalize_output=False, batchnorm=batchnorm)
-        self.rotation_layer = RotMatSDPSolver()
+        self.rotation_layer = RotMatSDPSolver(n_jobs=sdp_jobs)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
 
@@ -5,89 +5,9 @@ import cvxpy as cp
 import time
 import torch
 # from rotation_matrix_sdp import solve_equality_QCQP_dual, rotation_matrix_constraints
+from qcqp_layers import HomogeneousRotationQCQPFastSolver, compute_rotation_QCQP_grad_fast, solve_rotation_qcqp_fast
 
 
-def solve_rotation_qcqp(A, constraint_matrices, constraint_vec):
-    r_out = A.new_zeros((A.shape[0], 10))
-    nu_out = A.new_zeros((A.shape[0], 22))
-    for idx in range(A.shape[0]):
-        nu, R = solve_equality_QCQP_dual(A[idx, :, :], constraint_matrices, constraint_vec, is_torch=True)
-        r_out[idx, :] = torch.from_numpy(np.append(np.reshape(R, (9,), order='F'), 1.))
-        nu_out[idx, :] = torch.from_numpy(nu)
-    return r_out, nu_out
-
-
-class HomogeneousRotationQCQPFastSolver(torch.autograd.Function):
-    """
-    
-    """
-    @staticmethod
-    def forward(ctx, A_vec):
-        if A_vec.dim() < 2:
-            A_vec = A_vec.unsqueeze()
-        A = convert_Avec_to_A(A_vec)
-        r, nu = solve_rotation_qcqp(A, CONSTRAINT_MATRICES, C_VEC)
-        ctx.save_for_backward(A, r, nu)
-        return r
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        A, r, nu = ctx.saved_tensors
-        grad_qcqp = compute_rotation_QCQP_grad_fast(A, CONSTRAINT_MATRICES, nu, r)
-        outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
-        return outgrad
-
-def compute_rotation_QCQP_grad_fast(A, E, nu, x):
-    """
-    Input: A: (B,10,10) tensor (parametrices B symmetric 4x4 matrices)
-           E: (22,10,10) tensor (quadratic symmetric equality constraint matrices)
-           nu: (B,22) tensor (optimal lagrange multipliers)
-           x: (B,10) tensor (optimal vectorized rotation matrices with homogenizing 10th entry of 1)
-
-    Output: grad: (B, 10, 55) tensor (gradient)
-
-    Applies the implicit function theorem to compute gradients of the solution to an equality-constrained
-    homogeneous rotation matrix QCQP.
-    """
-    assert(A.dim() > 2)
-    assert(E.dim() > 2)
-    assert(nu.dim() > 1)
-    assert(x.dim() > 1)
-
-    # Remove redundant/SO(3) constraints
-    num_constraints = 7
-    M = A.new_zeros((A.shape[0], 10 + num_constraints, 10 + num_constraints))
-
-    # TODO: are all 22 E's needed, or just the 7 of interest? Should be all 22 for KKT definitino
-    M[:, :10, :10] = A + torch.einsum('bi,imn->bmn', nu, E)
-    B = torch.einsum('mij,bj->bim', E[:num_constraints, :, :], x)
-    M[:, :10, 10:] = B
-    M[:, 10:, :10] = B.transpose(1, 2)
-
-    # Eig check
-    eigs, _ = torch.symeig(M)
-
-    b = A.new_zeros((A.shape[0], 10+num_constraints, 55))
-    # symmetric matrix indices
-    idx = torch.triu_indices(10, 10)
-
-    i = torch.arange(55)
-    I_ij = A.new_zeros((55, 10, 10))
-
-    I_ij[i, idx[0], idx[1]] = 1.
-    I_ij[i, idx[1], idx[0]] = 1.
-
-    I_ij = I_ij.expand(A.shape[0], 55, 10, 10)
-
-    b[:, :10, :] = torch.einsum('bkij,bi->bjk', I_ij, x)
-
-    # This solves all gradients simultaneously!
-    X, _ = torch.solve(b, M)
-
-    grad = -1 * X[:, :10, :]
-
-    return grad
-
 def compute_grad_fast(A, nu, q):
     """
     Input: A_vec: (B,4,4) tensor (parametrices B symmetric 4x4 matrices)
@@ -270,16 +190,6 @@ def q_from_qqT(qqT):
     return q
 
 
-def solve_rotation_qcqp(A, constraint_matrices, constraint_vec):
-    r_out = A.new_zeros((A.shape[0], 10))
-    nu_out = A.new_zeros((A.shape[0], 22))
-    for idx in range(A.shape[0]):
-        nu, R = solve_equality_QCQP_dual(A[idx, :, :], constraint_matrices, constraint_vec, is_torch=True)
-        r_out[idx, :] = torch.from_numpy(np.append(np.reshape(R, (9,), order='F'), 1))
-        nu_out[idx, :] = torch.from_numpy(nu)
-    return r_out, nu_out
-
-
 def compute_rotation_QCQP_grad(A, E, nu, x):
     """
     Input: A_vec: (B,10,10) tensor (parametrices B symmetric 4x4 matrices)
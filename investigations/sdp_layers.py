@@ -1,100 +1,11 @@
 import cvxpy as cp
 import torch
-from cvxpylayers.torch import CvxpyLayer
 from rotation_matrix_sdp import rotation_matrix_constraints
 from qcqp_layers import *
 import time
 from utils import allclose
 from quaternions import *
 
-def x_from_xxT(xxT):
-    """
-    Input: BxNxN symmetric rank 1 tensor 
-    Output: BxN tensor x s.t. xxT = x*x.T (outer product), assumes last element must be positive to resolve sign ambiguities
-    """
-
-    if xxT.dim() < 3:
-        xxT = xxT.unsqueeze(dim=0)
-    assert(xxT.shape[1] == xxT.shape[2])
-    N = xxT.shape[1]
-    x = torch.sqrt(torch.abs(xxT[:, torch.arange(N), torch.arange(N)]))
-    signs = torch.sign(xxT[:, :, -1])
-    x = x * signs
-    return x.squeeze()
-
-def kronecker(A, B):
-
-    assert(A.dim() == B.dim())
-    assert(A.dim() > 1)
-    if A.dim() < 3:
-        A = A.unsqueeze(dim=0)
-        B = B.unsqueeze(dim=0)
-    assert(A.shape[0] == B.shape[0])
-
-    return torch.einsum("nab,ncd->nacbd", A, B).view(A.shape[0], A.shape[1]*B.shape[1],  A.shape[2]*B.shape[2]).squeeze()
-
-def A_from_16_vec(vec):
-    if vec.dim() < 2:
-        vec = vec.unsqueeze(dim=0)
-    assert(vec.shape[1] == 16)
-
-    idx = torch.triu_indices(3,3)
-    A = vec.new_zeros((vec.shape[0], 10, 10))
-
-    M = vec.new_zeros((vec.shape[0], 3, 3))
-    M[:, idx[0], idx[1]] = vec[:, :6]
-    M[:, idx[1], idx[0]] = vec[:, :6]
-    
-    I = vec.new_zeros((vec.shape[0], 3, 3))
-    I[:, torch.arange(3), torch.arange(3)] = 1. 
-
-    A[:, :9, :9] = kronecker(M, I)
-    A[:, :9, 9] = vec[:, 6:-1]
-    A[:, 9, :9] = vec[:, 6:-1]
-    A[:, 9, 9] = vec[:, -1]
-    return A
-    
-
-
-    
-
-
-
-class RotMatSDPSolver(torch.nn.Module):
-    def __init__(self):
-        super(RotMatSDPSolver, self).__init__()
-        
-        self.X = cp.Variable((10, 10), PSD=True)
-        self.constraint_matrices, self.c_vec = rotation_matrix_constraints()
-        self.constraints = [cp.trace(self.constraint_matrices[idx, :, :] @ self.X) == self.c_vec[idx]
-                    for idx in range(self.constraint_matrices.shape[0])]
-        self.A = cp.Parameter((10, 10), symmetric=True)
-        self.prob = cp.Problem(cp.Minimize(cp.trace(self.A @ self.X)), self.constraints)
-
-    def forward(self, A_vec):
-        
-        if A_vec.dim() < 2:
-            A_vec = A_vec.unsqueeze(dim=0)
-
-        if A_vec.shape[1] == 16:
-            A = A_from_16_vec(A_vec)
-        else:
-            A = convert_Avec_to_A(A_vec)
-        
-        sdp_solver = CvxpyLayer(self.prob, parameters=[self.A], variables=[self.X])
-        X, = sdp_solver(A)
-        del(sdp_solver)
-        x = x_from_xxT(X)
-
-
-        if x.dim() < 2:
-            x = x.unsqueeze(dim=0)
-
-        r_vec = x[:, :9]
-        rotmat = r_vec.view(-1, 3,3).transpose(1,2)
-        return rotmat.squeeze()
-
-
 def test_16_vec():
     num_samples = 1000
     A_vec = torch.randn((num_samples, 16), dtype=torch.double, requires_grad=True)
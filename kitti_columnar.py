@@ -0,0 +1,40 @@
+import numpy as np
+import os
+import json
+import pickle
+
+#Columnar KITTI pose data, kept free of torch/cv2 so the data creation scripts can import it
+
+
+KITTI_COLUMNS = ['seqs', 'pose_indices', 'T_21_gt', 'T_21_vo']
+
+def save_kitti_columnar(kitti_data, out_dir):
+    """Writes a KITTI dataset dict (as produced by create_kitti_training_data_single_memory.py) in columnar form:
+    per split, {split}_T_21_gt.npy / {split}_T_21_vo.npy (N x 4 x 4), {split}_pose_indices.npy (N x 2), 
+    {split}_seqs.npy (N) and the pose deltas in meta.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for split in ['train', 'test']:
+        np.save(os.path.join(out_dir, '{}_seqs.npy'.format(split)), np.array(kitti_data[split + '_seqs'], dtype=str).reshape(-1))
+        np.save(os.path.join(out_dir, '{}_pose_indices.npy'.format(split)), np.array(kitti_data[split + '_pose_indices'], dtype=np.int64).reshape(-1, 2))
+        np.save(os.path.join(out_dir, '{}_T_21_gt.npy'.format(split)), np.array(kitti_data[split + '_T_21_gt'], dtype=np.float64).reshape(-1, 4, 4))
+        np.save(os.path.join(out_dir, '{}_T_21_vo.npy'.format(split)), np.array(kitti_data[split + '_T_21_vo'], dtype=np.float64).reshape(-1, 4, 4))
+    meta = {'train_pose_deltas': list(kitti_data['train_pose_deltas']), 'test_pose_delta': kitti_data['test_pose_delta']}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return out_dir
+
+def load_kitti_columnar(data_dir, split):
+    #Copy-on-write memory maps: nothing is read until indexed
+    data = {col: np.load(os.path.join(data_dir, '{}_{}.npy'.format(split, col)), mmap_mode='c') for col in KITTI_COLUMNS}
+    with open(os.path.join(data_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    data['pose_deltas'] = meta['train_pose_deltas']
+    data['pose_delta'] = meta['test_pose_delta']
+    return data
+
+def convert_kitti_pickle_to_columnar(kitti_dataset_file, out_dir=None):
+    out_dir = out_dir if out_dir is not None else os.path.splitext(kitti_dataset_file)[0]
+    with open(kitti_dataset_file, 'rb') as handle:
+        kitti_data = pickle.load(handle)
+    return save_kitti_columnar(kitti_data, out_dir)
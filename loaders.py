@@ -11,6 +11,8 @@ from liegroups.torch import SO3
 import pickle
 import cv2
 import torch.utils.data as tud
+from collections import OrderedDict
+from kitti_columnar import load_kitti_columnar
 
 
 class KITTIVODatasetPreTransformed(Dataset):
@@ -19,10 +21,14 @@ class KITTIVODatasetPreTransformed(Dataset):
     def __init__(self, kitti_dataset_file, seqs_base_path, output_sample_images=0, 
     transform_img=None, transform_second_half_only=False, run_type='train', 
     use_flow=True, apply_blur=False, reverse_images=False, seq_prefix='seq_', 
-    use_only_seq=None, rotmat_targets=False):
+    use_only_seq=None, rotmat_targets=False, use_memmap=False, flow_cache_dir=None):
 
         self.kitti_dataset_file = kitti_dataset_file
         self.seqs_base_path = seqs_base_path
+        #Read frames from the uint8 .npy store written by convert_kitti_seq_to_memmap
+        self.use_memmap = use_memmap
+        #Precomputed optical flow (see precompute_kitti_flow); misses are computed and filled in
+        self.flow_cache = KITTIFlowCache(flow_cache_dir, seq_prefix) if flow_cache_dir is not None else None
         self.apply_blur = apply_blur
         self.transform_img = transform_img
         self.transform_second_half_only = transform_second_half_only
@@ -43,6 +49,9 @@ class KITTIVODatasetPreTransformed(Dataset):
             self.output_image_idx = []
 
     def load_kitti_data(self, run_type, use_only_seq):
+        if os.path.isdir(self.kitti_dataset_file):
+            return self.load_kitti_data_columnar(run_type, use_only_seq)
+
         with open(self.kitti_dataset_file, 'rb') as handle:
             kitti_data = pickle.load(handle)
 
@@ -73,16 +82,59 @@ class KITTIVODatasetPreTransformed(Dataset):
             self.seqs = [self.seqs[i] for i in range(len(self.seqs))
                                  if self.seqs[i] == use_only_seq]
 
+        self.load_seq_images()
+
+    def load_seq_images(self):
         print('Loading sequences...{}'.format(list(set(self.seqs))))
         print('Pose delta: {}'.format(self.pose_indices[0][1] - self.pose_indices[0][0]))
-        self.seq_images = {seq: self.import_seq(seq) for seq in list(set(self.seqs))}
-        print('...done loading images into memory.')
+        if self.use_memmap:
+            #Opened lazily so that every DataLoader worker maps the files itself
+            self.seq_images = {seq: None for seq in list(set(self.seqs))}
+            print('...using memory-mapped images.')
+        else:
+            self.seq_images = {seq: self.import_seq(seq) for seq in list(set(self.seqs))}
+            print('...done loading images into memory.')
+
+    def load_kitti_data_columnar(self, run_type, use_only_seq):
+        #Columnar dataset directory (see save_kitti_columnar): arrays are memory-mapped, filters are masks
+        if run_type not in ['train', 'test']:
+            raise ValueError('run_type must be set to `train`, or `test`. ')
+        kitti_data = load_kitti_columnar(self.kitti_dataset_file, run_type)
+        self.seqs = kitti_data['seqs']
+        self.pose_indices = kitti_data['pose_indices']
+        self.T_21_gt = kitti_data['T_21_gt']
+        self.T_21_vo = kitti_data['T_21_vo']
+        if run_type == 'train':
+            self.pose_deltas = kitti_data['pose_deltas']
+        else:
+            self.pose_delta = kitti_data['pose_delta']
+
+        if use_only_seq is not None:
+            mask = self.seqs == use_only_seq
+            self.seqs = self.seqs[mask]
+            self.pose_indices = self.pose_indices[mask]
+            self.T_21_gt = self.T_21_gt[mask]
+            self.T_21_vo = self.T_21_vo[mask]
+
+        self.load_seq_images()
 
     def import_seq(self, seq):
         file_path = self.seqs_base_path + '/' + self.seq_prefix + '{}.pt'.format(seq)
         data = torch.load(file_path)
         return data['im_l']
 
+    def import_seq_memmap(self, seq):
+        file_path = kitti_memmap_path(self.seqs_base_path, seq, self.seq_prefix)
+        #Copy-on-write mapping: pages are shared between workers and torch gets a writable array
+        return np.load(file_path, mmap_mode='c')
+
+    def get_image(self, seq, p_id):
+        if self.use_memmap:
+            if self.seq_images[seq] is None:
+                self.seq_images[seq] = self.import_seq_memmap(seq)
+            return torch.from_numpy(self.seq_images[seq][p_id])
+        return self.seq_images[seq][p_id]
+
     def __len__(self):
         return len(self.T_21_gt)
 
@@ -103,6 +155,26 @@ class KITTIVODatasetPreTransformed(Dataset):
 
         return flow_img
 
+    def get_flow(self, seq, p_ids, idx):
+        if self.flow_cache is not None:
+            flow_img = self.flow_cache.get(seq, p_ids[0], p_ids[1], self.apply_blur)
+            if flow_img is not None:
+                return flow_img
+
+        flow_img = self.compute_flow(self.get_image(seq, p_ids[0]), self.get_image(seq, p_ids[1]), idx, self.apply_blur)
+        if self.flow_cache is not None:
+            self.flow_cache.put(seq, p_ids[0], p_ids[1], self.apply_blur, flow_img)
+        return flow_img
+
+    def flow_pairs(self):
+        #All (seq, id1, id2) image pairs that __getitem__ computes flow for
+        pairs = {}
+        for seq, p_ids in zip(self.seqs, self.pose_indices):
+            if self.reverse_images:
+                p_ids = [p_ids[1], p_ids[0]]
+            pairs.setdefault(seq, set()).add((int(p_ids[0]), int(p_ids[1])))
+        return {seq: sorted(seq_pairs) for seq, seq_pairs in pairs.items()}
+
 
     def __getitem__(self, idx):
         seq = self.seqs[idx]
@@ -114,7 +186,7 @@ class KITTIVODatasetPreTransformed(Dataset):
             C_21_gt = self.T_21_gt[idx][:3,:3].transpose(0,1)
 
         if self.use_flow:
-            img_input = self.compute_flow(self.seq_images[seq][p_ids[0]], self.seq_images[seq][p_ids[1]], idx, self.apply_blur)
+            img_input = self.get_flow(seq, p_ids, idx)
         else:
             #Should we transform?
             transform_img_flag = False
@@ -125,12 +197,12 @@ class KITTIVODatasetPreTransformed(Dataset):
                 else:
                     transform_img_flag = True
 
+            img_1 = self.prep_img(self.get_image(seq, p_ids[0]))
+            img_2 = self.prep_img(self.get_image(seq, p_ids[1]))
             if transform_img_flag:
-                img_input = torch.cat([self.transform_img(self.prep_img(self.seq_images[seq][p_ids[0]])),
-                            self.transform_img(self.prep_img(self.seq_images[seq][p_ids[1]]))], dim=0)
+                img_input = torch.cat([self.transform_img(img_1), self.transform_img(img_2)], dim=0)
             else:
-                img_input = torch.cat([self.prep_img(self.seq_images[seq][p_ids[0]]),
-                            self.prep_img(self.seq_images[seq][p_ids[1]])], dim=0)
+                img_input = torch.cat([img_1, img_2], dim=0)
 
         if idx in self.output_image_idx:
             file_name = 'img_{0}.png'.format(idx)
@@ -143,11 +215,313 @@ class KITTIVODatasetPreTransformed(Dataset):
             return img_input, rotmat_to_quat(torch.from_numpy(C_21_gt).float())
 
 
+class KITTIVODatasetStreaming(KITTIVODatasetPreTransformed, tud.IterableDataset):
+    """Streaming (IterableDataset) version of KITTIVODatasetPreTransformed.
+
+    Reads the memory-mapped image store (see convert_kitti_seq_to_memmap) one chunk of consecutive frames 
+    at a time, so only the frames of the chunks in flight are resident. Every pair is assigned to the chunk 
+    of its first frame (and the chunk is extended to cover its second frame). Each epoch the chunks are 
+    shuffled with a seed shared by all DataLoader workers and dealt round-robin to the workers; items are 
+    shuffled within a bounded buffer of shuffle_buffer items.
+    """
+
+    def __init__(self, kitti_dataset_file, seqs_base_path, chunk_size=512, shuffle_buffer=1024, seed=None, **kwargs):
+        kwargs['use_memmap'] = True
+        super(KITTIVODatasetStreaming, self).__init__(kitti_dataset_file, seqs_base_path, **kwargs)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.chunk = None
+
+        #Group pairs into chunks by (seq, first frame // chunk_size)
+        chunks = {}
+        for idx, (seq, p_ids) in enumerate(zip(self.seqs, self.pose_indices)):
+            chunks.setdefault((seq, min(p_ids) // chunk_size), []).append(idx)
+        self.chunks = []
+        for key in sorted(chunks.keys()):
+            ids = chunks[key]
+            frames = [p_id for idx in ids for p_id in self.pose_indices[idx]]
+            self.chunks.append((key[0], min(frames), max(frames) + 1, ids))
+
+    def set_epoch(self, epoch):
+        #Only needed with a fixed seed, to get a different shuffle every epoch
+        self.epoch = epoch
+
+    def get_image(self, seq, p_id):
+        if self.chunk is not None:
+            chunk_seq, start, frames = self.chunk
+            if seq == chunk_seq and start <= p_id < start + frames.shape[0]:
+                return frames[p_id - start]
+        return super(KITTIVODatasetStreaming, self).get_image(seq, p_id)
+
+    def load_chunk(self, seq, start, end):
+        if self.seq_images[seq] is None:
+            self.seq_images[seq] = self.import_seq_memmap(seq)
+        #One sequential read of the whole chunk
+        self.chunk = (seq, start, torch.from_numpy(np.array(self.seq_images[seq][start:end])))
+
+    def __iter__(self):
+        worker_info = tud.get_worker_info()
+        if self.seed is not None:
+            shared_seed = self.seed + self.epoch
+        elif worker_info is not None:
+            #The base seed is drawn once per epoch by the main process and is shared by all workers
+            shared_seed = worker_info.seed - worker_info.id
+        else:
+            shared_seed = torch.randint(2**31, (1,)).item()
+        if worker_info is None:
+            self.epoch += 1
+
+        rng = np.random.default_rng(shared_seed % 2**32)
+        chunk_order = rng.permutation(len(self.chunks))
+        if worker_info is not None:
+            chunk_order = chunk_order[worker_info.id::worker_info.num_workers]
+            rng = np.random.default_rng((shared_seed + worker_info.id + 1) % 2**32)
+
+        buffer = []
+        for c_i in chunk_order:
+            seq, start, end, ids = self.chunks[c_i]
+            self.load_chunk(seq, start, end)
+            for idx in rng.permutation(ids):
+                buffer.append(self[int(idx)])
+                if len(buffer) >= self.shuffle_buffer:
+                    b_i = rng.integers(len(buffer))
+                    buffer[b_i], buffer[-1] = buffer[-1], buffer[b_i]
+                    yield buffer.pop()
+        self.chunk = None
+        for b_i in rng.permutation(len(buffer)):
+            yield buffer[b_i]
+
+
+def kitti_memmap_path(seqs_base_path, seq, seq_prefix='seq_'):
+    return seqs_base_path + '/' + seq_prefix + '{}_im_l.npy'.format(seq)
+
+def convert_kitti_seq_to_memmap(seqs_base_path, seq, seq_prefix='seq_'):
+    """One-time conversion of a seq_XX.pt file into a raw uint8 .npy store (N x C x H x W).
+    The .npy header holds the shape and dtype, so the file can be memory-mapped with np.load(mmap_mode=...).
+    """
+    file_path = seqs_base_path + '/' + seq_prefix + '{}.pt'.format(seq)
+    im_l = torch.load(file_path)['im_l']
+    out_path = kitti_memmap_path(seqs_base_path, seq, seq_prefix)
+    im_l = im_l.numpy()
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=im_l.dtype, shape=im_l.shape)
+    out[:] = im_l
+    out.flush()
+    del out
+    return out_path
+
+
+class KITTIFlowCache():
+    """Float16 memory-mapped optical flow store keyed by (seq, id1, id2, blur).
+
+    Each (seq, blur) store is three .npy files in cache_dir: the flow images (K x 2 x H x W, float16), 
+    the (id1, id2) pair of every row (K x 2) and a per-row valid flag (K). Rows are allocated up front by 
+    allocate(); get() returns None for pairs that are unallocated or not yet filled. put() fills allocated rows
+    only: the first miss of a (seq, blur) store is reported once.
+    """
+    def __init__(self, cache_dir, seq_prefix='seq_'):
+        self.cache_dir = cache_dir
+        self.seq_prefix = seq_prefix
+        self.stores = {} #Opened lazily (per DataLoader worker)
+        self.warned = set() #(seq, blur) stores already reported as missing or incomplete
+
+    def store_path(self, seq, blur, name):
+        return os.path.join(self.cache_dir, self.seq_prefix + '{}_flow_blur_{}_{}.npy'.format(seq, int(blur), name))
+
+    def allocate(self, seq, blur, pairs, flow_shape):
+        """Allocates rows for pairs. Pairs already in the store are kept, along with their filled rows:
+        the new store is written under temporary names and only then replaces the old one.
+        Returns the pairs of the new store.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        pairs = [(int(id1), int(id2)) for id1, id2 in pairs]
+        old = self.open_store(seq, blur)
+        if old is not None:
+            pairs = sorted(set(pairs) | set(old[2].keys()))
+            if old[0].shape[1:] != tuple(flow_shape):
+                #Stored flow has a different image size and cannot be reused
+                old = None
+
+        flow = np.lib.format.open_memmap(self.store_path(seq, blur, 'flow') + '.tmp', mode='w+', dtype=np.float16, shape=(len(pairs),) + tuple(flow_shape))
+        valid = np.zeros(len(pairs), dtype=np.uint8)
+        if old is not None:
+            for row, pair in enumerate(pairs):
+                old_row = old[2].get(pair)
+                if old_row is not None and old[1][old_row]:
+                    flow[row] = old[0][old_row]
+                    valid[row] = 1
+        flow.flush()
+        del flow, old
+        with open(self.store_path(seq, blur, 'pairs') + '.tmp', 'wb') as f:
+            np.save(f, np.array(pairs, dtype=np.int64).reshape(-1, 2))
+        with open(self.store_path(seq, blur, 'valid') + '.tmp', 'wb') as f:
+            np.save(f, valid)
+
+        self.stores.pop((seq, int(blur)), None)
+        for name in ['flow', 'pairs', 'valid']:
+            os.replace(self.store_path(seq, blur, name) + '.tmp', self.store_path(seq, blur, name))
+        return pairs
+
+    def open_store(self, seq, blur):
+        key = (seq, int(blur))
+        if key not in self.stores:
+            if os.path.exists(self.store_path(seq, blur, 'flow')):
+                flow = np.load(self.store_path(seq, blur, 'flow'), mmap_mode='r+')
+                valid = np.load(self.store_path(seq, blur, 'valid'), mmap_mode='r+')
+                pairs = np.load(self.store_path(seq, blur, 'pairs'))
+                rows = {(int(id1), int(id2)): row for row, (id1, id2) in enumerate(pairs)}
+                self.stores[key] = (flow, valid, rows)
+            else:
+                self.stores[key] = None
+        return self.stores[key]
+
+    def row(self, seq, id1, id2, blur):
+        store = self.open_store(seq, blur)
+        if store is None:
+            return None, None
+        return store, store[2].get((int(id1), int(id2)))
+
+    def missing_pairs(self, seq, blur, pairs):
+        #Returns (pairs not yet filled, whether the existing store already has rows for all pairs)
+        store = self.open_store(seq, blur)
+        if store is None:
+            return pairs, False
+        rows = [store[2].get(pair) for pair in pairs]
+        if any(row is None for row in rows):
+            return pairs, False
+        return [pair for pair, row in zip(pairs, rows) if not store[1][row]], True
+
+    def get(self, seq, id1, id2, blur):
+        store, row = self.row(seq, id1, id2, blur)
+        if row is None or not store[1][row]:
+            return None
+        return torch.from_numpy(store[0][row].astype(np.float32))
+
+    def put(self, seq, id1, id2, blur, flow_img):
+        store, row = self.row(seq, id1, id2, blur)
+        if row is None:
+            #Rows are not allocated on demand: DataLoader workers share the store files and cannot safely resize them
+            key = (seq, int(blur))
+            if key not in self.warned:
+                self.warned.add(key)
+                reason = 'has no store' if store is None else 'is missing pairs'
+                print('Warning: flow cache {} {} for sequence {} (blur: {}); uncached flow is recomputed every epoch. '
+                      'Run kitti/precompute_kitti_flow.py with this dataset to fill it.'.format(self.cache_dir, reason, seq, bool(blur)))
+            return False
+        store[0][row] = flow_img.numpy().astype(np.float16)
+        store[1][row] = 1
+        return True
+
+#Set before forking the pool so workers inherit the dataset instead of receiving a pickled copy per job
+_FLOW_CACHE_DATASET = None
+
+def _flow_cache_worker(args):
+    seq, pairs = args
+    dataset = _FLOW_CACHE_DATASET
+    for id1, id2 in pairs:
+        flow_img = dataset.compute_flow(dataset.get_image(seq, id1), dataset.get_image(seq, id2), None, dataset.apply_blur)
+        dataset.flow_cache.put(seq, id1, id2, dataset.apply_blur, flow_img)
+    for store in dataset.flow_cache.stores.values():
+        if store is not None:
+            store[0].flush()
+            store[1].flush()
+    return len(pairs)
+
+def precompute_kitti_flow(dataset, num_procs=None, chunk_size=64):
+    """Offline job: fills dataset.flow_cache with the flow of every image pair in the dataset,
+    split across num_procs processes (defaults to all cores).
+    """
+    global _FLOW_CACHE_DATASET
+    import multiprocessing
+    cache = dataset.flow_cache
+    jobs = []
+    for seq, pairs in dataset.flow_pairs().items():
+        missing, allocated = cache.missing_pairs(seq, dataset.apply_blur, pairs)
+        if not allocated:
+            #(Re)allocate for the union of these pairs and any pairs already in the store (filled rows are kept)
+            flow_shape = dataset.compute_flow(dataset.get_image(seq, pairs[0][0]), dataset.get_image(seq, pairs[0][1]), None, dataset.apply_blur).shape
+            cache.allocate(seq, dataset.apply_blur, pairs, flow_shape)
+            missing, _ = cache.missing_pairs(seq, dataset.apply_blur, pairs)
+        pairs = missing
+        jobs.extend([(seq, pairs[i:i+chunk_size]) for i in range(0, len(pairs), chunk_size)])
+
+    #Workers open their own mappings
+    cache.stores = {}
+    _FLOW_CACHE_DATASET = dataset
+    try:
+        with multiprocessing.get_context('fork').Pool(num_procs) as pool:
+            num_done = sum(pool.imap_unordered(_flow_cache_worker, jobs))
+    finally:
+        _FLOW_CACHE_DATASET = None
+    return num_done
+
+
+def normalize_device(device):
+    #torch.device('cuda') and torch.device('cuda:0') name the same device (tensors always report the index)
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
 def pointnet_collate(batch):
     data = torch.cat([item[0] for item in batch], dim=0)
     target = torch.cat([item[1] for item in batch], dim=0)
     return [data, target]
 
+def pointnet_ids_collate(batch):
+    return torch.tensor(batch, dtype=torch.long)
+
+def load_pts_file(path):
+    #Whitespace separated x y z rows
+    return np.loadtxt(path, dtype=np.float64, ndmin=2)
+
+def pointnet_cache_dir(pc_folder):
+    return os.path.normpath(pc_folder) + '_cache'
+
+def build_pointnet_cache(pc_folder, cache_dir=None, num_procs=None):
+    """Parses every .pts file in pc_folder (in parallel) into a single consolidated cache:
+    points.npy (total_points x 3), offsets.npy (num_files + 1) and files.txt (file order).
+    Points of file i are points[offsets[i]:offsets[i+1]].
+    """
+    import multiprocessing
+    cache_dir = cache_dir if cache_dir is not None else pointnet_cache_dir(pc_folder)
+    file_names = sorted(os.listdir(pc_folder))
+    with multiprocessing.Pool(num_procs) as pool:
+        clouds = pool.map(load_pts_file, [os.path.join(pc_folder, f) for f in file_names], chunksize=16)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    offsets = np.zeros(len(clouds) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([cloud.shape[0] for cloud in clouds])
+    points = np.lib.format.open_memmap(os.path.join(cache_dir, 'points.npy'), mode='w+', dtype=np.float64, shape=(int(offsets[-1]), 3))
+    for i, cloud in enumerate(clouds):
+        points[offsets[i]:offsets[i+1]] = cloud
+    points.flush()
+    del points
+    np.save(os.path.join(cache_dir, 'offsets.npy'), offsets)
+    #Written last: its presence marks a complete cache
+    with open(os.path.join(cache_dir, 'files.txt'), 'w') as f:
+        f.write('\n'.join(file_names))
+    return cache_dir
+
+def load_pointnet_cache_file_list(pc_folder, cache_dir):
+    #Builds the cache if it is missing or stale, and returns the file list in cache order
+    file_names = sorted(os.listdir(pc_folder))
+    list_path = os.path.join(cache_dir, 'files.txt')
+    cached_names = None
+    if os.path.exists(list_path):
+        with open(list_path) as f:
+            cached_names = f.read().split('\n')
+    if cached_names != file_names:
+        print('Building pointcloud cache in {}...'.format(cache_dir))
+        build_pointnet_cache(pc_folder, cache_dir)
+        print('Done')
+    return [os.path.join(pc_folder, f) for f in file_names]
+
+def open_pointnet_cache(cache_dir):
+    points = np.load(os.path.join(cache_dir, 'points.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(cache_dir, 'offsets.npy'))
+    return points, offsets
+
 class PointNetDataset(Dataset):
     """PointNet Dataset."""
 
@@ -157,10 +531,19 @@ class PointNetDataset(Dataset):
     rotmat_targets=False,
     load_into_memory=True, 
     device=torch.device('cpu'),
-    test_mode=False):
+    test_mode=False,
+    use_cache=False,
+    cache_dir=None,
+    ids_only=False,
+    seed=None):
         """
         Args:
-
+            use_cache: read points from the consolidated binary cache (built on first use, see build_pointnet_cache)
+                       instead of parsing the .pts files; the cache is memory-mapped lazily in each worker
+            cache_dir: location of the cache (defaults to pc_folder + '_cache')
+            ids_only: items are only cloud ids (collate with pointnet_ids_collate); rotations, rotated clouds and 
+                      targets are then generated for the whole batch on the training device by synthesize_batch
+            seed: seeds the random stream used by synthesize_batch (for reproducible batches)
         """
         self.file_list = self._load_pc_list(pc_folder)
         self.total_iters = int(total_iters)
@@ -168,7 +551,19 @@ class PointNetDataset(Dataset):
         self.dtype = dtype
         self.rotmat_targets = rotmat_targets
         self.test_mode = test_mode
-        if load_into_memory:
+        self.cache_dir = None
+        self.cache = None
+        self.ids_only = ids_only
+        self.seed = seed
+        self.device_clouds = None
+        self.clouds_device = None
+        self.generator = None
+        if use_cache:
+            self.cache_dir = cache_dir if cache_dir is not None else pointnet_cache_dir(pc_folder)
+            self.file_list = load_pointnet_cache_file_list(pc_folder, self.cache_dir)
+            self.data = None
+        elif load_into_memory and not ids_only:
+            #(ids_only keeps its own copy of the clouds on the training device instead, see synthesize_batch)
             print('Loading pointclouds into memory...')
             self.data = [torch.from_numpy(np.array(self._load_file(file))) for file in self.file_list]
             print('Done')
@@ -181,27 +576,22 @@ class PointNetDataset(Dataset):
         return files
 
     def _load_file(self, path):
-        """takes as input the path to a .pts and returns a list of 
-        tuples of floats containing the points in in the form:
-        [(x_0, y_0, z_0),
-        (x_1, y_1, z_1),
+        """takes as input the path to a .pts and returns an N x 3 array of the points in the form:
+        [[x_0, y_0, z_0],
+        [x_1, y_1, z_1],
         ...
-        (x_n, y_n, z_n)]"""
-        with open(path) as f:
-            rows = [rows.strip() for rows in f]
-        
-        """Use the curly braces to find the start and end of the point data""" 
-        #head = rows.index('{') + 1
-        #tail = rows.index('}')
-
-        """Select the point data split into coordinates"""
-        raw_points = rows#rows[head:tail]
-        coords_set = [point.split() for point in raw_points]
-
-        """Convert entries from lists of strings to tuples of floats"""
-        points = [tuple([float(point) for point in coords]) for coords in coords_set]
-        return (points)
-
+        [x_n, y_n, z_n]]"""
+        return load_pts_file(path)
+
+    def _get_points(self, pointcloud_id):
+        if self.cache_dir is not None:
+            if self.cache is None:
+                self.cache = open_pointnet_cache(self.cache_dir)
+            points, offsets = self.cache
+            return torch.from_numpy(np.array(points[offsets[pointcloud_id]:offsets[pointcloud_id+1]]))
+        if self.data is None:
+            return torch.from_numpy(np.array(self._load_file(self.file_list[pointcloud_id])))
+        return self.data[pointcloud_id]
 
     def __len__(self):
         if self.test_mode:
@@ -210,16 +600,17 @@ class PointNetDataset(Dataset):
             return self.total_iters
 
     def __getitem__(self, idx):
+        if self.ids_only:
+            #Training ids are drawn by synthesize_batch
+            return idx
+
         # Select a random point cloud
         if self.test_mode:
             pointcloud_id = idx
         else:
             pointcloud_id = torch.randint(len(self.file_list), (1,)).item() 
         
-        if self.data is None:
-            pc1 = torch.from_numpy(np.array(self._load_file(self.file_list[pointcloud_id])))
-        else:
-            pc1 = self.data[pointcloud_id]
+        pc1 = self._get_points(pointcloud_id)
 
         #Matches the original code
         point_num = int(pc1.shape[0]/2)
@@ -245,50 +636,166 @@ class PointNetDataset(Dataset):
         
         return (x, targets)
 
+    def synthesize_batch(self, ids, device=torch.device('cpu')):
+        """Vectorized equivalent of collating __getitem__ over ids (ids_only mode), run on device.
+        In training mode the cloud ids are drawn from the (optionally seeded) random stream instead.
+        """
+        device = normalize_device(device)
+        clouds = self._get_device_clouds(device)
+        generator = self._get_generator(device)
+
+        if not self.test_mode:
+            ids = torch.randint(len(self.file_list), (len(ids),), generator=generator, device=device)
+        ids = ids.to(device)
+        if torch.is_tensor(clouds):
+            x, C = self._rotate_clouds(clouds[ids.repeat_interleave(self.rotations_per_batch)], generator)
+        else:
+            #Clouds of different sizes: synthesize each item (as __getitem__ does) and concatenate (as pointnet_collate does)
+            items = [self._rotate_clouds(clouds[i].expand(self.rotations_per_batch, -1, -1), generator) for i in ids.tolist()]
+            x = torch.cat([x_i for x_i, _ in items], dim=0)
+            C = torch.cat([C_i for _, C_i in items], dim=0)
+
+        if self.rotmat_targets:
+            targets = C
+        else:
+            targets = rotmat_to_quat(C, ordering='xyzw').view(-1, 4)
+        return (x.to(self.dtype), targets.to(self.dtype))
+
+    def _get_device_clouds(self, device):
+        #Sub-sampled clouds, moved to the device once: stacked if they all have the same size, a list otherwise
+        if self.device_clouds is None or self.clouds_device != device:
+            clouds = [self._get_points(i) for i in range(len(self.file_list))]
+            clouds = [pc[:int(pc.shape[0]/2)].to(device=device, dtype=torch.double) for pc in clouds]
+            if len(set(pc.shape[0] for pc in clouds)) == 1:
+                clouds = torch.stack(clouds)
+            self.device_clouds = clouds
+            self.clouds_device = device
+        return self.device_clouds
+
+    def _get_generator(self, device):
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            if self.seed is not None:
+                self.generator.manual_seed(self.seed)
+            else:
+                self.generator.seed()
+        return self.generator
+
+    def reseed(self, seed):
+        #Restarts the random stream of synthesize_batch
+        self.seed = seed
+        self.generator = None
+
+    def _rotate_clouds(self, pc1, generator):
+        C = SO3.exp(torch.randn(pc1.shape[0], 3, dtype=torch.double, device=pc1.device, generator=generator)).as_matrix()
+        if C.dim() < 3:
+            C = C.unsqueeze(dim=0)
+        pc2 = pc1.bmm(C.transpose(1,2))
+        return torch.stack([pc1, pc2], dim=1), C
+
+
+def seven_scenes_frames(scene, data_path, train):
+    #Image filenames and pose filenames (in order) for the train or test split of a scene
+    base_dir = osp.join(osp.expanduser(data_path), scene)   
+    if train:
+        split_file = osp.join(base_dir, 'TrainSplit.txt')
+    else:
+        split_file = osp.join(base_dir, 'TestSplit.txt')
+    with open(split_file, 'r') as f:
+        seqs = [int(l.split('sequence')[-1]) for l in f if not l.startswith('#')]
+
+    c_imgs = []
+    pose_files = []
+    for seq in seqs:
+        seq_dir = osp.join(base_dir, 'seq-{:02d}'.format(seq))
+        p_filenames = [n for n in os.listdir(osp.join(seq_dir, '.')) if n.find('pose') >= 0]
+        frame_idx = range(len(p_filenames))
+        pose_files.extend([osp.join(seq_dir, 'frame-{:06d}.pose.txt'.format(i)) for i in frame_idx])
+        c_imgs.extend([osp.join(seq_dir, 'frame-{:06d}.color.png'.format(i)) for i in frame_idx])
+    return c_imgs, pose_files
+
+def seven_scenes_shard_paths(shard_dir, scene, train, size=256):
+    prefix = osp.join(shard_dir, '{}_{}_{}'.format(scene, 'train' if train else 'test', size))
+    return prefix + '_images.npy', prefix + '_poses.npy'
+
+def pack_seven_scenes(scene, data_path, train, shard_dir=None, size=256):
+    """One-time packer: writes the resized (shorter side = size) uint8 images (N x 3 x H x W) and the 
+    flattened 4x4 poses (N x 16) of a scene split into two memory-mappable .npy files in shard_dir 
+    (defaults to the scene directory).
+    """
+    shard_dir = shard_dir if shard_dir is not None else osp.join(osp.expanduser(data_path), scene)
+    os.makedirs(shard_dir, exist_ok=True)
+    images_path, poses_path = seven_scenes_shard_paths(shard_dir, scene, train, size)
+    c_imgs, pose_files = seven_scenes_frames(scene, data_path, train)
+
+    #Both files are written under temporary names and only moved into place once complete,
+    #so an interrupted pack is never mistaken for a finished shard
+    poses = np.stack([np.loadtxt(f).flatten() for f in pose_files])
+    with open(poses_path + '.tmp', 'wb') as f:
+        np.save(f, poses)
+
+    resize = torchvision.transforms.Resize(size)
+    first = np.asarray(resize(default_loader(c_imgs[0])))
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8, shape=(len(c_imgs), 3) + first.shape[:2])
+    for i, filename in enumerate(c_imgs):
+        images[i] = np.asarray(resize(default_loader(filename))).transpose(2, 0, 1)
+    images.flush()
+    del images
+
+    os.replace(poses_path + '.tmp', poses_path)
+    os.replace(images_path + '.tmp', images_path)
+    return images_path, poses_path
+
+class ShardCropNormalize():
+    """Tensor transform for packed 7Scenes shards: random (train) or center crop of a uint8 C x H x W 
+    image, then scaling to [0,1] and normalization (matches Resize/RandomCrop/ToTensor/Normalize on the PIL image).
+    """
+    def __init__(self, crop_size=224, train=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
+        self.crop_size = crop_size
+        self.train = train
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+
+    def __call__(self, img):
+        H, W = img.shape[1:]
+        if self.train:
+            top = torch.randint(H - self.crop_size + 1, (1,)).item()
+            left = torch.randint(W - self.crop_size + 1, (1,)).item()
+        else:
+            top = int(round((H - self.crop_size) / 2.))
+            left = int(round((W - self.crop_size) / 2.))
+        img = img[:, top:top+self.crop_size, left:left+self.crop_size].float() / 255.
+        return (img - self.mean) / self.std
 
 class SevenScenesData(Dataset):
-    def __init__(self, scene, data_path, train, transform=None, output_first_image=True, tensor_type=torch.float):
+    def __init__(self, scene, data_path, train, transform=None, output_first_image=True, tensor_type=torch.float, shard_dir=None, shard_size=256):
         
         """
           :param scene: scene name: 'chess', 'pumpkin', ...
           :param data_path: root 7scenes data directory.
+          :param shard_dir: read from the shard written by pack_seven_scenes (images are then uint8 C x H x W 
+                            tensors, see ShardCropNormalize for a matching transform)
 
         """
         self.transform = transform
         self.train = train
         self.tensor_type = tensor_type
-          # directories
-        base_dir = osp.join(osp.expanduser(data_path), scene)   
-          # decide which sequences to use
-        if train:
-            split_file = osp.join(base_dir, 'TrainSplit.txt')
+        self.images_path = None
+        self.images = None
+
+        if shard_dir is not None:
+            self.images_path, poses_path = seven_scenes_shard_paths(shard_dir, scene, train, shard_size)
+            self.c_imgs = None
+            self.poses = np.load(poses_path)
         else:
-            split_file = osp.join(base_dir, 'TestSplit.txt')
-        with open(split_file, 'r') as f:
-            seqs = [int(l.split('sequence')[-1]) for l in f if not l.startswith('#')]
-    
-        # read poses and collect image names
-        self.c_imgs = []
-        self.pose_files = []
-        self.gt_idx = np.empty((0,), dtype=np.int)
-        ps = {}
-        for seq in seqs:
-            seq_dir = osp.join(base_dir, 'seq-{:02d}'.format(seq))
-            p_filenames = [n for n in os.listdir(osp.join(seq_dir, '.')) if n.find('pose') >= 0]
-            frame_idx = np.array(range(len(p_filenames)), dtype=np.int)
-            pss = [np.loadtxt(osp.join(seq_dir, 'frame-{:06d}.pose.txt'.format(i))).flatten() for i in frame_idx]
-            ps[seq] = np.asarray(pss)
-            c_imgs = [osp.join(seq_dir, 'frame-{:06d}.color.png'.format(i)) for i in frame_idx]
-            self.c_imgs.extend(c_imgs)
-        
-        self.poses = np.empty((0,16))
-        for seq in seqs:
-            self.poses = np.vstack((self.poses,ps[seq]))
+            # read poses and collect image names
+            self.c_imgs, pose_files = seven_scenes_frames(scene, data_path, train)
+            self.poses = np.stack([np.loadtxt(f).flatten() for f in pose_files])
 
         self.poses = torch.from_numpy(self.poses).to(dtype=tensor_type)
 
         if output_first_image:
-            self.first_image = self.transform(self.load_image(self.c_imgs[0])).to(dtype=tensor_type)
+            self.first_image = self.transform(self.get_image(0)).to(dtype=tensor_type)
             self.C_w_c0 = self.poses[0].view(4,4)[:3, :3]
 
         else:
@@ -297,8 +804,16 @@ class SevenScenesData(Dataset):
 
         print('Loaded {} poses'.format(self.poses.shape[0]))
 
+    def get_image(self, index):
+        if self.images_path is not None:
+            if self.images is None:
+                #Mapped lazily in each worker
+                self.images = np.load(self.images_path, mmap_mode='c')
+            return torch.from_numpy(self.images[index])
+        return self.load_image(self.c_imgs[index])
+
     def __getitem__(self, index):
-        img = self.transform(self.load_image(self.c_imgs[index])).to(dtype=self.tensor_type)
+        img = self.transform(self.get_image(index)).to(dtype=self.tensor_type)
         pose = self.poses[index].view(4,4) #Poses are camera to world
         C_ci_w = pose[:3,:3].transpose(0,1) #World to camera
         
@@ -322,70 +837,64 @@ class SevenScenesData(Dataset):
         return img
 
 
+def read_asl_csv(file_path):
+    #Reads an ASL-format csv (comment lines start with '#') into a 2D array of stripped strings
+    with open(file_path, "r") as ff:
+        return np.char.strip(np.loadtxt((line for line in ff if line[0] != "#"), dtype=str, delimiter=",", ndmin=2))
+
 class FLADataset(tud.Dataset):
     """Loads FLA data from ASL format into a torch dataset.
     """
 
-    def __init__(self, dataset_file, image_dir, pose_dir, transform=None, rotmat_targets=False, eval_mode=False):
+    def __init__(self, dataset_file, image_dir, pose_dir, transform=None, rotmat_targets=False, eval_mode=False, frame_cache_size=0):
         """Constructor for FLADataset.
 
         :param image_dir: Root directory of images.
         :param pose_dir: Root directory of poses.
         :param transform: Transform to apply when reading data.
+        :param frame_cache_size: Number of decoded (and transformed) frames kept in an LRU cache by each 
+                                 worker (0 disables). Assumes a deterministic transform; pair with FLAPairSampler.
         """
         self.image_dir = image_dir
         self.pose_dir = pose_dir
         self.transform = transform
         self.rotmat_targets = rotmat_targets
         self.eval_mode = eval_mode
+        self.frame_cache_size = frame_cache_size
+        self.frame_cache = OrderedDict()
+        #(hits, misses) in shared memory, so the counts of all DataLoader workers add up in the main process
+        import multiprocessing
+        self.cache_counts = multiprocessing.Array('q', 2)
 
         # Read in images.
-        self.image_timestamps = [] # nanoseconds.
-        self.image_filenames = []
-        with open(os.path.join(self.image_dir, "data.csv"), "r") as ff:
-            lines = ff.readlines()
-            lines = [line.rstrip() for line in lines] # Strip newlines.
-            lines = [line for line in lines if line[0] is not "#"] # Strip comments.
-
-            for line in lines:
-                tokens = line.split(",")
-                self.image_timestamps.append(np.uint64(tokens[0]))
-                self.image_filenames.append(tokens[1])
-
-        self.image_timestamps = np.array(self.image_timestamps)
+        image_data = read_asl_csv(os.path.join(self.image_dir, "data.csv"))
+        self.image_timestamps = image_data[:, 0].astype(np.uint64) # nanoseconds.
+        self.image_filenames = image_data[:, 1].tolist()
 
         # Read poses.
-        self.pose_timestamps = [] # nanoseconds.
-        self.pose_qxyzw = []
-        with open(os.path.join(self.pose_dir, "data.csv"), "r") as ff:
-            lines = ff.readlines()
-            lines = [line.rstrip() for line in lines] # Strip newlines.
-            lines = [line for line in lines if line[0] is not "#"] # Strip comments.
-
-            for line in lines:
-                tokens = line.split(",")
-                self.pose_timestamps.append(np.uint64(tokens[0]))
-
-                qw = np.float(tokens[-4])
-                qx = np.float(tokens[-3])
-                qy = np.float(tokens[-2])
-                qz = np.float(tokens[-1])
+        pose_data = read_asl_csv(os.path.join(self.pose_dir, "data.csv"))
+        self.pose_timestamps = pose_data[:, 0].astype(np.uint64) # nanoseconds.
+        qwxyz = pose_data[:, -4:].astype(np.float64)
+        self.pose_qxyzw = torch.from_numpy(qwxyz[:, [1, 2, 3, 0]].copy())
+        #Normalize once here; quat_to_rotmat no longer does so per call
+        self.pose_qxyzw = self.pose_qxyzw/self.pose_qxyzw.norm(dim=1, keepdim=True)
 
-                self.pose_qxyzw.append(np.array([qx, qy, qz, qw]))
-
-        self.pose_timestamps = np.array(self.pose_timestamps)
-        self.pose_qxyzw = torch.from_numpy(np.array(self.pose_qxyzw))
+        #Sorted pose index for the timestamp lookups
+        self.pose_order = np.argsort(self.pose_timestamps, kind='stable')
+        self.sorted_pose_timestamps = self.pose_timestamps[self.pose_order].astype(np.int64)
 
         #Read in pairs of images
-        self.image_pair_ids = []
-        with open(dataset_file, "r") as ff:
-            lines = ff.readlines()
-            lines = [line.rstrip() for line in lines] # Strip newlines.
-            lines = [line for line in lines if line[0] is not "#"] # Strip comments.
-            for line in lines:
-                tokens = line.split(",")
-                self.image_pair_ids.append([np.uint64(tokens[0]), np.uint64(tokens[1])])
+        self.image_pair_ids = np.loadtxt(dataset_file, dtype=np.int64, delimiter=",", comments="#", ndmin=2)
         print('Loaded {} pairs of images from {}'.format(len(self.image_pair_ids), dataset_file))
+
+        #Resolve every pair to its pose indices up front
+        pair_timestamps = self.image_timestamps[self.image_pair_ids].astype(np.int64)
+        self.pair_pose_ids, pose_dt = self.find_poses(pair_timestamps)
+        tol_ms = 30
+        bad_pairs = np.nonzero((np.abs(pose_dt)*1e-6 >= tol_ms).any(axis=1))[0]
+        if len(bad_pairs) > 0:
+            raise ValueError('{} image pairs in {} have no pose within {} ms (pair indices: {}{}).'.format(
+                len(bad_pairs), dataset_file, tol_ms, bad_pairs[:10].tolist(), ', ...' if len(bad_pairs) > 10 else ''))
        
     def __len__(self):
         return len(self.image_pair_ids)
@@ -401,31 +910,74 @@ class FLADataset(tud.Dataset):
 
         return flow_img
 
+    def find_poses(self, timestamps):
+        #Closest pose (index, signed time difference in ns) for an array of int64 timestamps
+        if len(self.sorted_pose_timestamps) < 2:
+            #Nothing to bracket with: a single pose is the closest one (the caller checks the tolerance)
+            if len(self.sorted_pose_timestamps) == 0:
+                raise ValueError('No poses found in {}.'.format(self.pose_dir))
+            nearest = np.zeros(np.shape(timestamps), dtype=np.int64)
+        else:
+            right = np.clip(np.searchsorted(self.sorted_pose_timestamps, timestamps), 1, len(self.sorted_pose_timestamps) - 1)
+            left = right - 1
+            dt_left = timestamps - self.sorted_pose_timestamps[left]
+            dt_right = self.sorted_pose_timestamps[right] - timestamps
+            nearest = np.where(dt_left <= dt_right, left, right)
+        return self.pose_order[nearest], timestamps - self.sorted_pose_timestamps[nearest]
+
     def find_pose(self, timestamp):
          # Find closest pose given timestamp.
-        pose_idx = np.argmin(np.abs(self.pose_timestamps - timestamp))
+        pose_idx, dt = self.find_poses(np.array([timestamp], dtype=np.int64))
         
         tol_ms = 30
-        assert(np.abs(np.float(self.pose_timestamps[pose_idx]) - timestamp) * 1e-6 < tol_ms)
-        return pose_idx
+        assert(np.abs(dt[0]) * 1e-6 < tol_ms)
+        return pose_idx[0]
+
+    def load_frame(self, image_id):
+        image = Image.open(os.path.join(self.image_dir, "data", self.image_filenames[image_id]))
+        if self.transform:
+            image = self.transform(image)
+        return image
+
+    def get_frame(self, image_id):
+        #LRU cache lookup (per worker, since each DataLoader worker holds its own copy of the dataset)
+        if self.frame_cache_size <= 0:
+            return self.load_frame(image_id)
+        image_id = int(image_id)
+        hit = image_id in self.frame_cache
+        with self.cache_counts.get_lock():
+            self.cache_counts[0 if hit else 1] += 1
+        if hit:
+            self.frame_cache.move_to_end(image_id)
+            return self.frame_cache[image_id]
+        image = self.load_frame(image_id)
+        self.frame_cache[image_id] = image
+        if len(self.frame_cache) > self.frame_cache_size:
+            self.frame_cache.popitem(last=False)
+        return image
+
+    def cache_stats(self, reset=False):
+        #Frame cache counts summed over all workers (since construction or the last reset)
+        with self.cache_counts.get_lock():
+            hits, misses = self.cache_counts[:]
+            if reset:
+                self.cache_counts[:] = [0, 0]
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total > 0 else 0.}
 
     def __getitem__(self, idx):
         
         [id1, id2] = self.image_pair_ids[idx]
 
-        image1 = Image.open(os.path.join(self.image_dir, "data", self.image_filenames[id1]))
-        image2 = Image.open(os.path.join(self.image_dir, "data", self.image_filenames[id2]))
+        image1 = self.get_frame(id1)
+        image2 = self.get_frame(id2)
 
-        pose_idx1 = self.find_pose(self.image_timestamps[id1])
-        pose_idx2 = self.find_pose(self.image_timestamps[id2])
+        pose_idx1, pose_idx2 = self.pair_pose_ids[idx]
 
         R_1 = quat_to_rotmat(self.pose_qxyzw[pose_idx1, :], ordering='xyzw')
         R_2 = quat_to_rotmat(self.pose_qxyzw[pose_idx2, :], ordering='xyzw')
 
         R = R_1.mm(R_2.transpose(0,1))
-        if self.transform:
-            image1 = self.transform(image1)
-            image2 = self.transform(image2)
 
         if self.rotmat_targets:
             target = R
@@ -434,4 +986,30 @@ class FLADataset(tud.Dataset):
 
         #flow_image = self.compute_flow(image1, image2)
         img_input = torch.cat([image1, image2], dim=0)
-        return img_input, target
\ No newline at end of file
+        return img_input, target
+
+
+class FLAPairSampler(tud.Sampler):
+    """Shuffles FLADataset pairs while keeping pairs that share frames close together.
+
+    Pairs are ordered by their first frame, split into windows of `window` consecutive pairs, and the windows 
+    (and the pairs within each window) are shuffled. A per-worker frame cache of about 2*window frames then 
+    decodes most frames only once per epoch.
+    """
+    def __init__(self, dataset, window=512, seed=None):
+        self.pair_ids = np.asarray(dataset.image_pair_ids)
+        self.window = window
+        self.seed = seed
+        self.epoch = 0
+        self.order = np.argsort(self.pair_ids.min(axis=1), kind='stable')
+
+    def __iter__(self):
+        rng = np.random.default_rng(None if self.seed is None else self.seed + self.epoch)
+        self.epoch += 1
+        windows = [self.order[i:i+self.window] for i in range(0, len(self.order), self.window)]
+        for w_i in rng.permutation(len(windows)):
+            for idx in rng.permutation(windows[w_i]):
+                yield int(idx)
+
+    def __len__(self):
+        return len(self.order)
@@ -22,7 +22,7 @@ class QuatNet(torch.nn.Module):
         self.A_net = PointNet(dim_out=10, normalize_output=False, batchnorm=batchnorm)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
     
     def output_A(self, x):
         A_vec = self.A_net(x)
@@ -35,13 +35,7 @@ class QuatNet(torch.nn.Module):
 
     def forward(self, x):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm)
         return q
 
 
@@ -182,10 +176,10 @@ class RotMat6DFlowNet(torch.nn.Module):
         return C
 
 class RotMatSDPFlowNet(torch.nn.Module):
-    def __init__(self, dim_in=2, dim_rep=55, enforce_psd=True, unit_frob_norm=True, batchnorm=True):
+    def __init__(self, dim_in=2, dim_rep=55, enforce_psd=True, unit_frob_norm=True, batchnorm=True, sdp_jobs=None):
         super(RotMatSDPFlowNet, self).__init__()        
         self.net = BasicCNN(dim_in=dim_in, dim_out=dim_rep, normalize_output=False, batchnorm=batchnorm)
-        self.sdp_solver = RotMatSDPSolver()
+        self.sdp_solver = RotMatSDPSolver(n_jobs=sdp_jobs)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
 
@@ -205,7 +199,7 @@ class QuatFlowNet(torch.nn.Module):
         self.A_net = BasicCNN(dim_in=dim_in, dim_out=10, normalize_output=False, batchnorm=batchnorm)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
     
     def output_A(self, x):
         A_vec = self.A_net(x)
@@ -218,13 +212,7 @@ class QuatFlowNet(torch.nn.Module):
 
     def forward(self, x):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm)
         return q
 
 class QuatFlowResNet(torch.nn.Module):
@@ -233,7 +221,7 @@ class QuatFlowResNet(torch.nn.Module):
         self.A_net = CustomResNet(dim_out=10)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
     
     def output_A(self, x):
         A_vec = self.A_net(x)
@@ -246,13 +234,7 @@ class QuatFlowResNet(torch.nn.Module):
 
     def forward(self, x):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm)
         return q
 
 def conv_unit(in_planes, out_planes, kernel_size=3, stride=2,padding=1, batchnorm=True):
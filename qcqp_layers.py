@@ -1,23 +1,92 @@
 import numpy as np
 import scipy as sp
 import time
+import math
 import torch
 
+#=========================INDEX / BASIS CACHES=========================
+# Index and basis tensors used to convert between BxM vectors and symmetric BxNxN matrices (M = N*(N+1)/2).
+# These are built once per (N, device[, dtype]) and shared; callers must not modify them in place.
+SYM_CACHE = {}
+
+def cached_sym_tensor(key, build):
+    if key not in SYM_CACHE:
+        SYM_CACHE[key] = build()
+    return SYM_CACHE[key]
+
+def A_dim_from_Avec_dim(M):
+    """ Returns N such that M = N*(N+1)/2"""
+    N = int(round((math.sqrt(8*M + 1) - 1)/2))
+    if N*(N+1)//2 != M:
+        raise ValueError("A_vec of length {} does not encode a symmetric matrix.".format(M))
+    return N
+
+def sym_triu_indices(N, device=torch.device('cpu')):
+    """ (2,M) row and column indices of the upper triangle of NxN matrices (the A_vec ordering)"""
+    return cached_sym_tensor(('triu', N, device), lambda: torch.triu_indices(N, N, device=device))
+
+def sym_tril_indices(N, device=torch.device('cpu')):
+    """ (2,M) row and column indices of the lower triangle of NxN matrices (the Cholesky-like A_vec ordering)"""
+    return cached_sym_tensor(('tril_idx', N, device), lambda: torch.tril_indices(N, N, device=device))
+
+def sym_gather_indices(N, device=torch.device('cpu')):
+    """ (N*N,) indices into A_vec of every (row-major) entry of the NxN symmetric matrix it encodes"""
+    def build():
+        idx = torch.triu_indices(N, N, device=device)
+        vec_idx = torch.arange(idx.shape[1], device=device)
+        gather_idx = torch.empty((N, N), dtype=torch.long, device=device)
+        gather_idx[idx[0], idx[1]] = vec_idx
+        gather_idx[idx[1], idx[0]] = vec_idx
+        return gather_idx.view(-1)
+    return cached_sym_tensor(('gather', N, device), build)
+
+def sym_tril_gather(N, device=torch.device('cpu'), dtype=torch.double):
+    """ (N*N,) indices into A_vec and (N*N,) mask that fill a lower triangular NxN matrix (row-major)"""
+    def build():
+        idx = sym_tril_indices(N, device)
+        gather_idx = torch.zeros((N, N), dtype=torch.long, device=device)
+        gather_idx[idx[0], idx[1]] = torch.arange(idx.shape[1], device=device)
+        mask = torch.ones((N, N), dtype=dtype, device=device).tril()
+        return gather_idx.view(-1), mask.view(-1)
+    return cached_sym_tensor(('tril', N, device, dtype), build)
+
+def sym_frob_weights(N, device=torch.device('cpu'), dtype=torch.double):
+    """ (M,) weights s.t. the squared Frobenius norm of a symmetric matrix is sum_i w_i*A_vec_i^2"""
+    def build():
+        idx = torch.triu_indices(N, N, device=device)
+        return 2. - (idx[0] == idx[1]).to(dtype)
+    return cached_sym_tensor(('frob', N, device, dtype), build)
+
+def sym_basis(N, device=torch.device('cpu'), dtype=torch.double):
+    """ (M,N,N) symmetric basis I_ij, with ones at (i,j) and (j,i), s.t. A = sum_k A_vec_k*I_ij[k]"""
+    def build():
+        idx = torch.triu_indices(N, N, device=device)
+        i = torch.arange(idx.shape[1], device=device)
+        I_ij = torch.zeros((idx.shape[1], N, N), dtype=dtype, device=device)
+        I_ij[i, idx[0], idx[1]] = 1.
+        I_ij[i, idx[1], idx[0]] = 1.
+        return I_ij
+    return cached_sym_tensor(('basis', N, device, dtype), build)
+
+def sym_eye(N, device=torch.device('cpu'), dtype=torch.double):
+    return cached_sym_tensor(('eye', N, device, dtype), lambda: torch.eye(N, dtype=dtype, device=device))
+
+
 def normalize_Avec(A_vec):
     """ Normalizes BxM vectors such that resulting symmetric BxNxN matrices have unit Frobenius norm"""
     """ M = N*(N+1)/2"""
     
-    A = convert_Avec_to_A(A_vec)
-    if A.dim() < 3:
-        A = A.unsqueeze(dim=0)
-    A = A / A.norm(dim=[1,2], keepdim=True)
-    return convert_A_to_Avec(A).squeeze()
+    if A_vec.dim() < 2:
+        A_vec = A_vec.unsqueeze(dim=0)
+    w = sym_frob_weights(A_dim_from_Avec_dim(A_vec.shape[1]), A_vec.device, A_vec.dtype)
+    A_vec = A_vec / (w*A_vec*A_vec).sum(dim=1, keepdim=True).sqrt()
+    return A_vec.squeeze()
 
 def convert_A_to_Avec(A):
     """ Convert BxNXN symmetric matrices to BxM vectors encoding unique values"""
     if A.dim() < 3:
         A = A.unsqueeze(dim=0)
-    idx = torch.triu_indices(A.shape[1], A.shape[1])
+    idx = sym_triu_indices(A.shape[1], A.device)
     A_vec = A[:, idx[0], idx[1]]
     return A_vec.squeeze()
 
@@ -27,36 +96,21 @@ def convert_Avec_to_A(A_vec):
     if A_vec.dim() < 2:
         A_vec = A_vec.unsqueeze(dim=0)
     
-    if A_vec.shape[1] == 10:
-        A_dim = 4
-    elif A_vec.shape[1] == 55:
-        A_dim = 10
-    else:
-        raise ValueError("Arbitrary A_vec not yet implemented")
-
-    idx = torch.triu_indices(A_dim,A_dim)
-    A = A_vec.new_zeros((A_vec.shape[0],A_dim,A_dim))   
-    A[:, idx[0], idx[1]] = A_vec
-    A[:, idx[1], idx[0]] = A_vec
+    A_dim = A_dim_from_Avec_dim(A_vec.shape[1])
+    idx = sym_gather_indices(A_dim, A_vec.device)
+    A = A_vec[:, idx].view(A_vec.shape[0], A_dim, A_dim)
     return A.squeeze()
 
 def convert_Avec_to_Avec_psd(A_vec):
     """ Convert BxM tensor (encodes symmetric NxN amatrices) to BxM tensor  
-    (encodes symmetric and PSD 4x4 matrices)"""
+    (encodes symmetric and PSD NxN matrices)"""
 
     if A_vec.dim() < 2:
-        A_vec = A_vec.unsqueeze()
+        A_vec = A_vec.unsqueeze(dim=0)
     
-    if A_vec.shape[1] == 10:
-        A_dim = 4
-    elif A_vec.shape[1] == 55:
-        A_dim = 10
-    else:
-        raise ValueError("Arbitrary A_vec not yet implementedf")
-
-    idx = torch.tril_indices(A_dim,A_dim)
-    L = A_vec.new_zeros((A_vec.shape[0],A_dim,A_dim))   
-    L[:, idx[0], idx[1]] = A_vec
+    A_dim = A_dim_from_Avec_dim(A_vec.shape[1])
+    idx, mask = sym_tril_gather(A_dim, A_vec.device, A_vec.dtype)
+    L = (A_vec[:, idx]*mask).view(A_vec.shape[0], A_dim, A_dim)
     A = L.bmm(L.transpose(1,2))
     A_vec_psd = convert_A_to_Avec(A)
     return A_vec_psd
@@ -77,46 +131,204 @@ class QuadQuatFastSolver(torch.autograd.Function):
     """
     Differentiable QCQP solver
     Input: Bx10 tensor 'A_vec' which encodes symmetric 4x4 matrices, A
+           solver: eigensolver used in the forward pass ('symeig' or 'jacobi', see solve_wahba_fast)
+           grad_mode: 'eig' (closed-form gradient from the saved eigendecomposition, see compute_grad_eig)
+                      or 'kkt' (implicit function theorem on the KKT system, see compute_grad_fast)
     Output: q that minimizes q^T A q s.t. |q| = 1
     """
 
     @staticmethod
-    def forward(ctx, A_vec):
+    def forward(ctx, A_vec, solver='symeig', grad_mode='eig'):
 
         A = convert_Avec_to_A(A_vec)
         if A.dim() < 3:
             A = A.unsqueeze(dim=0)
-        q, nu  = solve_wahba_fast(A)
-        ctx.save_for_backward(A, q, nu)
+        nus, qs = symeig_fast(A, solver=solver)
+        q, nu = min_eigenpair(nus, qs)
+        if grad_mode == 'eig':
+            ctx.save_for_backward(q, nus, qs)
+        elif grad_mode == 'kkt':
+            ctx.save_for_backward(A, q, nu)
+        else:
+            raise ValueError("Valid grad_modes are 'eig' and 'kkt'. Got '{}'.".format(grad_mode))
+        ctx.grad_mode = grad_mode
         return q
 
     @staticmethod
     def backward(ctx, grad_output):
-        A, q, nu = ctx.saved_tensors
-        grad_qcqp = compute_grad_fast(A, nu, q)
-        outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
-        return outgrad
+        if ctx.grad_mode == 'eig':
+            q, nus, qs = ctx.saved_tensors
+            outgrad = compute_grad_eig(nus, qs, q, grad_output)
+        else:
+            A, q, nu = ctx.saved_tensors
+            grad_qcqp = compute_grad_fast(A, nu, q)
+            outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
+        return outgrad, None, None
 
-def solve_wahba_fast(A, compute_gap=False):
+class QuadQuatFusedSolver(torch.autograd.Function):
+    """
+    Differentiable QCQP solver, fused with the A_vec parametrization used by the A-based networks
+    Input: Bx10 tensor 'A_vec' (raw network output)
+           enforce_psd: A = L*L^T where L is lower triangular and encoded by A_vec (as in convert_Avec_to_Avec_psd)
+           unit_frob_norm: A is scaled to unit Frobenius norm (as in normalize_Avec)
+           solver: eigensolver used in the forward pass ('symeig' or 'jacobi', see solve_wahba_fast)
+    Output: q that minimizes q^T A q s.t. |q| = 1
+
+    Equivalent to QuadQuatFastSolver.apply(normalize_Avec(convert_Avec_to_Avec_psd(A_vec))), but A is kept
+    in 4x4 form throughout and the whole chain is a single node in the autograd graph.
+    """
+
+    @staticmethod
+    def forward(ctx, A_vec, enforce_psd=False, unit_frob_norm=False, solver='symeig'):
+
+        if A_vec.dim() < 2:
+            A_vec = A_vec.unsqueeze(dim=0)
+
+        if enforce_psd:
+            idx, mask = sym_tril_gather(4, A_vec.device, A_vec.dtype)
+            L = (A_vec[:, idx]*mask).view(-1, 4, 4)
+            A = L.bmm(L.transpose(1,2))
+        else:
+            L = None
+            A = A_vec[:, sym_gather_indices(4, A_vec.device)].view(-1, 4, 4)
+
+        if unit_frob_norm:
+            A_norm = A.norm(dim=[1,2], keepdim=True)
+            A = A / A_norm
+        else:
+            A_norm = None
+
+        nus, qs = symeig_fast(A, solver=solver)
+        q, _ = min_eigenpair(nus, qs)
+
+        ctx.save_for_backward(q, nus, qs, A, L, A_norm)
+        ctx.enforce_psd = enforce_psd
+        ctx.unit_frob_norm = unit_frob_norm
+        return q
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        q, nus, qs, A, L, A_norm = ctx.saved_tensors
+
+        #Symmetric gradient w.r.t. the 4x4 matrix passed to the eigensolver (see compute_grad_eig)
+        coeffs = torch.einsum('bik,bi->bk', qs[:, :, 1:], grad_output) / (nus[:, :1] - nus[:, 1:])
+        w = torch.einsum('bik,bk->bi', qs[:, :, 1:], coeffs)
+        G = torch.einsum('bi,bj->bij', w, q)
+        G = 0.5*(G + G.transpose(1, 2))
+
+        if ctx.unit_frob_norm:
+            G = (G - (G*A).sum(dim=[1,2], keepdim=True)*A) / A_norm
+
+        if ctx.enforce_psd:
+            idx = sym_tril_indices(4, G.device)
+            G = 2.*G.bmm(L)
+            outgrad = G[:, idx[0], idx[1]]
+        else:
+            idx = sym_triu_indices(4, G.device)
+            outgrad = G[:, idx[0], idx[1]]*sym_frob_weights(4, G.device, G.dtype)
+
+        return outgrad, None, None, None
+
+def solve_wahba_fast(A, compute_gap=False, solver='symeig'):
     """
     Use a fast eigenvalue solution to the dual of the 'generalized Wahba' problem to solve the primal.
     :param A: quadratic cost matrix
     :param redundant_constraints: boolean indicating whether to use redundand constraints
+    :param solver: 'symeig' (LAPACK/MAGMA) or 'jacobi' (batched fixed-sweep Jacobi, see batch_symeig_4x4)
     :return: Optimal q, optimal dual var. nu, time to solve, duality gap
     """
     #start = time.time()
     # Returns (b,n) and (b,n,n) tensors
-    nus, qs = torch.symeig(A, eigenvectors=True)
-    nu_min, nu_argmin = torch.min(nus, 1)# , keepdim=False, out=None)
-    q_opt = qs[torch.arange(A.shape[0]), :, nu_argmin]
-    q_opt = q_opt*(torch.sign(q_opt[:, 3]).unsqueeze(1))
-    nu_opt = -1.*nu_min.unsqueeze(1)
+    nus, qs = symeig_fast(A, solver=solver)
+    q_opt, nu_opt = min_eigenpair(nus, qs)
     if compute_gap:
         p = torch.einsum('bn,bnm,bm->b', q_opt, A, q_opt).unsqueeze(1)
         gap = p + nu_opt
         return q_opt, nu_opt, gap
     return q_opt, nu_opt
 
+def symeig_fast(A, solver='symeig'):
+    """ Returns the (B,4) eigenvalues (ascending) and (B,4,4) eigenvectors of (B,4,4) symmetric matrices"""
+    if solver == 'symeig':
+        return torch.symeig(A, eigenvectors=True)
+    elif solver == 'jacobi':
+        return batch_symeig_4x4(A)
+    else:
+        raise ValueError("Valid solvers are 'symeig' and 'jacobi'. Got '{}'.".format(solver))
+
+def min_eigenpair(nus, qs):
+    """ Returns the (B,4) eigenvectors (with positive scalar part) and (B,1) negated eigenvalues of the minimum eigenpairs"""
+    nu_min, nu_argmin = torch.min(nus, 1)# , keepdim=False, out=None)
+    q_opt = qs[torch.arange(qs.shape[0]), :, nu_argmin]
+    q_opt = q_opt*(torch.sign(q_opt[:, 3]).unsqueeze(1))
+    nu_opt = -1.*nu_min.unsqueeze(1)
+    return q_opt, nu_opt
+
+#Pairs of disjoint (p,q) planes: each round of a cyclic Jacobi sweep zeroes two off-diagonal entries at once
+JACOBI_ROUNDS_4x4 = [((0, 1), (2, 3)), ((0, 2), (1, 3)), ((0, 3), (1, 2))]
+
+def batch_symeig_4x4(A, sweeps=5):
+    """
+    Input: A: (B,4,4) tensor (B symmetric 4x4 matrices)
+           sweeps: number of (fixed, unchecked) cyclic Jacobi sweeps
+    
+    Output: nus: (B,4) tensor (eigenvalues in ascending order)
+            qs: (B,4,4) tensor (corresponding eigenvectors as columns)
+
+    Vectorized Jacobi eigensolver for small symmetric matrices. Avoids the per-call overhead of torch.symeig
+    on large batches of 4x4 matrices. Convergence is quadratic: 5 sweeps reach machine precision in double.
+    """
+    assert(A.dim() > 2 and A.shape[1] == 4 and A.shape[2] == 4)
+
+    I = sym_eye(4, A.device, A.dtype)
+    V = I.repeat(A.shape[0], 1, 1)
+    for _ in range(sweeps):
+        for planes in JACOBI_ROUNDS_4x4:
+            G = I.repeat(A.shape[0], 1, 1)
+            for p, r in planes:
+                #Rotation angle (|theta| <= pi/4) that zeroes A[p,r]
+                d = A[:, r, r] - A[:, p, p]
+                sgn = torch.where(d < 0., -torch.ones_like(d), torch.ones_like(d))
+                theta = 0.5*torch.atan2(2.*sgn*A[:, p, r], d.abs())
+                c = torch.cos(theta)
+                s = torch.sin(theta)
+                G[:, p, p] = c
+                G[:, r, r] = c
+                G[:, p, r] = s
+                G[:, r, p] = -s
+            A = G.transpose(1, 2).bmm(A).bmm(G)
+            V = V.bmm(G)
+
+    nus, idx = torch.sort(A.diagonal(dim1=1, dim2=2), dim=1)
+    qs = V.gather(2, idx.unsqueeze(1).expand(-1, 4, -1))
+    return nus, qs
+
+def compute_grad_eig(nus, qs, q, grad_output):
+    """
+    Input: nus: (B,4) tensor (eigenvalues of A in ascending order)
+           qs: (B,4,4) tensor (corresponding eigenvectors as columns)
+           q: (B,4) tensor (optimal unit quaternions, i.e. +/- the first eigenvector)
+           grad_output: (B,4) tensor (gradient of the loss w.r.t. q)
+
+    Output: grad: (B,10) tensor (gradient of the loss w.r.t. A_vec)
+
+    Closed-form alternative to compute_grad_fast. Perturbation theory gives
+    dq = sum_k q_k q_k^T dA q / (nu_0 - nu_k) over the remaining eigenpairs (k = 1..3),
+    so no KKT system needs to be built or solved.
+    """
+    assert(nus.dim() > 1 and qs.dim() > 2 and q.dim() > 1)
+
+    #Projection of the incoming gradient onto each remaining eigenvector, scaled by the inverse eigengap
+    coeffs = torch.einsum('bik,bi->bk', qs[:, :, 1:], grad_output) / (nus[:, :1] - nus[:, 1:])
+    w = torch.einsum('bik,bk->bi', qs[:, :, 1:], coeffs)
+
+    #dL/dA = w q^T, then account for A_ij = A_ji being a single entry of A_vec
+    G = torch.einsum('bi,bj->bij', w, q)
+    G = G + G.transpose(1, 2)
+    idx = sym_triu_indices(4, G.device)
+    grad = G[:, idx[0], idx[1]]*(0.5*sym_frob_weights(4, G.device, G.dtype))
+    return grad
+
 def compute_grad_fast(A, nu, q):
     """
     Input: A_vec: (B,4,4) tensor (parametrices B symmetric 4x4 matrices)
@@ -131,30 +343,492 @@ def compute_grad_fast(A, nu, q):
     assert(A.dim() > 2 and nu.dim() > 0 and q.dim() > 1)
     
     M = A.new_zeros((A.shape[0], 5, 5))
-    I = A.new_zeros((A.shape[0], 4, 4))
-
-    I[:,0,0] = I[:,1,1] = I[:,2,2] = I[:,3,3] = 1.
 
-    M[:, :4, :4] = A + I*nu.view(-1,1,1)
+    M[:, :4, :4] = A + sym_eye(4, A.device, A.dtype)*nu.view(-1,1,1)
     M[:, 4,:4] = q
     M[:, :4,4] = q
 
     b = A.new_zeros((A.shape[0], 5, 10))
 
-    #symmetric matrix indices
-    idx = torch.triu_indices(4,4)
-
-    i = torch.arange(10)
-    I_ij = A.new_zeros((10, 4, 4))
-
-    I_ij[i, idx[0], idx[1]] = 1.
-    I_ij[i, idx[1], idx[0]] = 1.
-    
-    I_ij = I_ij.expand(A.shape[0], 10, 4, 4)
+    #symmetric matrix basis
+    I_ij = sym_basis(4, A.device, A.dtype)
 
-    b[:, :4, :] = torch.einsum('bkij,bi->bjk',I_ij, q) 
+    b[:, :4, :] = torch.einsum('kij,bi->bjk',I_ij, q) 
 
     #This solves all gradients simultaneously!
     X, _ = torch.solve(b, M)
     grad = -1*X[:,:4,:]
-    return grad
\ No newline at end of file
+    return grad
+
+# #=========================WARM-STARTED (STREAMING) SOLVER=========================
+
+class QuadQuatWarmStartSolver(torch.nn.Module):
+    """
+    Stateful QCQP solver for streams of slowly varying A (e.g., consecutive frame pairs in online VO)
+    Input: Bx10 tensor 'A_vec' which encodes symmetric 4x4 matrices, A
+    Output: q that minimizes q^T A q s.t. |q| = 1
+
+    The solution of the previous call seeds a fixed number of Rayleigh-shifted inverse iterations
+    (see solve_wahba_warm) in place of a full eigendecomposition. Samples that do not pass the convergence and
+    eigengap checks fall back to solve_wahba_fast. Gradients use the KKT system (see compute_grad_fast).
+    The report of the last call is stored in self.report.
+    """
+    def __init__(self, iterations=3, shift=1e-5, tol=1e-5, gap_tol=1e-4, solver='symeig'):
+        super(QuadQuatWarmStartSolver, self).__init__()
+        self.iterations = iterations
+        self.shift = shift
+        self.tol = tol
+        self.gap_tol = gap_tol
+        self.solver = solver
+        self.q_prev = None
+        self.report = None
+
+    def reset(self):
+        self.q_prev = None
+        self.report = None
+
+    def forward(self, A_vec):
+        if A_vec.dim() < 2:
+            A_vec = A_vec.unsqueeze(dim=0)
+        A = convert_Avec_to_A(A_vec.detach())
+        if A.dim() < 3:
+            A = A.unsqueeze(dim=0)
+
+        with torch.no_grad():
+            if self.q_prev is None or self.q_prev.shape[0] != A.shape[0]:
+                #Cold start
+                q, nu = solve_wahba_fast(A, solver=self.solver)
+                self.report = {'iterations': 0, 'step': torch.zeros_like(nu.squeeze(1)),
+                               'residual': torch.zeros_like(nu.squeeze(1)),
+                               'converged': torch.ones_like(nu.squeeze(1), dtype=torch.bool),
+                               'fallback': torch.ones_like(nu.squeeze(1), dtype=torch.bool)}
+            else:
+                q, nu, self.report = solve_wahba_warm(A, self.q_prev.to(dtype=A.dtype, device=A.device),
+                                                      iterations=self.iterations, shift=self.shift,
+                                                      tol=self.tol, gap_tol=self.gap_tol,
+                                                      solver=self.solver)
+        self.q_prev = q
+        return QuadQuatKKTGrad.apply(A_vec, q, nu)
+
+
+class QuadQuatKKTGrad(torch.autograd.Function):
+    """
+    Attaches the implicit (KKT) gradient of the QCQP to an externally computed solution
+    Input: Bx10 tensor 'A_vec', (B,4) optimal q and (B,1) optimal nu for the encoded A
+    Output: q
+    """
+
+    @staticmethod
+    def forward(ctx, A_vec, q, nu):
+        A = convert_Avec_to_A(A_vec)
+        if A.dim() < 3:
+            A = A.unsqueeze(dim=0)
+        ctx.save_for_backward(A, q, nu)
+        return q.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        A, q, nu = ctx.saved_tensors
+        grad_qcqp = compute_grad_fast(A, nu, q)
+        outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
+        return outgrad, None, None
+
+def solve_wahba_warm(A, q_init, iterations=3, shift=1e-5, tol=1e-5, gap_tol=1e-4, solver='symeig'):
+    """
+    Input: A: (B,4,4) tensor (B symmetric 4x4 matrices)
+           q_init: (B,4) tensor (initial guess, e.g. the solution for the previous A)
+           iterations: number of (fixed) inverse iteration steps
+           shift: shift below the Rayleigh quotient, relative to |A|_F
+           tol: maximum change in q over the last iteration for a sample to be accepted
+           gap_tol: minimum eigengap / |A|_F for a sample to be accepted
+
+    Output: q: (B,4) tensor (optimal unit quaternions), nu: (B,1) tensor (optimal dual variables),
+            report: dict with the iteration count and per-sample 'step' (last change in q),
+                    'residual' (|Aq - rho*q| / |A|_F), 'converged' and 'fallback' tensors
+
+    Shifted inverse iteration, (A - (rho - shift)I) q_{k+1} ~ q_k with rho = q_k^T A q_k, converges to the
+    eigenvector whose eigenvalue is nearest the shift, which is the minimum one for a good seed. Acceptance
+    requires a small last step and A - (rho + gap)I + s*qq^T to be PD (i.e., all other eigenvalues are at least
+    'gap' above rho). Rejected samples are re-solved with solve_wahba_fast.
+    """
+    assert(A.dim() > 2 and q_init.dim() > 1)
+
+    I = sym_eye(4, A.device, A.dtype)
+    A_norm = A.norm(dim=[1,2]).view(-1, 1, 1)
+
+    q = q_init / q_init.norm(dim=1, keepdim=True)
+    q_last = q
+    for _ in range(iterations):
+        q_last = q
+        rho = torch.einsum('bi,bij,bj->b', q, A, q).view(-1, 1, 1)
+        y, _ = torch.solve(q.unsqueeze(2), A - (rho - shift*A_norm)*I)
+        q = y.squeeze(2) / y.norm(dim=1)
+
+    rho = torch.einsum('bi,bij,bj->b', q, A, q)
+    residual = (A.bmm(q.unsqueeze(2)).squeeze(2) - rho.unsqueeze(1)*q).norm(dim=1) / A_norm.view(-1)
+
+    #Eigengap check: the q direction is lifted by 2|A|_F, all others must stay positive after the gap shift
+    M = A - (rho.view(-1, 1, 1) + gap_tol*A_norm)*I + 2.*A_norm*torch.einsum('bi,bj->bij', q, q)
+    step = torch.min((q - q_last).norm(dim=1), (q + q_last).norm(dim=1))
+    converged = (step < tol) & (batch_ldl_pivots(M).min(dim=1)[0] > 0.)
+    converged = converged & torch.isfinite(q).all(dim=1)
+
+    q = q*torch.sign(q[:, 3]).unsqueeze(1)
+    nu = -1.*rho.unsqueeze(1)
+
+    fallback = converged.logical_not()
+    if fallback.any():
+        q_fb, nu_fb = solve_wahba_fast(A[fallback], solver=solver)
+        q[fallback] = q_fb
+        nu[fallback] = nu_fb
+
+    report = {'iterations': iterations, 'step': step, 'residual': residual, 'converged': converged, 'fallback': fallback}
+    return q, nu, report
+
+def batch_ldl_pivots(M):
+    """
+    Input: M: (B,N,N) tensor (B symmetric matrices)
+    Output: (B,N) tensor of pivots of Gaussian elimination without pivoting (i.e., D in M = LDL^T)
+
+    M is positive definite iff all pivots are positive. Once a non-positive pivot is hit the remaining
+    pivots of that sample are meaningless (but the sample is already known not to be PD).
+    """
+    M = M.clone()
+    N = M.shape[1]
+    pivots = M.new_empty((M.shape[0], N))
+    for k in range(N):
+        p = M[:, k, k]
+        pivots[:, k] = p
+        p_safe = torch.where(p > 0., p, torch.ones_like(p))
+        col = M[:, k+1:, k] / p_safe.unsqueeze(1)
+        M[:, k+1:, k+1:] = M[:, k+1:, k+1:] - torch.einsum('bi,bj->bij', col, M[:, k, k+1:])
+    return pivots
+
+
+# #=========================ROTATION MATRIX (HOMOGENEOUS) SOLVER=========================
+
+def rotation_matrix_constraints(redundant=True, right_handed=True, homogeneous=True):
+    '''
+    Return QCQP/SDP constraint matrices enforcing rotation matrices.
+
+    :param redundant: indicates whether to include redundant column orthogonality constraints
+    :param right_handed: indicates whether to enforce SO(3) right-handedness
+    :param homogeneous: indicates whether to include a homogenizing variably y^2 = 1
+    :return: array of quadratic constraint matrices, vector of constraint constants
+    '''
+    if right_handed:
+        homogeneous = True
+
+    if homogeneous:
+        N = 10
+    else:
+        N = 9
+    constraint_matrices = np.zeros((0, N, N))
+    c = []
+
+    # Homogeneous constraint
+    if homogeneous:
+        A_h = np.zeros((N, N))
+        A_h[-1, -1] = 1
+        constraint_matrices = np.append(constraint_matrices,
+                                        np.expand_dims(A_h, axis=0), axis=0)
+        c.append(1)
+
+    # Row constraints
+    for idx in range(3):
+        ind1 = slice(3 * idx, 3 * (idx + 1))
+        for jdx in range(idx+1):
+            ind2 = slice(3 * jdx, 3 * (jdx + 1))
+            A = np.zeros((N, N))
+            if idx == jdx:
+                A[ind1, ind1] = np.eye(3)
+                c.append(1)
+            else:
+                A[ind1, ind2] = 0.5*np.eye(3)
+                A[ind2, ind1] = 0.5*np.eye(3)
+                c.append(0)
+            constraint_matrices = np.append(constraint_matrices,
+                                        np.expand_dims(A, axis=0), axis=0)
+
+    # Column constraints
+    if redundant:
+        for idx in range(3):
+            for jdx in range(idx+1):
+                A = np.zeros((N, N))
+                if idx == jdx:
+                    A_sub = np.zeros((3, 3))
+                    A_sub[idx, idx] = 1
+                    A[0:3, 0:3] = A_sub
+                    A[3:6, 3:6] = A_sub
+                    A[6:9, 6:9] = A_sub
+                    c.append(1)
+                else:
+                    A_sub = np.zeros((3, 3))
+                    A_sub[idx, jdx] = 0.5
+                    A_sub[jdx, idx] = 0.5
+                    A[0:3, 0:3] = A_sub
+                    A[3:6, 3:6] = A_sub
+                    A[6:9, 6:9] = A_sub
+                    c.append(0)
+                constraint_matrices = np.append(constraint_matrices,
+                                        np.expand_dims(A, axis=0), axis=0)
+
+    # Right-handed constraint
+    if right_handed:
+        A_sub = -1*np.array([[[0, 0, 0], [0, 0, -1], [0, 1, 0]],
+                            [[0, 0, 1], [0, 0, 0], [-1, 0, 0]],
+                            [[0, -1, 0], [1, 0, 0], [0, 0, 0]]])
+
+        for idx in range(0, 3):
+            # Cyclic constraints {1,2,3}, {2,3,1}, {3,1,2}
+            ind1 = np.arange(3*idx, 3*(idx+1))
+            ind2 = slice(3*((idx+1)%3), 3*((idx+1)%3 + 1))
+            ind3 = np.arange(3*((idx+2) % 3), 3*((idx+2) % 3 + 1))
+            for jdx in range(0, 3):
+                A = np.zeros((N, N))
+                A[ind1, ind2] = A_sub[jdx, :, :]
+                A[ind3[jdx], -1] = -1
+                A = 0.5*(A+A.T)
+                constraint_matrices = np.append(constraint_matrices,
+                                        np.expand_dims(A, axis=0), axis=0)
+                c.append(0)
+
+    return constraint_matrices, np.array(c)
+
+#The identity on the 3x3 blocks is both the sum of the row and column norm constraints,
+#so the last column norm constraint is dropped (nu = 0) in the dual solve to keep its Hessian nonsingular
+ROTATION_DUAL_IDX = [idx for idx in range(22) if idx != 12]
+
+def rotation_constraints_torch(device=torch.device('cpu'), dtype=torch.double):
+    """ Cached (22,10,10) constraint matrices and (22,) constants of rotation_matrix_constraints()"""
+    def build():
+        E, c = rotation_matrix_constraints()
+        return torch.from_numpy(E).to(device=device, dtype=dtype), torch.from_numpy(c).to(device=device, dtype=dtype)
+    return cached_sym_tensor(('rotation_constraints', device, dtype), build)
+
+
+class HomogeneousRotationQCQPFastSolver(torch.autograd.Function):
+    """
+    Differentiable rotation matrix QCQP solver
+    Input: Bx55 tensor 'A_vec' which encodes symmetric 10x10 matrices, A
+    Output: (B,10) tensor r = [vec(C); 1] that minimizes r^T A r s.t. C in SO(3) (column-major vec)
+    """
+    @staticmethod
+    def forward(ctx, A_vec):
+        if A_vec.dim() < 2:
+            A_vec = A_vec.unsqueeze(dim=0)
+        A = convert_Avec_to_A(A_vec)
+        if A.dim() < 3:
+            A = A.unsqueeze(dim=0)
+        r, nu = solve_rotation_qcqp_fast(A)
+        ctx.save_for_backward(A, r, nu)
+        return r
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        A, r, nu = ctx.saved_tensors
+        E, _ = rotation_constraints_torch(A.device, A.dtype)
+        grad_qcqp = compute_rotation_QCQP_grad_fast(A, E, nu, r)
+        outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
+        return outgrad
+
+def solve_rotation_qcqp_fast(A, outer_iterations=10, newton_iterations=5, barrier_factor=10.):
+    """
+    Input: A: (B,10,10) tensor (B symmetric cost matrices)
+           outer_iterations: number of barrier parameter updates
+           newton_iterations: number of Newton steps per barrier parameter
+
+    Output: r: (B,10) tensor (optimal homogeneous vectorized rotation matrices)
+            nu: (B,22) tensor (optimal lagrange multipliers)
+
+    Batched log-barrier interior point method on the dual SDP,
+        max -c^T nu s.t. Z(nu) = A + sum_i nu_i E_i >= 0,
+    with a fixed iteration budget. Each barrier problem, min tau*c^T nu - log det Z(nu), is solved with damped
+    Newton steps (step 1/(1+lambda) for Newton decrement lambda >= 1/4), which keep Z(nu) positive definite
+    without a line search. The primal solution is the null vector of Z(nu) at the optimum.
+    The final duality gap is 10/tau = 10*barrier_factor^(-outer_iterations) (relative to |A|_F).
+    The solve always runs in double precision.
+    """
+    assert(A.dim() > 2 and A.shape[1] == 10 and A.shape[2] == 10)
+
+    #Single precision is not enough to follow the central path to a small gap
+    dtype = A.dtype
+    A = A.double()
+
+    E, c = rotation_constraints_torch(A.device, A.dtype)
+    E_dual = E[ROTATION_DUAL_IDX]
+    c_dual = c[ROTATION_DUAL_IDX]
+
+    #Solve with unit norm A; the multipliers scale with |A|_F
+    A_norm = A.norm(dim=[1,2]).view(-1, 1)
+    A_unit = A / A_norm.unsqueeze(2)
+
+    #Z(nu) = A_unit + 2I is strictly feasible (the homogeneous and row norm constraints sum to I)
+    nu = A.new_zeros((A.shape[0], len(ROTATION_DUAL_IDX)))
+    nu[:, [0, 1, 3, 6]] = 2.
+
+    tau = 1.
+    for _ in range(outer_iterations):
+        for _ in range(newton_iterations):
+            Z = A_unit + torch.einsum('bi,imn->bmn', nu, E_dual)
+            ZiE = torch.einsum('bmn,inp->bimp', torch.inverse(Z), E_dual)
+            g = tau*c_dual - ZiE.diagonal(dim1=2, dim2=3).sum(dim=2)
+            H = torch.einsum('bimn,bjnm->bij', ZiE, ZiE)
+            d, _ = torch.solve(-g.unsqueeze(2), H)
+            d = d.squeeze(2)
+            decrement = torch.sqrt(torch.clamp(-(g*d).sum(dim=1, keepdim=True), min=0.))
+            step = torch.where(decrement < 0.25, torch.ones_like(decrement), 1./(1. + decrement))
+            nu = nu + step*d
+        tau = tau*barrier_factor
+
+    #Primal solution from the (near) null space of Z(nu)
+    Z = A_unit + torch.einsum('bi,imn->bmn', nu, E_dual)
+    _, evs = torch.symeig(Z, eigenvectors=True)
+    r = evs[:, :, 0]
+    r = r / r[:, 9:]
+
+    nu_out = A.new_zeros((A.shape[0], 22))
+    nu_out[:, ROTATION_DUAL_IDX] = nu*A_norm
+    return r.to(dtype), nu_out.to(dtype)
+
+def compute_rotation_QCQP_grad_fast(A, E, nu, x):
+    """
+    Input: A: (B,10,10) tensor (parametrices B symmetric 4x4 matrices)
+           E: (22,10,10) tensor (quadratic symmetric equality constraint matrices)
+           nu: (B,22) tensor (optimal lagrange multipliers)
+           x: (B,10) tensor (optimal vectorized rotation matrices with homogenizing 10th entry of 1)
+
+    Output: grad: (B, 10, 55) tensor (gradient)
+
+    Applies the implicit function theorem to compute gradients of the solution to an equality-constrained
+    homogeneous rotation matrix QCQP.
+    """
+    assert(A.dim() > 2)
+    assert(E.dim() > 2)
+    assert(nu.dim() > 1)
+    assert(x.dim() > 1)
+
+    # Remove redundant/SO(3) constraints
+    num_constraints = 7
+    M = A.new_zeros((A.shape[0], 10 + num_constraints, 10 + num_constraints))
+
+    M[:, :10, :10] = A + torch.einsum('bi,imn->bmn', nu, E)
+    B = torch.einsum('mij,bj->bim', E[:num_constraints, :, :], x)
+    M[:, :10, 10:] = B
+    M[:, 10:, :10] = B.transpose(1, 2)
+
+    b = A.new_zeros((A.shape[0], 10+num_constraints, 55))
+
+    # symmetric matrix basis
+    I_ij = sym_basis(10, A.device, A.dtype)
+
+    b[:, :10, :] = torch.einsum('kij,bi->bjk', I_ij, x)
+
+    # This solves all gradients simultaneously!
+    X, _ = torch.solve(b, M)
+
+    grad = -1 * X[:, :10, :]
+
+    return grad
+
+
+# #=========================SDP RELAXATION LAYER (CVXPYLAYERS)=========================
+def x_from_xxT(xxT):
+    """
+    Input: BxNxN symmetric rank 1 tensor 
+    Output: BxN tensor x s.t. xxT = x*x.T (outer product), assumes last element must be positive to resolve sign ambiguities
+    """
+
+    if xxT.dim() < 3:
+        xxT = xxT.unsqueeze(dim=0)
+    assert(xxT.shape[1] == xxT.shape[2])
+    N = xxT.shape[1]
+    x = torch.sqrt(torch.abs(xxT[:, torch.arange(N), torch.arange(N)]))
+    signs = torch.sign(xxT[:, :, -1])
+    x = x * signs
+    return x.squeeze()
+
+def kronecker(A, B):
+
+    assert(A.dim() == B.dim())
+    assert(A.dim() > 1)
+    if A.dim() < 3:
+        A = A.unsqueeze(dim=0)
+        B = B.unsqueeze(dim=0)
+    assert(A.shape[0] == B.shape[0])
+
+    return torch.einsum("nab,ncd->nacbd", A, B).view(A.shape[0], A.shape[1]*B.shape[1],  A.shape[2]*B.shape[2]).squeeze()
+
+def A_from_16_vec(vec):
+    if vec.dim() < 2:
+        vec = vec.unsqueeze(dim=0)
+    assert(vec.shape[1] == 16)
+
+    idx = torch.triu_indices(3,3)
+    A = vec.new_zeros((vec.shape[0], 10, 10))
+
+    M = vec.new_zeros((vec.shape[0], 3, 3))
+    M[:, idx[0], idx[1]] = vec[:, :6]
+    M[:, idx[1], idx[0]] = vec[:, :6]
+    
+    I = vec.new_zeros((vec.shape[0], 3, 3))
+    I[:, torch.arange(3), torch.arange(3)] = 1. 
+
+    A[:, :9, :9] = kronecker(M, I)
+    A[:, :9, 9] = vec[:, 6:-1]
+    A[:, 9, :9] = vec[:, 6:-1]
+    A[:, 9, 9] = vec[:, -1]
+    return A
+    
+
+
+    
+
+
+
+class RotMatSDPSolver(torch.nn.Module):
+    def __init__(self, n_jobs=None):
+        """
+        :param n_jobs: passed to diffcp as n_jobs_forward / n_jobs_backward, the size of the thread pool
+                       diffcp solves (and differentiates) the batch with. None keeps diffcp's default (all cores);
+                       a value only caps or fixes the number of threads, there is no separate process pool.
+        """
+        super(RotMatSDPSolver, self).__init__()
+        #Optional dependencies: only the SDP layer needs them
+        import cvxpy as cp
+        from cvxpylayers.torch import CvxpyLayer
+
+        self.X = cp.Variable((10, 10), PSD=True)
+        self.constraint_matrices, self.c_vec = rotation_matrix_constraints()
+        self.constraints = [cp.trace(self.constraint_matrices[idx, :, :] @ self.X) == self.c_vec[idx]
+                    for idx in range(self.constraint_matrices.shape[0])]
+        self.A = cp.Parameter((10, 10), symmetric=True)
+        self.prob = cp.Problem(cp.Minimize(cp.trace(self.A @ self.X)), self.constraints)
+
+        #Canonicalize once; the compiled layer is reused for every batch
+        self.sdp_layer = CvxpyLayer(self.prob, parameters=[self.A], variables=[self.X])
+        if n_jobs is None:
+            self.solver_args = {}
+        else:
+            self.solver_args = {'n_jobs_forward': n_jobs, 'n_jobs_backward': n_jobs}
+
+    def forward(self, A_vec):
+        
+        if A_vec.dim() < 2:
+            A_vec = A_vec.unsqueeze(dim=0)
+
+        if A_vec.shape[1] == 16:
+            A = A_from_16_vec(A_vec)
+        else:
+            A = convert_Avec_to_A(A_vec)
+        
+        X, = self.sdp_layer(A, solver_args=self.solver_args)
+        x = x_from_xxT(X)
+
+
+        if x.dim() < 2:
+            x = x.unsqueeze(dim=0)
+
+        r_vec = x[:, :9]
+        rotmat = r_vec.view(-1, 3,3).transpose(1,2)
+        return rotmat.squeeze()
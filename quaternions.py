@@ -6,7 +6,7 @@ import math
 #NUMPY
 ##########
 def Omega_l(q):
-    Om = np.zeros((4,4)) * np.nan
+    Om = np.zeros((4,4))
     np.fill_diagonal(Om, q[3]) 
     
     Om[0,1] = -q[2]
@@ -28,7 +28,7 @@ def Omega_l(q):
     return Om
 
 def Omega_r(q):
-    Om = np.zeros((4,4)) * np.nan
+    Om = np.zeros((4,4))
     np.fill_diagonal(Om, q[3]) 
     
     Om[0,1] = q[2]
@@ -59,13 +59,81 @@ def pure_quat(v):
 
 #ASSUMES XYZW
 def quat_inv(q):
-    #Note, 'empty_like' is necessary to prevent in-place modification (which is not auto-diff'able)
-    if q.dim() < 2:
-        q = q.unsqueeze()
-    q_inv = torch.empty_like(q)
-    q_inv[:, :3] = -1*q[:, :3]
-    q_inv[:, 3] = q[:, 3]
-    return q_inv.squeeze()
+    #Unit quaternions only; shape is preserved
+    return quat_conj(q)
+
+#Batched quaternion algebra (XYZW, Hamilton convention): all functions take (...,4) tensors
+#and follow quat_to_rotmat(quat_mul(q_a, q_b)) = quat_to_rotmat(q_a).bmm(quat_to_rotmat(q_b)).
+def quat_conj(q):
+    return torch.cat((-q[..., :3], q[..., 3:]), dim=-1)
+
+def quat_pure(v):
+    return torch.cat((v, v.new_zeros(v.shape[:-1] + (1,))), dim=-1)
+
+def quat_omega_l(q):
+    #Batched Omega_l: quat_omega_l(q).matmul(p) = q * p
+    x, y, z, w = q.unbind(dim=-1)
+    return torch.stack((
+        torch.stack((w, -z, y, x), dim=-1),
+        torch.stack((z, w, -x, y), dim=-1),
+        torch.stack((-y, x, w, z), dim=-1),
+        torch.stack((-x, -y, -z, w), dim=-1)), dim=-2)
+
+def quat_omega_r(q):
+    #Batched Omega_r: quat_omega_r(q).matmul(p) = p * q
+    x, y, z, w = q.unbind(dim=-1)
+    return torch.stack((
+        torch.stack((w, z, -y, x), dim=-1),
+        torch.stack((-z, w, x, y), dim=-1),
+        torch.stack((y, -x, w, z), dim=-1),
+        torch.stack((-x, -y, -z, w), dim=-1)), dim=-2)
+
+def quat_mul(q_a, q_b):
+    #Hamilton product q_a * q_b (broadcasts over leading dimensions)
+    v_a, w_a = q_a[..., :3], q_a[..., 3:]
+    v_b, w_b = q_b[..., :3], q_b[..., 3:]
+    v_a, v_b = torch.broadcast_tensors(v_a, v_b)
+    v = w_a*v_b + w_b*v_a + torch.cross(v_a, v_b, dim=-1)
+    w = w_a*w_b - (v_a*v_b).sum(dim=-1, keepdim=True)
+    return torch.cat((v, w), dim=-1)
+
+def quat_compose(*qs):
+    #Composes rotations left to right (C_1 C_2 ... C_n) and renormalizes to unit length
+    q = qs[0]
+    for q_i in qs[1:]:
+        q = quat_mul(q, q_i)
+    return q/q.norm(dim=-1, keepdim=True)
+
+def quat_rotate(q, v):
+    #Rotates 3-vectors v (...,3) by unit quaternions q (...,4), i.e. C(q)v
+    u, w = q[..., :3], q[..., 3:]
+    u, v = torch.broadcast_tensors(u, v)
+    t = 2.*torch.cross(u, v, dim=-1)
+    return v + w*t + torch.cross(u, t, dim=-1)
+
+def quat_exp(phi):
+    #Axis-angle vector (...,3) to unit quaternion; sinc keeps small angles smooth
+    angle = phi.norm(dim=-1, keepdim=True)
+    v = 0.5*torch.sinc(angle/(2.*np.pi))*phi
+    return torch.cat((v, torch.cos(0.5*angle)), dim=-1)
+
+def quat_log(q):
+    #Unit quaternion to axis-angle vector (...,3) with angle in [0, pi]
+    q = torch.where(q[..., 3:] < 0., -q, q)
+    v, w = q[..., :3], q[..., 3:]
+    v_norm = v.norm(dim=-1, keepdim=True)
+    angle = 2.*torch.atan2(v_norm, w)
+    #angle/|v| -> 2/w as |v| -> 0
+    small = v_norm < 1e-8
+    scale = torch.where(small, 2./w, angle/torch.where(small, torch.ones_like(v_norm), v_norm))
+    return scale*v
+
+def quat_slerp(q_a, q_b, t):
+    #Spherical linear interpolation along the shortest arc; t is a scalar or broadcastable to (...,1)
+    if torch.is_tensor(t) and t.dim() > 0:
+        t = t.unsqueeze(dim=-1)
+    q_ab = quat_mul(quat_conj(q_a), q_b)
+    return quat_mul(q_a, quat_exp(t*quat_log(q_ab)))
 
 
 #Quaternion difference of two unit quaternions
@@ -95,52 +163,38 @@ def quat_norm_to_angle(q_norms, units='deg'):
     return angle
 
 
-def quat_to_rotmat(quat, ordering='xyzw'):
+def quat_to_rotmat(quat, ordering='xyzw', check_norm=False):
     """Form a rotation matrix from a unit length quaternion.
 
         Valid orderings are 'xyzw' and 'wxyz'.
+        The unit norm check (and normalization) is opt-in since it synchronizes with the device.
     """
     if quat.dim() < 2:
         quat = quat.unsqueeze(dim=0)
 
-    if not utils.allclose(quat.norm(p=2, dim=1), 1.):
+    if check_norm and not utils.allclose(quat.norm(p=2, dim=1), 1.):
         print("Warning: Some quaternions not unit length ... normalizing.")
         quat = quat/quat.norm(p=2, dim=1, keepdim=True)
 
-    if ordering is 'xyzw':
-        qx = quat[:, 0]
-        qy = quat[:, 1]
-        qz = quat[:, 2]
-        qw = quat[:, 3]
-    elif ordering is 'wxyz':
-        qw = quat[:, 0]
-        qx = quat[:, 1]
-        qy = quat[:, 2]
-        qz = quat[:, 3]
+    if ordering == 'xyzw':
+        qx, qy, qz, qw = quat.unbind(dim=1)
+    elif ordering == 'wxyz':
+        qw, qx, qy, qz = quat.unbind(dim=1)
     else:
         raise ValueError(
             "Valid orderings are 'xyzw' and 'wxyz'. Got '{}'.".format(ordering))
 
     # Form the matrix
-    mat = quat.new_empty(quat.shape[0], 3, 3)
-
     qx2 = qx * qx
     qy2 = qy * qy
     qz2 = qz * qz
 
-    mat[:, 0, 0] = 1. - 2. * (qy2 + qz2)
-    mat[:, 0, 1] = 2. * (qx * qy - qw * qz)
-    mat[:, 0, 2] = 2. * (qw * qy + qx * qz)
-
-    mat[:, 1, 0] = 2. * (qw * qz + qx * qy)
-    mat[:, 1, 1] = 1. - 2. * (qx2 + qz2)
-    mat[:, 1, 2] = 2. * (qy * qz - qw * qx)
-
-    mat[:, 2, 0] = 2. * (qx * qz - qw * qy)
-    mat[:, 2, 1] = 2. * (qw * qx + qy * qz)
-    mat[:, 2, 2] = 1. - 2. * (qx2 + qy2)
+    mat = torch.stack((
+        1. - 2. * (qy2 + qz2), 2. * (qx * qy - qw * qz), 2. * (qw * qy + qx * qz),
+        2. * (qw * qz + qx * qy), 1. - 2. * (qx2 + qz2), 2. * (qy * qz - qw * qx),
+        2. * (qx * qz - qw * qy), 2. * (qw * qx + qy * qz), 1. - 2. * (qx2 + qy2)), dim=1)
 
-    return mat.squeeze_()
+    return mat.view(-1, 3, 3).squeeze()
 
 
 #Based on https://d3cw3dd2w32x2b.cloudfront.net/wp-content/uploads/2015/01/matrix-to-quat.pdf
@@ -159,54 +213,28 @@ def rotmat_to_quat(mat, ordering='xyzw'):
 
     #Row first operation
     R = R.transpose(1,2)
-    q = R.new_empty((R.shape[0], 4))
-
-    cond1_mask = R[:, 2, 2] < 0.
-    cond1a_mask = R[:, 0, 0] > R[:, 1, 1]
-    cond1b_mask = R[:, 0, 0] < -R[:, 1, 1]
-
-    if ordering=='xyzw':
-        v_ind = torch.arange(0,3)
-        w_ind = 3
-    else:
-        v_ind = torch.arange(1,4)
-        w_ind = 0    
-
-    mask = cond1_mask & cond1a_mask
-    if mask.any():
-        t = 1 + R[mask, 0, 0] - R[mask, 1, 1] - R[mask, 2, 2]
-        q[mask, w_ind] =  R[mask, 1, 2]- R[mask, 2, 1]
-        q[mask, v_ind[0]] = t
-        q[mask, v_ind[1]] = R[mask, 0, 1] + R[mask, 1, 0]
-        q[mask, v_ind[2]] = R[mask, 2, 0] + R[mask, 0, 2]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask & cond1a_mask.logical_not()
-    if mask.any():
-        t = 1 - R[mask,0, 0] + R[mask,1, 1] - R[mask,2, 2]
-        q[mask, w_ind] =  R[mask,2, 0]-R[mask,0, 2]
-        q[mask, v_ind[0]] = R[mask,0, 1]+R[mask,1, 0]
-        q[mask, v_ind[1]] = t
-        q[mask, v_ind[2]] = R[mask,1, 2]+R[mask,2, 1]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask.logical_not() & cond1b_mask
-    if mask.any():
-        t = 1 - R[mask,0, 0] - R[mask,1, 1] + R[mask,2, 2]
-        q[mask, w_ind] =  R[mask,0, 1]-R[mask,1, 0]
-        q[mask, v_ind[0]] = R[mask,2, 0]+R[mask,0, 2]
-        q[mask, v_ind[1]] = R[mask,1, 2]+R[mask,2, 1]
-        q[mask, v_ind[2]] = t
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask.logical_not() & cond1b_mask.logical_not()
-    if mask.any():
-        t = 1 + R[mask, 0, 0] + R[mask,1, 1] + R[mask,2, 2]
-        q[mask, w_ind] = t
-        q[mask, v_ind[0]] = R[mask,1, 2]-R[mask,2, 1]
-        q[mask, v_ind[1]] = R[mask,2, 0]-R[mask,0, 2]
-        q[mask, v_ind[2]] = R[mask,0, 1]-R[mask,1, 0]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
+    R00, R01, R02, R10, R11, R12, R20, R21, R22 = R.reshape(-1, 9).unbind(dim=1)
+
+    #All four candidates (xyzw, unnormalized) and their pivots
+    t = torch.stack((1 + R00 - R11 - R22, 
+                     1 - R00 + R11 - R22, 
+                     1 - R00 - R11 + R22, 
+                     1 + R00 + R11 + R22), dim=1)
+    q_cand = torch.stack((
+        torch.stack((t[:, 0], R01 + R10, R20 + R02, R12 - R21), dim=1),
+        torch.stack((R01 + R10, t[:, 1], R12 + R21, R20 - R02), dim=1),
+        torch.stack((R20 + R02, R12 + R21, t[:, 2], R01 - R10), dim=1),
+        torch.stack((R12 - R21, R20 - R02, R01 - R10, t[:, 3]), dim=1)), dim=1)
+
+    #Select the branch without host syncs; only the selected pivot enters the sqrt (keeps gradients finite)
+    cond1_mask = R22 < 0.
+    branch = torch.where(cond1_mask, (R00 <= R11).long(), 2 + (R00 >= -R11).long())
+    q = q_cand.gather(1, branch.view(-1, 1, 1).expand(-1, 1, 4)).squeeze(1)
+    t = t.gather(1, branch.view(-1, 1))
+    q = q * (0.5 / torch.sqrt(t))
+
+    if ordering != 'xyzw':
+        q = q[:, [3, 0, 1, 2]]
     
     return q.squeeze()
 
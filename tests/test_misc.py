@@ -65,10 +65,59 @@ def test_xxT():
     assert(allclose(x, x_from_xxT(X)))
     print('All passed.')
 
+def test_batch_quat_algebra():
+    print('Testing batched quaternion algebra...')
+    N = 100
+    C_a = SO3.exp(torch.randn(N, 3, dtype=torch.double))
+    C_b = SO3.exp(torch.randn(N, 3, dtype=torch.double))
+    q_a = rotmat_to_quat(C_a.as_matrix())
+    q_b = rotmat_to_quat(C_b.as_matrix())
+
+    #Hamilton product agrees with the Omega matrices and with rotation composition
+    q_ab = quat_mul(q_a, q_b)
+    assert(allclose(q_ab, quat_omega_l(q_a).bmm(q_b.unsqueeze(2)).squeeze(2)))
+    assert(allclose(q_ab, quat_omega_r(q_b).bmm(q_a.unsqueeze(2)).squeeze(2)))
+    assert(allclose(quat_omega_l(q_a[0]), torch.from_numpy(Omega_l(q_a[0].numpy()))))
+    assert(allclose(quat_omega_r(q_a[0]), torch.from_numpy(Omega_r(q_a[0].numpy()))))
+    assert(allclose(quat_to_rotmat(quat_compose(q_a, q_b)), C_a.dot(C_b).as_matrix()))
+    assert(allclose(quat_mul(q_a, quat_inv(q_a)), torch.tensor([0., 0., 0., 1.], dtype=torch.double)))
+
+    #Rotation of vectors and exp/log
+    v = torch.randn(N, 3, dtype=torch.double)
+    assert(allclose(quat_rotate(q_a, v), C_a.as_matrix().bmm(v.unsqueeze(2)).squeeze(2)))
+    phi = C_a.log()
+    assert(allclose(quat_angle_diff(quat_exp(phi), q_a, reduce=False), 0., tol=1e-5))
+    assert(allclose(quat_log(q_a), phi))
+    assert(allclose(quat_exp(torch.zeros(1, 3)), torch.tensor([[0., 0., 0., 1.]])))
+
+    #Slerp end points and midpoint
+    assert(allclose(quat_angle_diff(quat_slerp(q_a, q_b, 0.), q_a, reduce=False), 0., tol=1e-5))
+    assert(allclose(quat_angle_diff(quat_slerp(q_a, q_b, 1.), q_b, reduce=False), 0., tol=1e-5))
+    q_mid = quat_slerp(q_a, q_b, 0.5*torch.ones(N, dtype=torch.double))
+    assert(allclose(quat_angle_diff(q_mid, q_a, reduce=False), quat_angle_diff(q_mid, q_b, reduce=False), tol=1e-5))
+    print('All passed.')
+
+def test_metrics_accumulator():
+    print('Testing MetricsAccumulator...')
+    losses = torch.rand(20)
+    errs = 180.*torch.rand(20)
+    metrics = MetricsAccumulator(['loss', 'mean_err'])
+    for k in range(20):
+        metrics.add(loss=losses[k], mean_err=errs[k].item())
+    means = metrics.means()
+    assert(isinstance(means['loss'], float))
+    assert(abs(means['loss'] - losses.double().mean().item()) < 1e-6)
+    assert(abs(means['mean_err'] - errs.double().mean().item()) < 1e-4)
+    metrics.reset()
+    assert(metrics.means() == {'loss': 0., 'mean_err': 0.})
+    print('All passed.')
+
 if __name__=='__main__':
     # test_rotmat_quat_conversions()
     # test_rot_angles()
     # test_xxT()
     # test_rotmat_quat_large_conversions()
     # test_chordal_squared_loss_equality()
+    # test_batch_quat_algebra()
+    # test_metrics_accumulator()
     test_180_quat()
\ No newline at end of file
@@ -56,6 +56,58 @@ def test_pytorch_fast_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
     assert (grad_test == True)
     print('Batch...Passed.')
 
+def test_pytorch_kkt_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
+    print('Checking PyTorch KKT gradients (random A, batch_size: {})'.format(num_samples))
+    qcqp_solver = lambda A_vec: QuadQuatFastSolver.apply(A_vec, 'symeig', 'kkt')
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+    input = (A_vec,)
+    grad_test = gradcheck(qcqp_solver, input, eps=eps, atol=tol)
+    assert (grad_test == True)
+    print('Batch...Passed.')
+
+def test_compare_eig_and_kkt_gradients(num_samples=1000):
+    print('Checking eigendecomposition gradients against KKT gradients (batch_size: {})'.format(num_samples))
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+    grad_output = torch.randn((num_samples, 4), dtype=torch.double)
+    grads = []
+    for solver in ['symeig', 'jacobi']:
+        for grad_mode in ['eig', 'kkt']:
+            q = QuadQuatFastSolver.apply(A_vec, solver, grad_mode)
+            grads.append(torch.autograd.grad(q, A_vec, grad_output)[0])
+    for grad in grads[1:]:
+        assert allclose(grads[0], grad, tol=1e-6)
+    print('Passed.')
+
+def test_pytorch_fused_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
+    print('Checking PyTorch fused solver gradients (random A, batch_size: {})'.format(num_samples))
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+    for enforce_psd in [False, True]:
+        for unit_frob_norm in [False, True]:
+            qcqp_solver = lambda A_vec: QuadQuatFusedSolver.apply(A_vec, enforce_psd, unit_frob_norm)
+            grad_test = gradcheck(qcqp_solver, (A_vec,), eps=eps, atol=tol)
+            assert (grad_test == True)
+    print('Batch...Passed.')
+
+def test_compare_fused_and_chained_solvers(num_samples=1000):
+    print('Checking fused solver against the chained A_vec pipeline (batch_size: {})'.format(num_samples))
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+    grad_output = torch.randn((num_samples, 4), dtype=torch.double)
+    for enforce_psd in [False, True]:
+        for unit_frob_norm in [False, True]:
+            A_vec_chained = A_vec
+            if enforce_psd:
+                A_vec_chained = convert_Avec_to_Avec_psd(A_vec_chained)
+            if unit_frob_norm:
+                A_vec_chained = normalize_Avec(A_vec_chained)
+            q = QuadQuatFastSolver.apply(A_vec_chained)
+            q_fused = QuadQuatFusedSolver.apply(A_vec, enforce_psd, unit_frob_norm)
+            assert allclose(q, q_fused, tol=1e-8)
+
+            grad = torch.autograd.grad(q, A_vec, grad_output)[0]
+            grad_fused = torch.autograd.grad(q_fused, A_vec, grad_output)[0]
+            assert allclose(grad, grad_fused, tol=1e-6)
+    print('Passed.')
+
 def test_duality_gap_wahba_solver(num_samples=100):
     print('Checking duality gap on the fast Wahba solver')
     A = torch.randn((num_samples, 4, 4), dtype=torch.double, requires_grad=True)
@@ -80,6 +132,77 @@ def test_compare_fast_and_slow_solvers(eps=1e-6, tol=1e-4, num_samples=5):
     # print(q_out)
     # print(q_out_fast)
 
+def test_jacobi_symeig_parity(num_samples=1000):
+    print('Checking batched Jacobi eigensolver against torch.symeig (batch_size: {})'.format(num_samples))
+    A = torch.randn((num_samples, 4, 4), dtype=torch.double)
+    A = 0.5*(A.transpose(1, 2) + A)
+    nus, qs = torch.symeig(A, eigenvectors=True)
+    nus_jac, qs_jac = batch_symeig_4x4(A)
+    assert allclose(nus, nus_jac, tol=1e-10)
+    #Eigenvectors are only unique up to sign
+    signs = torch.sign((qs*qs_jac).sum(dim=1, keepdim=True))
+    assert allclose(qs, signs*qs_jac, tol=1e-8)
+    print('Passed.')
+
+def test_compare_symeig_and_jacobi_solvers(num_samples=1000):
+    print('Checking accuracy of Jacobi engine in fast solver')
+    for dtype, tol in [(torch.double, 1e-8), (torch.float, 1e-3)]:
+        A_vec = torch.randn((num_samples, 10), dtype=dtype)
+        A = convert_Avec_to_A(A_vec)
+        q, nu = solve_wahba_fast(A)
+        q_jac, nu_jac = solve_wahba_fast(A, solver='jacobi')
+        assert allclose(nu, nu_jac, tol=tol)
+        assert allclose(quat_norm_diff(q, q_jac), 0., tol=tol)
+
+        q_out = QuadQuatFastSolver.apply(A_vec)
+        q_out_jac = QuadQuatFastSolver.apply(A_vec, 'jacobi')
+        assert allclose(quat_norm_diff(q_out, q_out_jac), 0., tol=tol)
+    print('Passed.')
+
+def test_Avec_conversions(num_samples=100):
+    print('Checking A_vec conversions for arbitrary dimensions')
+    for N in [3, 4, 10, 13]:
+        A = torch.randn((num_samples, N, N), dtype=torch.double)
+        A = 0.5*(A.transpose(1, 2) + A)
+        A_vec = convert_A_to_Avec(A)
+        assert(A_vec.shape[1] == N*(N+1)//2)
+        assert allclose(convert_Avec_to_A(A_vec), A)
+
+        A_unit = convert_Avec_to_A(normalize_Avec(A_vec))
+        assert allclose(A_unit, A / A.norm(dim=[1,2], keepdim=True))
+
+        L = torch.zeros_like(A)
+        idx = torch.tril_indices(N, N)
+        L[:, idx[0], idx[1]] = A_vec
+        assert allclose(convert_Avec_to_A(convert_Avec_to_Avec_psd(A_vec)), L.bmm(L.transpose(1, 2)))
+    print('Passed.')
+
+def test_warm_start_solver(num_samples=100, num_frames=10):
+    print('Checking warm-started solver on a stream of slowly varying A (batch_size: {})'.format(num_samples))
+    A = torch.randn((num_samples, 4, 4), dtype=torch.double)
+    A = 0.5*(A.transpose(1, 2) + A)
+    solver = QuadQuatWarmStartSolver(iterations=3)
+    for _ in range(num_frames):
+        dA = 1e-2*torch.randn((num_samples, 4, 4), dtype=torch.double)
+        A = A + 0.5*(dA.transpose(1, 2) + dA)
+        q = solver(convert_A_to_Avec(A))
+        q_fast, _ = solve_wahba_fast(A)
+        assert allclose(quat_norm_diff(q, q_fast), 0., tol=1e-6)
+    assert(solver.report['iterations'] == 3)
+
+    #Seeding with the maximum eigenvector must be caught and re-solved
+    nus, qs = torch.symeig(A, eigenvectors=True)
+    q, _, report = solve_wahba_warm(A, qs[:, :, -1])
+    assert(report['fallback'].all())
+    assert allclose(quat_norm_diff(q, solve_wahba_fast(A)[0]), 0., tol=1e-6)
+
+    #Repeated minimum eigenvalues have no unique solution and must fall back as well
+    nus[:, 1] = nus[:, 0]
+    A_degenerate = qs.bmm(torch.diag_embed(nus)).bmm(qs.transpose(1, 2))
+    _, _, report = solve_wahba_warm(A_degenerate, qs[:, :, 0])
+    assert(report['fallback'].all())
+    print('Passed.')
+
 def test_rotmat_wahba():
     print('Checking accuracy of QCQP rotmat solver')
     N = 1000
@@ -134,6 +257,60 @@ def create_wahba_As(N=10):
             A[n] += torch.from_numpy(mat.T.dot(mat))
     return A, C
 
+def test_build_A_batch(N=20):
+    print('Checking batched A construction against build_A and create_wahba_As.')
+    N_points = 100
+    sigma_2 = np.random.rand(N_points) + 0.1
+    x_1 = torch.empty(N, N_points, 3, dtype=torch.double)
+    x_2 = torch.empty(N, N_points, 3, dtype=torch.double)
+    A = torch.empty(N, 4, 4, dtype=torch.double)
+    A_rotmat = torch.zeros(N, 10, 10, dtype=torch.double)
+    for n in range(N):
+        _, x_1_n, x_2_n = gen_sim_data(N_points, 0.01)
+        x_1[n] = torch.from_numpy(x_1_n)
+        x_2[n] = torch.from_numpy(x_2_n)
+        A[n] = torch.from_numpy(build_A(x_1_n, x_2_n, sigma_2))
+        for i in range(N_points):
+            mat = np.zeros((3,10))
+            mat[:,:9] = np.kron(x_1_n[i], np.eye(3))
+            mat[:,9] = -x_2_n[i]
+            A_rotmat[n] += torch.from_numpy(mat.T.dot(mat)/sigma_2[i])
+
+    sigma_2 = torch.from_numpy(sigma_2)
+    assert allclose(A, build_A_batch(x_1, x_2, sigma_2))
+    assert allclose(A_rotmat, build_A_rotmat_batch(x_1, x_2, sigma_2))
+    print('Passed.')
+
+def test_synthetic_wahba_stream():
+    print('Checking reproducibility of streamed synthetic Wahba minibatches.')
+    stream = SyntheticWahbaStream(100, 25, 50, sigma=0., seed=1, dtype=torch.double)
+    batches = list(stream.epoch(0))
+    assert len(batches) == 4
+    assert batches[0].x.shape == (25, 2, 50, 3) and batches[0].q.shape == (25, 4)
+    #Each minibatch only depends on its (epoch, index) counter
+    assert allclose(batches[2].x, stream.batch(0, 2).x)
+    assert not allclose(batches[2].x, stream.batch(1, 2).x)
+    #Noise-free matches are exactly rotated
+    C = quat_to_rotmat(batches[1].q)
+    assert allclose(batches[1].x[:, 1], batches[1].x[:, 0].bmm(C.transpose(1,2)))
+    print('Passed.')
+
+def test_rotmat_fast_wahba(N=100):
+    print('Checking accuracy of batched QCQP rotmat solver with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    start = time.time()
+    r, nu = solve_rotation_qcqp_fast(A)
+    C_solve = r[:, :9].view(-1, 3, 3).transpose(1, 2)
+    mean_error = rotmat_angle_diff(C, C_solve, units='deg').item()
+    print('Mean angle error: {:.3E} deg. Total solve time: {:.3F} sec.'.format(mean_error, time.time() - start))
+    assert(mean_error < 1e-4)
+
+    #Strong duality
+    E, c = rotation_constraints_torch(A.device, A.dtype)
+    gap = torch.einsum('bi,bij,bj->b', r, A, r) + nu.matmul(c)
+    assert allclose(gap / A.norm(dim=[1,2]), 0., tol=1e-6)
+    print('Passed.')
+
 def test_rotmat_sdp_wahba():
     N = 10
     print('Checking accuracy of SDP rotmat solver with {} datasets.'.format(N))
@@ -207,10 +384,21 @@ if __name__=='__main__':
     # test_pytorch_analytic_gradient()
     # print("=============")
     # test_pytorch_fast_analytic_gradient()
+    # test_pytorch_kkt_analytic_gradient()
+    # test_compare_eig_and_kkt_gradients()
+    # test_pytorch_fused_analytic_gradient()
+    # test_compare_fused_and_chained_solvers()
     # print("=============")
     # test_compare_fast_and_slow_solvers()
     # print("=============")
     # test_duality_gap_wahba_solver()
+    # print("=============")
+    # test_jacobi_symeig_parity()
+    # test_compare_symeig_and_jacobi_solvers()
+    # test_Avec_conversions()
+    # test_warm_start_solver()
+    # test_build_A_batch()
+    # test_synthetic_wahba_stream()
 
     # print("=============")
     # test_pytorch_manual_analytic_gradient()
@@ -218,6 +406,7 @@ if __name__=='__main__':
     #print('===============')
     #test_rotmat_sdp_wahba()
     #test_rotmat_wahba()
+    #test_rotmat_fast_wahba()
     # print("=============")
     # test_rotmat_pytorch_analytic_gradient()
     print("=============")
@@ -3,6 +3,8 @@ import numpy as np
 from liegroups.numpy import SO3
 from numpy.linalg import norm
 import math
+import os
+import multiprocessing as mp
 
 def allclose(mat1, mat2, tol=1e-6):
     """Check if all elements of two tensors are close within some tolerance.
@@ -181,4 +183,87 @@ def matrix_diff(X,Y):
     return np.abs(np.linalg.norm(X - Y) / min(np.linalg.norm(X), np.linalg.norm(Y)))
     
 def loguniform(low=0, high=1, size=None):
-    return np.exp(np.random.uniform(low, high, size))
\ No newline at end of file
+    return np.exp(np.random.uniform(low, high, size))
+
+
+class MetricsAccumulator():
+    """Running means of per-batch scalar metrics (e.g., loss, mean error).
+
+    The sums stay on the device the metrics are computed on, so adding a batch never
+    forces a host sync; means() copies all of them to the host at once.
+    """
+    def __init__(self, names, device=None, dtype=torch.double):
+        self.names = list(names)
+        self.device = device
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.count = 0
+
+    def add(self, **metrics):
+        values = torch.stack([torch.as_tensor(metrics[name]).detach().to(device=self.device, dtype=self.dtype).reshape(()) for name in self.names])
+        if self.sums is None:
+            self.sums = torch.zeros_like(values)
+        self.sums += values
+        self.count += 1
+
+    def means(self):
+        if self.count == 0:
+            return {name: 0. for name in self.names}
+        means = (self.sums / self.count).cpu().tolist()
+        return dict(zip(self.names, means))
+
+
+def _init_trial_worker(num_threads):
+    #One pool process per trial slot; pinning intra-op threads keeps the processes from oversubscribing the cores
+    torch.set_num_threads(num_threads)
+
+def _run_trial(trial):
+    trial_fn, t_i, params, base_seed = trial
+    #Seeded by trial index, so a trial does not depend on which process (or after which other trials) it runs
+    torch.manual_seed(base_seed + t_i)
+    np.random.seed(base_seed + t_i)
+    return t_i, trial_fn(t_i, params)
+
+def save_trials_checkpoint(checkpoint_file, trial_params, results, base_seed):
+    #Write to a temporary file first so that an interrupted save never corrupts the checkpoint
+    torch.save({'trial_params': trial_params, 'results': results, 'base_seed': base_seed}, checkpoint_file + '.tmp')
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def run_trials(trial_fn, trial_params, num_procs=1, threads_per_proc=None, checkpoint_file=None, base_seed=0):
+    """Runs trial_fn(t_i, trial_params[t_i]) for every (independent) trial, in a pool of num_procs processes.
+
+    trial_fn must be a module-level (picklable) function; workers are spawned, so it should build its own data.
+    Torch and numpy are seeded with base_seed + t_i before each trial.
+    If checkpoint_file is given, every finished trial is saved to it, and an existing checkpoint is resumed
+    (with the trial parameters and base seed it was started with).
+    Returns the trial parameters and the list of trial results (in trial order).
+    """
+    results = {}
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        checkpoint = torch.load(checkpoint_file)
+        trial_params = checkpoint['trial_params']
+        results = checkpoint['results']
+        base_seed = checkpoint.get('base_seed', base_seed)
+        print('Resuming from {}: {}/{} trials done.'.format(checkpoint_file, len(results), len(trial_params)))
+
+    pending = [(trial_fn, t_i, params, base_seed) for t_i, params in enumerate(trial_params) if t_i not in results]
+    if threads_per_proc is None:
+        threads_per_proc = max(1, (os.cpu_count() or 1) // num_procs)
+
+    def finished(t_i, result):
+        results[t_i] = result
+        if checkpoint_file is not None:
+            save_trials_checkpoint(checkpoint_file, trial_params, results, base_seed)
+
+    if num_procs > 1 and len(pending) > 1:
+        with mp.get_context('spawn').Pool(num_procs, initializer=_init_trial_worker, initargs=(threads_per_proc,)) as pool:
+            for t_i, result in pool.imap_unordered(_run_trial, pending):
+                finished(t_i, result)
+    else:
+        for trial in pending:
+            finished(*_run_trial(trial))
+
+    return trial_params, [results[t_i] for t_i in range(len(trial_params))]